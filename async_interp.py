@@ -0,0 +1,165 @@
+import asyncio
+import inspect
+import time
+import unittest
+from collections import deque
+
+import cps
+from cps import RESUME, Call, Profile, apply_cont, as_env, cps_cont, drive, triv
+
+
+"""
+An asyncio driver for cps.interp's machine.
+
+interp_async runs the same transitions as cps.interp, except for calls to
+host procedures. A host procedure may be a coroutine function taking the
+argument alone,
+
+    async def fetch(url):
+        ...
+        return body
+
+and its result, once awaited, is passed to the call's continuation. While it
+waits, the event loop runs other tasks, so one thread can interleave any
+number of programs blocked on I/O. Ordinary host procedures keep cps.interp's
+protocol, f(arg, env, k): the continuation they resume with apply_cont is
+handed back to the driver (through cps.RESUME) rather than run in a nested,
+blocking interp, so the rest of the program may still await.
+
+A program that never calls a coroutine would hold the loop until it halts;
+interp_async yields to the loop every yield_every steps so that CPU-bound
+programs share it with the rest.
+"""
+
+
+def _awaits(term, env):
+    # A call to a coroutine function, which the driver must await.
+    match term:
+        case ["$call-cont", _, _] | ["let", _, _] | ["fun", _, _]:
+            return False
+        case [func, _, _] | Call(func, _, _):
+            return inspect.iscoroutinefunction(triv(func, env))
+    return False
+
+
+async def interp_async(term, env, profile=None, yield_every=1000):
+    pending = deque()
+    state = term, as_env(env)
+    while True:
+        state, _ = drive(state, pending, yield_every, profile, _awaits)
+        if state is None:
+            return
+        if not _awaits(*state):
+            # Out of fuel: let the loop run other tasks.
+            await asyncio.sleep(0)
+            continue
+        term, env = state
+        if profile is not None:
+            profile.record(term, env)
+        match term:
+            case [func, arg, k] | Call(func, arg, k):
+                # RESUME is not set while the coroutine runs, so an interp it
+                # starts keeps its own states.
+                value = await triv(func, env)(triv(arg, env))
+                token = RESUME.set(pending)
+                try:
+                    apply_cont(triv(k, env), value, env)
+                finally:
+                    RESUME.reset(token)
+        state = None
+
+
+async def run(term, env=None, profile=None, yield_every=1000):
+    """Run term with "k" bound to a halting continuation and return the
+    value passed to it."""
+    result = []
+    await interp_async(term, {**(env or {}), "k": result.append}, profile, yield_every)
+    return result[0]
+
+
+class AsyncInterpTests(unittest.IsolatedAsyncioTestCase):
+    async def test_pure(self):
+        exp = [[["lambda", ["x"], ["lambda", ["y"], ["+", "x", "y"]]], 3], 4]
+        self.assertEqual(await run(cps_cont(exp, "k")), 7)
+
+    async def test_coroutine_host(self):
+        async def double(x):
+            await asyncio.sleep(0)
+            return 2 * x
+        exp = ["+", 1, ["double", ["double", 5]]]
+        self.assertEqual(await run(cps_cont(exp, "k"), {"double": double}), 21)
+
+    async def test_sync_host_then_coroutine_host(self):
+        seen = []
+        def show(x, env, k):
+            seen.append(x)
+            apply_cont(k, x, env)
+        async def later(x):
+            await asyncio.sleep(0)
+            return x + 1
+        exp = ["later", ["show", ["later", 1]]]
+        self.assertEqual(await run(cps_cont(exp, "k"), {"show": show, "later": later}), 3)
+        self.assertEqual(seen, [2])
+
+    async def test_host_runs_nested_interp(self):
+        def ident(x, env, k):
+            apply_cont(k, x, env)
+        def evalsub(x, env, k):
+            out = []
+            cps.interp(cps_cont(["+", x, ["ident", 41]], "k"),
+                       {"k": out.append, "ident": ident})
+            apply_cont(k, out[0] if out else -1, env)
+        async def later(x):
+            await asyncio.sleep(0)
+            out = []
+            cps.interp(cps_cont(["ident", x], "k"), {"k": out.append, "ident": ident})
+            return out[0] if out else -1
+        expected = []
+        cps.interp(cps_cont(["evalsub", 1], "k"), {"evalsub": evalsub, "k": expected.append})
+        self.assertEqual(expected, [42])
+        exp = ["later", ["evalsub", 1]]
+        self.assertEqual(await run(cps_cont(exp, "k"), {"evalsub": evalsub, "later": later}),
+                         42)
+
+    async def test_interleaves_waiting_programs(self):
+        waiting = 0
+        most = 0
+        async def io(x):
+            nonlocal waiting, most
+            waiting += 1
+            most = max(most, waiting)
+            await asyncio.sleep(0.05)
+            waiting -= 1
+            return x
+        programs = [cps_cont(["+", ["io", i], ["io", 1]], "k") for i in range(2000)]
+        start = time.perf_counter()
+        results = await asyncio.gather(*[run(term, {"io": io}) for term in programs])
+        self.assertEqual(results, [i + 1 for i in range(2000)])
+        self.assertEqual(most, 2000)
+        # Two sequential waits each, overlapped across all programs.
+        self.assertLess(time.perf_counter() - start, 5)
+
+    async def test_cpu_bound_program_yields(self):
+        order = []
+        async def note(x):
+            order.append(x)
+            return x
+        # Thousands of steps with no await in them.
+        long_term = cps.closure_convert(cps_cont(["note", cps.recursive_sum_source(300)], "k"))
+        short_term = cps_cont(["note", 0], "k")
+        await asyncio.gather(run(long_term, {"note": note}, yield_every=100),
+                             run(short_term, {"note": note}))
+        self.assertEqual(order, [0, 300 * 301 // 2])
+
+    async def test_profile_matches_interp(self):
+        exp = [[["lambda", ["x"], ["lambda", ["y"], ["+", "x", "y"]]], 3], 4]
+        term = cps_cont(exp, "k")
+        expected = Profile()
+        cps.interp(term, {"k": lambda x: None}, expected)
+        profile = Profile()
+        await run(term, profile=profile)
+        self.assertEqual((profile.steps, profile.kinds), (expected.steps, expected.kinds))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,348 @@
+import random
+import unittest
+
+import cps
+from cps import PRIMS, cps_cont
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+"""
+Batched evaluation of first-order CPS programs over NumPy arrays.
+
+run_batch(term, inputs) runs term once for a whole batch of inputs, as if by
+cps.interp once per lane: inputs maps names to 1-D arrays of equal length (or
+to ints or NumPy integer scalars, shared by every lane), and the result is an array of the values the
+lanes pass to "k".
+
+The machine keeps, for each state it has yet to run, the lanes that reach it
+and an environment of arrays over just those lanes. $+, $-, $* and $/ are one
+array operation each. $if splits the lanes by its test and runs each arm on
+its own lanes only, so an arm costs nothing when no lane takes it and never
+sees the operands of lanes that do not (a division in an untaken arm cannot
+fail). A continuation bound by let is a join point: the arms deliver their
+values to it as they finish, and its body then runs once for all the lanes
+that reached it rather than once per arm.
+
+Only first-order programs are batched: the terms cps_cont produces from
+arithmetic, if and variables, without lambda or host procedures. Inputs must
+be integers. Lanes hold int64 values; if an input or the exact result of any
+operation on a lane does not fit, run_batch runs the batch again with
+run_each, which calls cps.interp once per lane, and returns its results as an
+array of Python ints (dtype object), so the values are always cps.interp's.
+Without NumPy, run_batch falls back to run_each too.
+"""
+
+
+def _is_scalar(value):
+    return isinstance(value, int) or np is not None and isinstance(value, np.integer)
+
+
+def _batch_size(inputs):
+    sizes = set()
+    for name, value in inputs.items():
+        if _is_scalar(value):
+            continue
+        if np is not None and isinstance(value, np.ndarray):
+            integers = value.dtype.kind in "iu"
+        else:
+            integers = all(_is_scalar(x) for x in value)
+        if not integers:
+            raise TypeError(f"input {name!r} must hold integers")
+        sizes.add(len(value))
+    if len(sizes) != 1:
+        raise ValueError(f"inputs must include arrays of one length, not {sorted(sizes)}")
+    return sizes.pop()
+
+
+def run_each(term, inputs):
+    """Run term with cps.interp once per lane of inputs; returns a list."""
+    results = []
+    for i in range(_batch_size(inputs)):
+        env = {name: int(value) if _is_scalar(value) else int(value[i])
+               for name, value in inputs.items()}
+        env["k"] = results.append
+        cps.interp(term, env)
+    return results
+
+
+class _Join:
+    """A let-bound continuation, collecting the values of the lanes that
+    apply it. lanes are the lanes of the let, and env its environment."""
+
+    __slots__ = ("lanes", "env", "cont", "values", "hit")
+
+    def __init__(self, lanes, env, cont):
+        self.lanes = lanes
+        self.env = env
+        self.cont = cont
+        self.values = np.zeros(len(lanes), dtype=np.int64)
+        self.hit = np.zeros(len(lanes), dtype=bool)
+
+    def deliver(self, lanes, value):
+        positions = np.searchsorted(self.lanes, lanes)
+        self.values[positions] = value
+        self.hit[positions] = True
+
+
+def _triv(exp, env):
+    match exp:
+        case str(_):
+            return env[exp]
+        case int(_):
+            return exp
+    raise NotImplementedError(f"not first-order: {exp!r}")
+
+
+_INT64_MIN = -(1 << 63)
+_INT64_MAX = (1 << 63) - 1
+
+
+def _int64(value):
+    """An input as an int or an int64 array, or OverflowError if it does not
+    fit."""
+    if _is_scalar(value):
+        value = int(value)
+        if not _INT64_MIN <= value <= _INT64_MAX:
+            raise OverflowError(f"{value} does not fit in int64")
+        return value
+    if isinstance(value, np.ndarray) and value.dtype.kind == "u" and value.size:
+        if value.max() > _INT64_MAX:
+            raise OverflowError(f"{value.max()} does not fit in int64")
+    return np.asarray(value, dtype=np.int64)
+
+
+def _arith(op, x, y):
+    """PRIMS[op] on int64 lanes, or OverflowError if the exact result of a
+    lane does not fit (NumPy would wrap it)."""
+    if not isinstance(x, np.ndarray) and not isinstance(y, np.ndarray):
+        return _int64(PRIMS[op](x, y))
+    with np.errstate(over="ignore"):
+        value = PRIMS[op](x, y)
+        match op:
+            case "$+":
+                wrapped = ((x ^ value) & (y ^ value)) < 0
+            case "$-":
+                wrapped = ((x ^ y) & (x ^ value)) < 0
+            case "$*":
+                # A wrapped product is the only kind that, divided by x,
+                # misses y, except -1 * INT64_MIN, which wraps to itself.
+                nonzero = np.not_equal(x, 0)
+                wrapped = nonzero & ((value // np.where(nonzero, x, 1) != y)
+                                     | (np.equal(x, -1) & np.equal(y, _INT64_MIN)))
+            case "$/":
+                wrapped = np.equal(x, _INT64_MIN) & np.equal(y, -1)
+    if np.any(wrapped):
+        raise OverflowError("integer overflow in a lane")
+    return value
+
+
+def _select(env, mask):
+    return {name: value[mask] if isinstance(value, np.ndarray) else value
+            for name, value in env.items()}
+
+
+def run_batch(term, inputs):
+    """Run the first-order CPS term over a batch of inputs; returns an array,
+    or a list if NumPy is not installed."""
+    n = _batch_size(inputs)
+    if np is None:
+        return run_each(term, inputs)
+    try:
+        return _run_batch(term, inputs, n)
+    except OverflowError:
+        return np.array(run_each(term, inputs), dtype=object)
+
+
+def _run_batch(term, inputs, n):
+    lanes = np.arange(n)
+    halt = _Join(lanes, None, None)
+    env = {name: _int64(value) for name, value in inputs.items()}
+    env["k"] = halt
+    # (term, env, lanes) states, or a _Join to run once every state above
+    # it has run.
+    stack = [(term, env, lanes)]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, _Join):
+            hit = item.hit
+            if not hit.any():
+                continue
+            argname, body = cps.unpack_cont(item.cont)
+            env = _select(item.env, hit)
+            env[argname] = item.values[hit]
+            stack.append((body, env, item.lanes[hit]))
+            continue
+        term, env, lanes = item
+        while term is not None:
+            match term:
+                case [op, x, y, k] if op in PRIMS:
+                    vx, vy = _triv(x, env), _triv(y, env)
+                    if op == "$/" and np.any(np.equal(vy, 0)):
+                        raise ZeroDivisionError("integer division or modulo by zero")
+                    cont, arg = k, _arith(op, vx, vy)
+                case ["$call-cont", k, value]:
+                    cont, arg = k, _triv(value, env)
+                case ["$if", test, iftrue, iffalse]:
+                    vtest = _triv(test, env)
+                    if not isinstance(vtest, np.ndarray):
+                        term = iftrue if vtest else iffalse
+                        continue
+                    mask = vtest != 0
+                    if mask.all():
+                        term = iftrue
+                        continue
+                    if not mask.any():
+                        term = iffalse
+                        continue
+                    stack.append((iffalse, _select(env, ~mask), lanes[~mask]))
+                    term, env, lanes = iftrue, _select(env, mask), lanes[mask]
+                    continue
+                case ["let", bindings, body]:
+                    env = dict(env)
+                    for name, value in bindings:
+                        if isinstance(value, list) and value[0] == "cont":
+                            join = _Join(lanes, env, value)
+                            env[name] = join
+                            # The join runs after everything in body.
+                            stack.append(join)
+                        else:
+                            env[name] = _triv(value, env)
+                    term = body
+                    continue
+                case _:
+                    raise NotImplementedError(f"not first-order: {term!r}")
+            match cont:
+                case str(_) if isinstance(env[cont], _Join):
+                    env[cont].deliver(lanes, arg)
+                    term = None
+                case ["cont", [argname], body]:
+                    env = {**env, argname: arg}
+                    term = body
+                case _:
+                    raise NotImplementedError(f"not first-order: {cont!r}")
+    if not halt.hit.all():
+        raise RuntimeError("some lanes did not halt")
+    return halt.values
+
+
+def _with_inputs(exp, rng, names):
+    """Replace some of the constants in exp with the given input names."""
+    match exp:
+        case int(_):
+            return rng.choice(names) if rng.random() < 0.4 else exp
+        case [head, *args]:
+            return [head, *[_with_inputs(arg, rng, names) for arg in args]]
+    return exp
+
+
+class RunEachTests(unittest.TestCase):
+    def test_run_each(self):
+        term = cps_cont(["if", ["-", "x", 2], ["*", "x", "y"], 100], "k")
+        self.assertEqual(run_each(term, {"x": [1, 2, 3], "y": 10}), [10, 100, 30])
+
+    def test_sizes(self):
+        with self.assertRaises(ValueError):
+            run_each(cps_cont("x", "k"), {"x": [1, 2], "y": [1]})
+        with self.assertRaises(ValueError):
+            run_each(cps_cont("x", "k"), {"x": 1})
+        with self.assertRaises(TypeError):
+            run_each(cps_cont("x", "k"), {"x": [1.7, 2.2]})
+
+
+@unittest.skipIf(np is None, "NumPy is not installed")
+class RunBatchTests(unittest.TestCase):
+    def test_arithmetic(self):
+        term = cps_cont(["+", "x", ["*", "x", 2]], "k")
+        result = run_batch(term, {"x": np.arange(5)})
+        self.assertEqual(result.tolist(), [0, 3, 6, 9, 12])
+
+    def test_masked_arms(self):
+        # The division runs only on the lanes where x is nonzero.
+        term = cps_cont(["+", 1, ["if", "x", ["/", 100, "x"], -1]], "k")
+        self.assertEqual(run_batch(term, {"x": np.array([0, 3, 0, 7])}).tolist(),
+                         [0, 34, 0, 15])
+
+    def test_division_by_zero(self):
+        with self.assertRaises(ZeroDivisionError):
+            run_batch(cps_cont(["/", 1, "x"], "k"), {"x": np.array([1, 0])})
+
+    def test_numpy_scalar(self):
+        term = cps_cont(["*", "x", "y"], "k")
+        inputs = {"x": np.arange(3), "y": np.int64(3)}
+        self.assertEqual(run_batch(term, inputs).tolist(), [0, 3, 6])
+        self.assertEqual(run_each(term, inputs), [0, 3, 6])
+
+    def test_overflow_matches_run_each(self):
+        big = np.array([2**31, 2**40, 2**62, -2**62, 2**63 - 1, -2**63, 0, -1, 7])
+        for exp in (["*", "x", "x"], ["+", "x", "x"], ["-", 0, "x"], ["-", "x", 1],
+                    ["/", "x", ["if", "x", -1, 1]], ["+", ["*", "x", 2], ["-", 0, "x"]]):
+            term = cps_cont(exp, "k")
+            with self.subTest(exp=exp):
+                self.assertEqual(run_batch(term, {"x": big}).tolist(),
+                                 run_each(term, {"x": big}))
+        self.assertEqual(run_batch(cps_cont(["*", "x", "x"], "k"), {"x": np.array([2**40])})[0],
+                         2**80)
+
+    def test_near_the_limit_stays_int64(self):
+        term = cps_cont(["-", ["+", "x", "y"], 1], "k")
+        inputs = {"x": np.array([2**62, -2**63 + 1]), "y": np.array([2**62 - 1, 0])}
+        result = run_batch(term, inputs)
+        self.assertEqual(result.dtype, np.int64)
+        self.assertEqual(result.tolist(), run_each(term, inputs))
+
+    def test_inputs_beyond_int64(self):
+        term = cps_cont(["-", "x", "y"], "k")
+        for inputs in ({"x": [2**70, 1], "y": 1}, {"x": np.arange(2), "y": 2**64},
+                       {"x": np.array([2**63], dtype=np.uint64), "y": 1}):
+            with self.subTest(inputs=inputs):
+                self.assertEqual(run_batch(term, inputs).tolist(), run_each(term, inputs))
+
+    def test_rejects_non_integers(self):
+        term = cps_cont(["+", "x", 1], "k")
+        with self.assertRaises(TypeError):
+            run_batch(term, {"x": np.array([1.7, 2.2])})
+        with self.assertRaises(TypeError):
+            run_batch(term, {"x": [1, 2.5]})
+
+    def test_sequential_joins(self):
+        # Ten ifs in sequence: one pass per join, not one per path.
+        exp = "x"
+        for i in range(10):
+            exp = ["+", ["if", ["-", "x", i], 1, 2], exp]
+        term = cps_cont(exp, "k")
+        inputs = {"x": np.arange(-5, 15)}
+        self.assertEqual(run_batch(term, inputs).tolist(), run_each(term, inputs))
+
+    def test_matches_interp(self):
+        for seed in range(40):
+            rng = random.Random(seed)
+            source = _with_inputs(cps.gen_source(rng, 60, lambda_density=0, if_density=0.3),
+                                  rng, ["x", "y"])
+            term = cps_cont(source, "k")
+            inputs = {"x": np.arange(-20, 20), "y": np.arange(40) % 3}
+            with self.subTest(seed=seed):
+                self.assertEqual(run_batch(term, inputs).tolist(), run_each(term, inputs))
+
+    def test_not_first_order(self):
+        term = cps_cont([["lambda", ["y"], "y"], "x"], "k")
+        with self.assertRaises(NotImplementedError):
+            run_batch(term, {"x": np.arange(3)})
+
+
+class FallbackTests(unittest.TestCase):
+    def test_fallback(self):
+        global np
+        saved, np = np, None
+        try:
+            term = cps_cont(["-", "x", 1], "k")
+            self.assertEqual(run_batch(term, {"x": [1, 2, 3]}), [0, 1, 2])
+        finally:
+            np = saved
+
+
+if __name__ == "__main__":
+    unittest.main()
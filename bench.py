@@ -0,0 +1,308 @@
+"""Benchmarks for the conversion and execution paths.
+
+Run as a script to print the results as JSON, for example:
+
+    python bench.py suite --sizes 100 1000 5000 --seed 0
+    python bench.py memory --size 2000 --seed 0
+    python bench.py trampoline --n 1000000 3000000
+    python bench.py frames --n 1000 10000
+"""
+
+import argparse
+import json
+import platform
+import random
+import sys
+import time
+import tracemalloc
+import unittest
+
+import cps
+import kelsey
+import trampoline
+from compiler import compile_cps
+from env import Env
+from names import name_supply
+
+
+def copy_lists(term):
+    """Rebuild the list structure of term, sharing the leaves."""
+    if isinstance(term, list):
+        return [copy_lists(item) for item in term]
+    return term
+
+
+def count_nodes(node):
+    """Count the nodes of a typed CPS term from cps.to_nodes."""
+    match node:
+        case cps.Cont(_, body) | cps.Fun(_, _, body):
+            return 1 + count_nodes(body)
+        case cps.If(cond, iftrue, iffalse):
+            return 1 + count_nodes(cond) + count_nodes(iftrue) + count_nodes(iffalse)
+        case cps.Let(bindings, body):
+            return 1 + sum(count_nodes(value) for _, value in bindings) + count_nodes(body)
+        case cps.CallCont(cont, arg):
+            return 1 + count_nodes(cont) + count_nodes(arg)
+        case cps.Prim(_, x, y, k) | cps.Call(x, y, k):
+            return 1 + count_nodes(x) + count_nodes(y) + count_nodes(k)
+    return 0
+
+
+def count_kelsey_nodes(node):
+    match node:
+        case kelsey.LCont(_, body) | kelsey.LProc(_, body) | kelsey.LJump(_, body):
+            return 1 + count_kelsey_nodes(body)
+        case kelsey.Let(_, _, body):
+            return 1 + count_kelsey_nodes(body)
+        case kelsey.Letrec(bindings, body):
+            return 1 + sum(count_kelsey_nodes(lam) for _, lam in bindings) + count_kelsey_nodes(body)
+        case kelsey.If(_, conseq, alt):
+            return 1 + count_kelsey_nodes(conseq) + count_kelsey_nodes(alt)
+        case kelsey.CallCont() | kelsey.Jmp():
+            return 1
+        case kelsey.App(_, _, k):
+            return 1 + count_kelsey_nodes(k)
+    return 0
+
+
+def allocated(build):
+    """Return (result, bytes allocated by build() and still alive)."""
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        result = build()
+        after = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    return result, after - before
+
+
+def peak_allocated(run):
+    """Return (result, peak bytes allocated while run() ran)."""
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        result = run()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return result, peak - before
+
+
+def _memory_row(nodes, list_bytes, node_bytes):
+    return {
+        "nodes": nodes,
+        "list_bytes": list_bytes,
+        "node_bytes": node_bytes,
+        "list_bytes_per_node": list_bytes / nodes,
+        "node_bytes_per_node": node_bytes / nodes,
+        "saving": 1 - node_bytes / list_bytes,
+    }
+
+
+def bench_memory(size, seed=0):
+    """Compare the memory used by the list and slotted forms of large
+    converted programs."""
+    rng = random.Random(seed)
+    with name_supply():
+        term = cps.cps(cps.gen_source(rng, size), "k")
+    _, list_bytes = allocated(lambda: copy_lists(term))
+    # Convert a private copy so that both forms own every list they
+    # reference; only what the typed form keeps alive is counted.
+    nodes, node_bytes = allocated(lambda: cps.to_nodes(copy_lists(term)))
+
+    source = kelsey.gen_source(rng, size)
+    with name_supply():
+        kterm = kelsey.F(source, "k")
+    _, klist_bytes = allocated(lambda: copy_lists(kterm))
+    knodes, knode_bytes = allocated(lambda: kelsey.to_nodes(copy_lists(kterm)))
+    return {
+        "size": size,
+        "seed": seed,
+        "cps": _memory_row(count_nodes(nodes), list_bytes, node_bytes),
+        "kelsey": _memory_row(count_kelsey_nodes(knodes), klist_bytes, knode_bytes),
+    }
+
+
+def timed(f, repeat):
+    """Return (result of the last call, best wall time over repeat calls)."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = f()
+        best = min(best, time.perf_counter() - start)
+    return result, best
+
+
+def convert(f, *args):
+    with name_supply():
+        return f(*args)
+
+
+def run_steps(term):
+    """Run term in cps.interp's machine, counting steps."""
+    result = []
+    state = term, Env({"k": result.append})
+    steps = 0
+    while state is not None:
+        state = cps.step(*state)
+        steps += 1
+    return steps, result[0]
+
+
+def _interp_row(term, repeat):
+    (steps, value), seconds = timed(lambda: run_steps(term), repeat)
+    return {"steps": steps, "seconds": seconds, "steps_per_second": steps / seconds,
+            "value": value}
+
+
+def bench_program(size, seed=0, depth=12, lambda_density=0.2, if_density=0.2, repeat=3):
+    """Time every conversion and execution path on generated programs."""
+    rng = random.Random(seed)
+    source = cps.gen_source(rng, size, depth, lambda_density, if_density)
+    naive, naive_time = timed(lambda: convert(cps.cps, source, "k"), repeat)
+    meta, meta_time = timed(lambda: convert(cps.cps_cont, source, "k"), repeat)
+    shrunk, shrink_time = timed(lambda: cps.shrink(naive), repeat)
+    program, compile_time = timed(lambda: compile_cps(meta), repeat)
+    halt = lambda x: None
+    _, compiled_time = timed(lambda: program({"k": halt}), repeat)
+
+    ksource = kelsey.gen_source(rng, size, depth, if_density)
+    kcps, f_time = timed(lambda: convert(kelsey.F, ksource, "k"), repeat)
+    blocks, g_time = timed(lambda: kelsey.Gblocks(kcps), repeat)
+
+    return {
+        "size": size,
+        "seed": seed,
+        "depth": depth,
+        "lambda_density": lambda_density,
+        "if_density": if_density,
+        "source_size": cps.term_size(source),
+        "cps": {"seconds": naive_time, "output_size": cps.term_size(naive)},
+        "cps_cont": {"seconds": meta_time, "output_size": cps.term_size(meta)},
+        "shrink": {"seconds": shrink_time, "output_size": cps.term_size(shrunk)},
+        "interp_cps": _interp_row(naive, repeat),
+        "interp_cps_cont": _interp_row(meta, repeat),
+        "interp_cps_shrink": _interp_row(shrunk, repeat),
+        "compile_cps": {"seconds": compile_time, "run_seconds": compiled_time},
+        "kelsey_source_size": cps.term_size(ksource),
+        "kelsey_F": {"seconds": f_time, "output_size": cps.term_size(kcps)},
+        "kelsey_Gblocks": {"seconds": g_time, "blocks": len(blocks),
+                           "output_size": sum(cps.term_size(stmts) for stmts in blocks.values())},
+    }
+
+
+def bench_trampoline(n, repeat=3):
+    """Time trampoline.fact_cps_thunked(n) and measure its peak memory.
+
+    Products are taken mod a 61-bit prime: the exact n! for n in the millions
+    would spend the time multiplying big integers, not bouncing."""
+    modulus = 2**61 - 1
+    identity = lambda x: x
+    run = lambda: trampoline.trampoline_counted(trampoline.fact_cps_thunked, n, identity,
+                                                trampoline.Bounce, modulus)
+    (value, bounces), seconds = timed(run, repeat)
+    _, peak = peak_allocated(run)
+    return {"n": n, "bounces": bounces, "seconds": seconds,
+            "bounces_per_second": bounces / seconds,
+            "peak_bytes": peak, "peak_bytes_per_level": peak / n, "value": value}
+
+
+def bench_frames(n, repeat=3):
+    """Compare closure-converted and defunctionalized continuations on
+    cps.recursive_sum_source(n): time and peak memory per pending level."""
+    with name_supply():
+        term = cps.cps_cont(cps.recursive_sum_source(n), "k")
+        forms = {"closure_convert": cps.closure_convert(term),
+                 "defunctionalize": cps.defunctionalize(term)}
+    result = {"n": n}
+    for name, program in forms.items():
+        out = []
+        run = lambda: cps.interp(program, {"k": out.append})
+        _, seconds = timed(run, repeat)
+        _, peak = peak_allocated(run)
+        result[name] = {"seconds": seconds, "peak_bytes": peak,
+                        "peak_bytes_per_level": peak / n, "value": out[-1]}
+    return result
+
+
+def bench_suite(sizes, seed=0, **params):
+    return {
+        "python": platform.python_version(),
+        "results": [bench_program(size, seed, **params) for size in sizes],
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+    suite = sub.add_parser("suite", help="time conversions and interpretation")
+    suite.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 5000])
+    suite.add_argument("--seed", type=int, default=0)
+    suite.add_argument("--depth", type=int, default=12)
+    suite.add_argument("--lambda-density", type=float, default=0.2)
+    suite.add_argument("--if-density", type=float, default=0.2)
+    suite.add_argument("--repeat", type=int, default=3)
+    memory = sub.add_parser("memory", help="list vs slotted IR memory")
+    memory.add_argument("--size", type=int, default=2000)
+    memory.add_argument("--seed", type=int, default=0)
+    bounce = sub.add_parser("trampoline", help="trampoline bounce rate and peak memory")
+    bounce.add_argument("--n", type=int, nargs="+", default=[1_000_000])
+    bounce.add_argument("--repeat", type=int, default=3)
+    frames = sub.add_parser("frames", help="closure vs frame record continuations")
+    frames.add_argument("--n", type=int, nargs="+", default=[1000, 10000])
+    frames.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args(argv)
+    # The converters recurse once per nested output node, and sequential
+    # code nests as deeply as it is long.
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), 50_000))
+    if args.command == "suite":
+        result = bench_suite(args.sizes, args.seed, depth=args.depth,
+                             lambda_density=args.lambda_density,
+                             if_density=args.if_density, repeat=args.repeat)
+    elif args.command == "memory":
+        result = bench_memory(args.size, args.seed)
+    elif args.command == "trampoline":
+        result = {"python": platform.python_version(),
+                  "results": [bench_trampoline(n, args.repeat) for n in args.n]}
+    elif args.command == "frames":
+        result = {"python": platform.python_version(),
+                  "results": [bench_frames(n, args.repeat) for n in args.n]}
+    print(json.dumps(result, indent=2))
+
+
+class BenchTests(unittest.TestCase):
+    def test_bench_program(self):
+        result = bench_program(60, seed=1, repeat=1)
+        self.assertEqual(result["interp_cps"]["value"], result["interp_cps_cont"]["value"])
+        self.assertGreater(result["interp_cps"]["steps"], result["interp_cps_cont"]["steps"])
+        json.dumps(result)
+
+    def test_shrink_matches_cps_cont_steps(self):
+        for seed in range(20):
+            result = bench_program(80, seed=seed, repeat=1)
+            shrunk, meta = result["interp_cps_shrink"], result["interp_cps_cont"]
+            self.assertEqual(shrunk["value"], meta["value"])
+            self.assertLessEqual(shrunk["steps"], meta["steps"])
+
+    def test_bench_memory(self):
+        result = bench_memory(200)
+        self.assertLess(result["cps"]["node_bytes"], result["cps"]["list_bytes"])
+
+    def test_bench_frames(self):
+        result = bench_frames(100, repeat=1)
+        self.assertEqual(result["closure_convert"]["value"], 5050)
+        self.assertEqual(result["defunctionalize"]["value"], 5050)
+        json.dumps(result)
+
+    def test_bench_trampoline(self):
+        result = bench_trampoline(10_000, repeat=1)
+        self.assertEqual(result["bounces"], 20_000)
+        self.assertGreater(result["peak_bytes"], 0)
+        json.dumps(result)
+
+
+if __name__ == "__main__":
+    main()
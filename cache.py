@@ -0,0 +1,298 @@
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+import threading
+import unittest
+from collections import OrderedDict
+
+import cps
+import kelsey
+from names import name_supply
+
+
+"""
+A compile cache for the conversions, keyed by a structural hash of the source.
+
+canonical renames the bound variables of a source expression to _0, _1, ...
+in the order of their binders (lambda parameters and let names), leaving free
+variables alone, so two expressions that differ only in the names of bound
+variables have one canonical form. If a free variable starts with the prefix,
+the prefix is doubled until none does, so renaming never captures one. The
+key of a conversion is the SHA-256 of its stage name and the canonical form.
+
+CompileCache.convert(stage, exp) converts the canonical form of exp with one
+of STAGES, each run under its own name_supply, so a conversion's output
+depends on its key alone: a hit returns exactly what a miss would have built,
+with bound variables named as in the canonical form.
+
+The cache keeps pickled results. The in-memory tier is an LRU bounded by the
+total size of the pickles, evicting the least recently used entries once
+max_bytes is exceeded; every hit unpickles a fresh copy, so callers may
+mutate what they get. With directory set, every result is also written there
+as <key>.pickle, and a miss in memory looks there before converting, so a
+restarted process starts warm. Results are read back with pickle, so the
+directory must be one only trusted processes write to.
+"""
+
+
+# Part of every key: bump it when the format of the results changes.
+VERSION = 1
+
+
+def _free(exp, bound, out):
+    match exp:
+        case str(_):
+            if exp not in bound:
+                out.add(exp)
+        case ["lambda", [*args], body]:
+            _free(body, bound | set(args), out)
+        case ["let", [[x, value]], body]:
+            _free(value, bound, out)
+            _free(body, bound | {x}, out)
+        case [*items]:
+            for item in items:
+                _free(item, bound, out)
+    return out
+
+
+def canonical(exp):
+    """Return exp with its bound variables renamed in binding order."""
+    free = _free(exp, frozenset(), set())
+    prefix = "_"
+    while any(name.startswith(prefix) for name in free):
+        prefix += "_"
+    count = 0
+
+    def bind(name, env):
+        nonlocal count
+        new = f"{prefix}{count}"
+        count += 1
+        return {**env, name: new}, new
+
+    def rename(exp, env):
+        match exp:
+            case str(_):
+                return env.get(exp, exp)
+            case ["lambda", [*args], body]:
+                params = []
+                for arg in args:
+                    env, new = bind(arg, env)
+                    params.append(new)
+                return ["lambda", params, rename(body, env)]
+            case ["let", [[x, value]], body]:
+                value = rename(value, env)
+                env, new = bind(x, env)
+                return ["let", [[new, value]], rename(body, env)]
+            case [*items]:
+                return [rename(item, env) for item in items]
+        return exp
+
+    return rename(exp, {})
+
+
+def structural_hash(stage, exp):
+    """The cache key of converting exp (already canonical) with stage."""
+    text = json.dumps([VERSION, stage, exp], separators=(",", ":"))
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def _alphatised(exp):
+    # alphatise needs an entry for every variable, so map the free ones to
+    # themselves.
+    return kelsey.alphatise_(exp, {name: name for name in _free(exp, frozenset(), set())})
+
+
+STAGES = {
+    "cps_cont": lambda exp: cps.cps_cont(exp, "k"),
+    "kelsey_F": lambda exp: kelsey.F(_alphatised(exp), "k"),
+    "kelsey_Gblocks": lambda exp: kelsey.Gblocks(kelsey.F(_alphatised(exp), "k")),
+}
+
+
+class CompileCache:
+    def __init__(self, max_bytes=64 << 20, directory=None):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+        # key -> pickled result, least recently used first.
+        self._memory = OrderedDict()
+        self.bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def convert(self, stage, exp):
+        """Return STAGES[stage] applied to the canonical form of exp."""
+        convert = STAGES[stage]
+        exp = canonical(exp)
+        key = structural_hash(stage, exp)
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return pickle.loads(data)
+        data = self._load(key)
+        if data is not None:
+            with self._lock:
+                self.disk_hits += 1
+                self._remember(key, data)
+            return pickle.loads(data)
+        with name_supply():
+            result = convert(exp)
+        data = pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+        self._store(key, data)
+        with self._lock:
+            self.misses += 1
+            self._remember(key, data)
+        return result
+
+    def _remember(self, key, data):
+        if key in self._memory:
+            return
+        if len(data) > self.max_bytes:
+            return
+        self._memory[key] = data
+        self.bytes += len(data)
+        while self.bytes > self.max_bytes:
+            _, old = self._memory.popitem(last=False)
+            self.bytes -= len(old)
+            self.evictions += 1
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.pickle")
+
+    def _load(self, key):
+        if self.directory is None:
+            return None
+        try:
+            with open(self._path(key), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def _store(self, key, data):
+        if self.directory is None:
+            return
+        # Write to a temporary file and rename it into place, so a reader
+        # never sees a partial entry.
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp, self._path(key))
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def clear(self):
+        """Empty the in-memory tier (the directory is left alone)."""
+        with self._lock:
+            self._memory.clear()
+            self.bytes = 0
+
+    def stats(self):
+        return {"entries": len(self._memory), "bytes": self.bytes, "hits": self.hits,
+                "disk_hits": self.disk_hits, "misses": self.misses,
+                "evictions": self.evictions}
+
+
+class CanonicalTests(unittest.TestCase):
+    def test_alpha_equivalent(self):
+        a = ["lambda", ["x"], [["lambda", ["y"], ["+", "x", "y"]], "z"]]
+        b = ["lambda", ["p"], [["lambda", ["q"], ["+", "p", "q"]], "z"]]
+        self.assertEqual(canonical(a), canonical(b))
+        self.assertEqual(canonical(a),
+                         ["lambda", ["_0"], [["lambda", ["_1"], ["+", "_0", "_1"]], "z"]])
+
+    def test_free_variables_matter(self):
+        self.assertNotEqual(canonical(["+", "x", 1]), canonical(["+", "y", 1]))
+        self.assertNotEqual(canonical(["lambda", ["x"], "x"]), canonical(["lambda", ["x"], "y"]))
+
+    def test_shadowing(self):
+        exp = ["let", [["x", 1]], ["let", [["x", ["+", "x", 1]]], "x"]]
+        self.assertEqual(canonical(exp),
+                         ["let", [["_0", 1]], ["let", [["_1", ["+", "_0", 1]]], "_1"]])
+
+    def test_prefix_avoids_free_names(self):
+        exp = ["lambda", ["x"], ["+", "x", "_0"]]
+        self.assertEqual(canonical(exp), ["lambda", ["__0"], ["+", "__0", "_0"]])
+
+
+class CompileCacheTests(unittest.TestCase):
+    def test_hit(self):
+        cache = CompileCache()
+        a = ["+", 1, [["lambda", ["x"], ["*", "x", "x"]], "n"]]
+        b = ["+", 1, [["lambda", ["y"], ["*", "y", "y"]], "n"]]
+        first = cache.convert("cps_cont", a)
+        second = cache.convert("cps_cont", b)
+        self.assertEqual(first, second)
+        self.assertIsNot(first, second)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        out = []
+        cps.interp(second, {"n": 7, "k": out.append})
+        self.assertEqual(out, [50])
+
+    def test_stages_are_separate(self):
+        cache = CompileCache()
+        exp = ["let", [["a", ["if", "p", 1, 2]]], ["f", "a"]]
+        with name_supply():
+            expected = kelsey.Gblocks(kelsey.F(_alphatised(canonical(exp)), "k"))
+        self.assertEqual(cache.convert("kelsey_Gblocks", exp), expected)
+        cache.convert("kelsey_F", exp)
+        self.assertEqual(cache.misses, 2)
+
+    def test_lru_eviction(self):
+        sources = [["+", "x", i] for i in range(10)]
+        size = len(pickle.dumps(cps.cps_cont(["+", "x", 0], "k"), pickle.HIGHEST_PROTOCOL))
+        cache = CompileCache(max_bytes=3 * size)
+        for source in sources[:3]:
+            cache.convert("cps_cont", source)
+        cache.convert("cps_cont", sources[0])
+        cache.convert("cps_cont", sources[3])
+        self.assertEqual(cache.evictions, 1)
+        self.assertLessEqual(cache.bytes, cache.max_bytes)
+        # sources[1] was least recently used.
+        cache.convert("cps_cont", sources[0])
+        self.assertEqual(cache.hits, 2)
+        cache.convert("cps_cont", sources[1])
+        self.assertEqual(cache.misses, 5)
+
+    def test_disk_tier(self):
+        with tempfile.TemporaryDirectory() as directory:
+            exp = [["lambda", ["x"], ["-", "x", 1]], 5]
+            first = CompileCache(directory=directory).convert("cps_cont", exp)
+            self.assertEqual(len(os.listdir(directory)), 1)
+            # A new cache, as after a restart.
+            cache = CompileCache(directory=directory)
+            self.assertEqual(cache.convert("cps_cont", exp), first)
+            self.assertEqual((cache.disk_hits, cache.misses), (1, 0))
+            cache.convert("cps_cont", exp)
+            self.assertEqual(cache.hits, 1)
+
+    def test_warm_does_not_convert(self):
+        converted = []
+        stage = STAGES["kelsey_Gblocks"]
+        def counted(exp):
+            converted.append(exp)
+            return stage(exp)
+        source = ["let", [["a", ["if", "p", ["f", 1], 2]]], ["+", "a", "p"]]
+        cache = CompileCache()
+        STAGES["kelsey_Gblocks"] = counted
+        try:
+            cold = cache.convert("kelsey_Gblocks", source)
+            warm = cache.convert("kelsey_Gblocks", source)
+        finally:
+            STAGES["kelsey_Gblocks"] = stage
+        self.assertEqual(warm, cold)
+        self.assertEqual(len(converted), 1)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+
+if __name__ == "__main__":
+    unittest.main()
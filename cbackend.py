@@ -0,0 +1,241 @@
+import ctypes
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+import kelsey
+from names import name_supply
+
+
+"""
+Native code for kelsey procedures.
+
+compile_procs takes named source procedures, for example
+
+    {"fib": ["lambda", ["n"], ...]}
+
+and runs each through kelsey.V, kelsey.Gproc and kelsey.out_of_ssa. It emits
+one C translation unit for all of them, compiles it into a shared library with
+the system C compiler and loads it with ctypes.
+
+Every value is a C long long. A procedure's continuation parameter is dropped:
+$call-cont becomes return, a letrec-bound jump becomes a label, and the phis at
+its head become copies before each goto. Expressions may use the integer
+operators in BINOPS, and calls may go to any procedure in the same unit. "/"
+is left out because C division truncates where Python's floors, and dividing
+by zero would crash the process.
+"""
+
+
+BINOPS = {"+": "+", "-": "-", "*": "*", "<": "<", "<=": "<=", ">": ">", ">=": ">=",
+          "=": "==", "!=": "!="}
+
+
+class _Names:
+    """Map kelsey names to distinct C identifiers with a common prefix."""
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.names = {}
+        self.used = set()
+
+    def __getitem__(self, name):
+        ident = self.names.get(name)
+        if ident is None:
+            base = ident = self.prefix + re.sub(r"\W", "_", name)
+            n = 0
+            while ident in self.used:
+                n += 1
+                ident = f"{base}_{n}"
+            self.used.add(ident)
+            self.names[name] = ident
+        return ident
+
+    def __contains__(self, name):
+        return name in self.names
+
+
+class _ProcEmitter:
+    def __init__(self, procs, arities, names):
+        self.procs = procs
+        self.arities = arities
+        self.names = names
+        self.lines = []
+
+    def expr(self, exp):
+        match exp:
+            case bool(_):
+                raise TypeError(f"not an integer: {exp!r}")
+            case int(_):
+                if not -2**63 < exp < 2**63:
+                    raise OverflowError(f"does not fit in a long long: {exp}")
+                return f"{exp}LL"
+            case str(_):
+                if exp not in self.names:
+                    raise NameError(f"unbound variable: {exp}")
+                return self.names[exp]
+            case [op, x, y] if op in BINOPS:
+                return f"({self.expr(x)} {BINOPS[op]} {self.expr(y)})"
+            case [str(fn), *args] if fn in self.arities:
+                if len(args) != self.arities[fn]:
+                    raise TypeError(f"{fn} takes {self.arities[fn]} arguments, got {len(args)}")
+                return f"{self.procs[fn]}({', '.join(self.expr(arg) for arg in args)})"
+        raise NotImplementedError(exp)
+
+    def stmts(self, stmts, indent):
+        pad = "    " * indent
+        for stmt in stmts:
+            match stmt:
+                case [x, "<-", value]:
+                    self.lines.append(f"{pad}{self.names[x]} = {self.expr(value)};")
+                case ["return", value]:
+                    self.lines.append(f"{pad}return {self.expr(value)};")
+                case ["goto", label]:
+                    self.lines.append(f"{pad}goto {self.label(label)};")
+                case ["if", test, conseq, alt]:
+                    self.lines.append(f"{pad}if ({self.expr(test)}) {{")
+                    self.stmts(conseq, indent + 1)
+                    self.lines.append(f"{pad}}} else {{")
+                    self.stmts(alt, indent + 1)
+                    self.lines.append(f"{pad}}}")
+                case _:
+                    raise NotImplementedError(stmt)
+
+    @staticmethod
+    def label(label):
+        return "L_" + re.sub(r"\W", "_", label)
+
+
+def emit_proc(name, proc, procs, arities):
+    """Emit the C definition of one Gproc result."""
+    _, params, entry, *blocks = proc
+    # The last parameter is the continuation; returning replaces it.
+    params = params[:-1]
+    blocks = kelsey.out_of_ssa({"entry": entry, **{label: stmts for label, stmts in blocks}})
+    names = _Names("v_")
+    for param in params:
+        names[param]
+    local = []
+    for stmts in blocks.values():
+        for x in kelsey.assigned(stmts):
+            if x not in names:
+                local.append(names[x])
+    emitter = _ProcEmitter(procs, arities, names)
+    signature = ", ".join(f"long long {names[param]}" for param in params) or "void"
+    emitter.lines.append(f"long long {procs[name]}({signature}) {{")
+    for ident in local:
+        emitter.lines.append(f"    long long {ident} = 0;")
+    emitter.stmts(blocks.pop("entry"), 1)
+    for label, stmts in blocks.items():
+        emitter.lines.append(f"{emitter.label(label)}:")
+        emitter.stmts(stmts, 1)
+    emitter.lines.append("}")
+    return "\n".join(emitter.lines)
+
+
+def emit_c(procs):
+    """Return (C source, {name: arity}) for named source procedures."""
+    idents = _Names("p_")
+    arities = {}
+    gprocs = {}
+    with name_supply():
+        for name, lam in procs.items():
+            match lam:
+                case ["lambda", [*args], _]:
+                    arities[name] = len(args)
+                case _:
+                    raise TypeError(f"not a procedure: {lam}")
+            idents[name]
+            gprocs[name] = kelsey.Gproc(kelsey.V(lam, name=name))
+    procs = idents.names
+    prototypes = [f"long long {procs[name]}({', '.join(['long long'] * arity) or 'void'});"
+                  for name, arity in arities.items()]
+    definitions = [emit_proc(name, proc, procs, arities) for name, proc in gprocs.items()]
+    return "\n\n".join(["\n".join(prototypes), *definitions]) + "\n", arities
+
+
+class NativeModule:
+    """Procedures compiled to native code; index by source name to get a
+    ctypes function taking and returning Python ints."""
+
+    def __init__(self, source, lib, arities):
+        self.source = source
+        self.lib = lib
+        self.functions = {}
+        idents = _Names("p_")
+        for name, arity in arities.items():
+            fn = getattr(lib, idents[name])
+            fn.argtypes = [ctypes.c_longlong] * arity
+            fn.restype = ctypes.c_longlong
+            self.functions[name] = fn
+
+    def __getitem__(self, name):
+        return self.functions[name]
+
+
+def compile_c(source, cc=None, flags=("-O2",)):
+    """Compile a C translation unit to a shared library and load it."""
+    cc = cc or os.environ.get("CC") or shutil.which("cc")
+    if cc is None:
+        raise RuntimeError("no C compiler found; set CC")
+    with tempfile.TemporaryDirectory() as tmp:
+        c_path = os.path.join(tmp, "procs.c")
+        so_path = os.path.join(tmp, "procs.so")
+        with open(c_path, "w") as f:
+            f.write(source)
+        subprocess.run([cc, *flags, "-shared", "-fPIC", "-o", so_path, c_path],
+                       check=True, capture_output=True, text=True)
+        # The loaded library stays mapped after the file is removed.
+        return ctypes.CDLL(so_path)
+
+
+def compile_procs(procs, cc=None, flags=("-O2",)):
+    source, arities = emit_c(procs)
+    return NativeModule(source, compile_c(source, cc, flags), arities)
+
+
+@unittest.skipUnless(shutil.which("cc") or os.environ.get("CC"), "no C compiler")
+class CBackendTests(unittest.TestCase):
+    def test_fib(self):
+        native = compile_procs({"fib": kelsey.FIB})
+        self.assertEqual([native["fib"](n) for n in range(10)], [0, 1, 1, 2, 3, 5, 8, 13, 21, 34])
+        self.assertEqual(native["fib"](30), 832040)
+
+    def test_phi(self):
+        native = compile_procs({"abs_plus": kelsey.ABS_PLUS})
+        self.assertIn("goto L_", native.source)
+        self.assertEqual([native["abs_plus"](x, 10) for x in [-3, 0, 4]], [13, 10, 14])
+
+    def test_mutual_recursion(self):
+        even = ["lambda", ["n"],
+                ["if", ["=", "n", 0], 1, ["let", [["m", ["-", "n", 1]]], ["odd", "m"]]]]
+        odd = ["lambda", ["n"],
+               ["if", ["=", "n", 0], 0, ["let", [["m", ["-", "n", 1]]], ["even", "m"]]]]
+        native = compile_procs({"even": even, "odd": odd})
+        self.assertEqual([native["even"](n) for n in range(5)], [1, 0, 1, 0, 1])
+
+    def test_self_tail_call_is_a_loop(self):
+        native = compile_procs({"total": kelsey.TOTAL}, flags=("-O0",))
+        self.assertNotIn("p_total(v_", native.source)
+        self.assertIn("goto L__loop", native.source)
+        # Deep enough to overflow the C stack if each iteration were a call.
+        self.assertEqual(native["total"](10_000_000, 0), 10_000_000 * 10_000_001 // 2)
+
+    def test_long_long(self):
+        native = compile_procs({"mul": ["lambda", ["x", "y"], ["*", "x", "y"]]})
+        self.assertEqual(native["mul"](3_000_000_000, 3), 9_000_000_000)
+
+    def test_unknown_procedure(self):
+        with self.assertRaises(NotImplementedError):
+            emit_c({"f": ["lambda", ["x"], ["g", "x"]]})
+
+    def test_unbound_variable(self):
+        with self.assertRaises(NameError):
+            emit_c({"f": ["lambda", ["x"], ["+", "x", "y"]]})
+
+
+if __name__ == "__main__":
+    unittest.main()
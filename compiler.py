@@ -0,0 +1,260 @@
+import time
+import unittest
+from types import FunctionType
+
+import cps
+
+
+"""
+Closure compilation of CPS terms.
+
+compile_cps walks a term once and turns every node into a pre-specialized
+Python closure, so running the program no longer re-matches list shapes,
+compares tag strings or dispatches through triv. Every variable name in the
+term is given a slot in a flat frame ahead of time.
+
+The compiled program has the same (dynamic) scoping as cps.interp: the
+interpreter threads a single environment through the program, extending it at
+every continuation and function application, and a single mutable frame per
+run behaves identically. Function values stay as their ["fun", ...] terms, as
+they do in interp; a function or continuation term that did not come from the
+compiled program (for example one supplied in the initial environment) is run
+by cps.interp.
+"""
+
+
+class Cont:
+    """A continuation value created by evaluating a compiled ["cont", ...].
+
+    Host code can call it like a host continuation; the compiled machine binds
+    the argument slot and jumps straight to the body instead."""
+
+    __slots__ = ("frame", "slot", "body")
+
+    def __init__(self, frame, slot, body):
+        self.frame = frame
+        self.slot = slot
+        self.body = body
+
+    def __call__(self, arg):
+        self.frame[self.slot] = arg
+        run(self.body, self.frame)
+
+
+def run(code, frame):
+    while code is not None:
+        code = code(frame)
+
+
+class Program:
+    def __init__(self, term):
+        self.term = term
+        self.slots = {}
+        self.funs = {}
+        self.refs = set()
+        self.binders = set()
+        self.code = self.compile(term)
+        # Scoping is dynamic, so only names bound nowhere in the term must
+        # come from the initial environment.
+        self.free = self.refs - self.binders
+
+    def __call__(self, env):
+        frame = self.new_frame(env)
+        run(self.code, frame)
+
+    def new_frame(self, env):
+        frame = [None] * len(self.slots)
+        for name in self.free:
+            frame[self.slots[name]] = env[name]
+        for name, value in env.items():
+            slot = self.slots.get(name)
+            if slot is not None:
+                frame[slot] = value
+        return frame
+
+    def env(self, frame):
+        return {name: frame[slot] for name, slot in self.slots.items()}
+
+    def bind(self, name):
+        self.binders.add(name)
+        return self.slot(name)
+
+    def slot(self, name):
+        slot = self.slots.get(name)
+        if slot is None:
+            slot = self.slots[name] = len(self.slots)
+        return slot
+
+    def triv(self, exp):
+        """Compile a trivial expression to a frame -> value getter."""
+        match exp:
+            case str(_):
+                self.refs.add(exp)
+                slot = self.slot(exp)
+                return lambda frame: frame[slot]
+            case int(_) | FunctionType():
+                return lambda frame: exp
+            case ["fun", [argname, kname], body]:
+                code = self.compile(body)
+                self.funs[id(exp)] = (exp, self.bind(argname), self.bind(kname), code)
+                return lambda frame: exp
+            case ["cont", [argname], body]:
+                code = self.compile(body)
+                slot = self.bind(argname)
+                return lambda frame: Cont(frame, slot, code)
+        raise NotImplementedError(exp)
+
+    def cont(self, k):
+        """Compile a continuation position to a (frame, value) -> code applier."""
+        match k:
+            case ["cont", [argname], body]:
+                code = self.compile(body)
+                slot = self.bind(argname)
+                def apply_literal(frame, value):
+                    frame[slot] = value
+                    return code
+                return apply_literal
+        getk = self.triv(k)
+        return lambda frame, value: self.apply_cont(frame, getk(frame), value)
+
+    def apply_cont(self, frame, vk, value):
+        if type(vk) is Cont:
+            vk.frame[vk.slot] = value
+            if vk.frame is frame:
+                return vk.body
+            run(vk.body, vk.frame)
+            return None
+        cps.apply_cont(vk, value, self.env(frame))
+        return None
+
+    def call(self, frame, vfunc, varg, vk):
+        fun = self.funs.get(id(vfunc))
+        if fun is not None and fun[0] is vfunc:
+            _, argslot, kslot, code = fun
+            frame[argslot] = varg
+            frame[kslot] = vk
+            return code
+        env = self.env(frame)
+        if isinstance(vfunc, FunctionType):
+            vfunc(varg, env, vk)
+            return None
+        argname, kname, body = cps.unpack_func(vfunc)
+        cps.interp(body, {**env, argname: varg, kname: vk})
+        return None
+
+    def compile(self, exp):
+        """Compile a CPS term to a frame -> next code closure."""
+        match exp:
+            case ["$call-cont", cont, arg]:
+                getarg = self.triv(arg)
+                applyk = self.cont(cont)
+                return lambda frame: applyk(frame, getarg(frame))
+            case ["$+", x, y, k]:
+                getx = self.triv(x)
+                gety = self.triv(y)
+                applyk = self.cont(k)
+                return lambda frame: applyk(frame, getx(frame) + gety(frame))
+            case ["$-", x, y, k]:
+                getx = self.triv(x)
+                gety = self.triv(y)
+                applyk = self.cont(k)
+                return lambda frame: applyk(frame, getx(frame) - gety(frame))
+            case [op, x, y, k] if op in cps.PRIMS:
+                prim = cps.PRIMS[op]
+                getx = self.triv(x)
+                gety = self.triv(y)
+                applyk = self.cont(k)
+                return lambda frame: applyk(frame, prim(getx(frame), gety(frame)))
+            case ["fun", [arg, k], body]:
+                raise NotImplementedError(exp)
+            case ["$if", cond, iftrue, iffalse]:
+                getcond = self.triv(cond)
+                codetrue = self.compile(iftrue)
+                codefalse = self.compile(iffalse)
+                return lambda frame: codetrue if getcond(frame) else codefalse
+            case ["let", bindings, body]:
+                names = [name for name, _ in bindings]
+                getters = [self.triv(value) for _, value in bindings]
+                slots = [self.bind(name) for name in names]
+                code = self.compile(body)
+                def let(frame):
+                    values = [get(frame) for get in getters]
+                    for slot, value in zip(slots, values):
+                        frame[slot] = value
+                    return code
+                return let
+            case [func, arg, k]:
+                getfunc = self.triv(func)
+                getarg = self.triv(arg)
+                getk = self.triv(k)
+                return lambda frame: self.call(frame, getfunc(frame), getarg(frame), getk(frame))
+        raise NotImplementedError(exp)
+
+
+def compile_cps(term):
+    return Program(term)
+
+
+def compare_with_interp(term, env, number=1000):
+    """Time cps.interp against the compiled program on the same term.
+
+    The compile step is timed once and reported separately from the runs."""
+    start = time.perf_counter()
+    program = compile_cps(term)
+    compile_time = time.perf_counter() - start
+    start = time.perf_counter()
+    for _ in range(number):
+        cps.interp(term, env)
+    interp_time = time.perf_counter() - start
+    start = time.perf_counter()
+    for _ in range(number):
+        program(env)
+    compiled_time = time.perf_counter() - start
+    return {
+        "compile": compile_time,
+        "interp": interp_time,
+        "compiled": compiled_time,
+        "speedup": interp_time / compiled_time,
+    }
+
+
+def _run_compiled(term, env):
+    compile_cps(term)(env)
+
+
+class CompiledCPSInterpTests(cps.CPSInterpTests):
+    interp = staticmethod(_run_compiled)
+
+
+class CompiledEndToEndTests(cps.EndToEndTests):
+    interp = staticmethod(_run_compiled)
+
+
+class CompileTests(unittest.TestCase):
+    def test_free_variable_missing_from_env(self):
+        with self.assertRaises(KeyError):
+            compile_cps(["$call-cont", "k", 1])({})
+
+    def test_program_is_reusable(self):
+        program = compile_cps(["$+", "x", 1, "k"])
+        results = []
+        for x in range(3):
+            program({"x": x, "k": results.append})
+        self.assertEqual(results, [1, 2, 3])
+
+    def test_cont_value_passed_to_host(self):
+        results = []
+        exp = ["f", 1, ["cont", ["v0"], ["$+", "v0", 1, "k"]]]
+        compile_cps(exp)({"f": lambda x, env, k: cps.apply_cont(k, x * 10, env),
+                          "k": results.append})
+        self.assertEqual(results, [11])
+
+    def test_compare_with_interp(self):
+        exp = cps.cps_cont([["lambda", ["x"], ["+", "x", 1]], 2], "k")
+        result = compare_with_interp(exp, {"k": lambda x: None}, number=10)
+        self.assertEqual(set(result), {"compile", "interp", "compiled", "speedup"})
+
+
+if __name__ == "__main__":
+    __import__("sys").modules["unittest.util"]._MAX_LENGTH = 999999999
+    unittest.main()
@@ -1,12 +1,14 @@
+import itertools
+import operator
+import random
 import unittest
+from collections import Counter, deque
+from contextvars import ContextVar
+from dataclasses import dataclass
 from types import FunctionType
 
-
-GENSYM_COUNTER = iter(range(1000))
-
-
-def gensym(stem="v"):
-    return f"{stem}{next(GENSYM_COUNTER)}"
+from env import Env, as_env
+from names import gensym, name_supply
 
 
 def cps(exp, k):
@@ -50,8 +52,7 @@ def cps(exp, k):
 
 class UseGensym(unittest.TestCase):
     def setUp(self):
-        global GENSYM_COUNTER
-        GENSYM_COUNTER = iter(range(1000))
+        self.enterContext(name_supply())
 
 
 class CPSTest(UseGensym):
@@ -165,10 +166,14 @@ def cps_pyfunc(exp, k):
                         cps_pyfunc(e, lambda ve:
                              [vf, ve, reify(k)]))
         case ["if", cond, iftrue, iffalse]:
-            return cps_pyfunc(cond, lambda vcond:
-                                [f"$if", vcond,
-                                 cps_pyfunc(iftrue, k),
-                                 cps_pyfunc(iffalse, k)])
+            # Applying k in both arms would copy the rest of the computation
+            # into each of them, doubling it for every enclosing if. Reify it
+            # once and bind it as a join point that both arms jump to.
+            return dedup(reify(k), lambda vk:
+                         cps_pyfunc(cond, lambda vcond:
+                             [f"$if", vcond,
+                              cps_cont(iftrue, vk),
+                              cps_cont(iffalse, vk)]))
     raise NotImplementedError((exp, k))
 
 
@@ -180,6 +185,9 @@ def dedup(cont, k):
 
 
 def cps_cont(exp, c):
+    # Every metacontinuation and every continuation term is used at most once
+    # in the output (if binds both with dedup first), so the output is linear
+    # in the size of exp.
     match exp:
         case int(_) | str(_) | ["lambda", _, _]:
             return ["$call-cont", c, cps_trivial(exp)]
@@ -200,6 +208,18 @@ def cps_cont(exp, c):
     raise NotImplementedError((exp, c))
 
 
+def term_size(exp):
+    """Count the lists and leaves in a term."""
+    size = 0
+    stack = [exp]
+    while stack:
+        exp = stack.pop()
+        size += 1
+        if isinstance(exp, list):
+            stack.extend(exp)
+    return size
+
+
 def cps_trivial(exp):
     match exp:
         case ["lambda", [var], expr]:
@@ -262,13 +282,38 @@ class MetaCPSTest(UseGensym):
     def test_if_nested_cond(self):
         self.assertEqual(
             cps_cont(["if", ["if", 1, 2, 3], ["+", 4, 4], ["+", 5, 5]], "k"),
-            # TODO(max): Figure out what to do about the code duplication of
-            # the iftrue and iffalse
-            ["$if", 1,
-             ["$if", 2, ["$+", 4, 4, "k"], ["$+", 5, 5, "k"]],
-             ["$if", 3, ["$+", 4, 4, "k"], ["$+", 5, 5, "k"]]]
+            # (+ 4 4) and (+ 5 5) are not duplicated
+            ["let", [["k1", ["cont", ["v0"],
+                             ["$if", "v0",
+                              ["$+", 4, 4, "k"],
+                              ["$+", 5, 5, "k"]]]]],
+             ["$if", 1,
+              ["$call-cont", "k1", 2],
+              ["$call-cont", "k1", 3]]]
         )
 
+    def test_if_in_operand(self):
+        self.assertEqual(
+            cps_cont(["+", ["if", "x", 1, 2], 3], "k"),
+            ["let", [["k1", ["cont", ["v0"], ["$+", "v0", 3, "k"]]]],
+             ["$if", "x",
+              ["$call-cont", "k1", 1],
+              ["$call-cont", "k1", 2]]]
+        )
+
+    def test_nested_if_output_is_linear(self):
+        def nested(depth):
+            exp = "x"
+            for i in range(depth):
+                exp = ["if", exp, ["+", i, i], ["-", i, i]]
+            return exp
+        sizes = {}
+        for depth in (25, 50, 100):
+            exp = nested(depth)
+            sizes[depth] = term_size(cps_cont(exp, "k"))
+            self.assertLess(sizes[depth], 10 * term_size(exp))
+        self.assertEqual(sizes[100] - sizes[50], 2 * (sizes[50] - sizes[25]))
+
     def test_call(self):
         self.assertEqual(
             cps_cont(["f", 1], "k"),
@@ -276,90 +321,545 @@ class MetaCPSTest(UseGensym):
         )
 
 
+def gen_source(rng, size, depth=12, lambda_density=0.2, if_density=0.2):
+    """Generate a closed, integer-valued program for cps and cps_cont.
+
+    size bounds the number of source nodes and depth their nesting. Each
+    interior node is an application of a lambda with probability
+    lambda_density, an if with probability if_density, and arithmetic
+    otherwise."""
+    names = iter(range(1_000_000))
+
+    def gen(size, depth, scope):
+        if size <= 1 or depth <= 0:
+            if scope and rng.random() < 0.5:
+                return rng.choice(scope)
+            return rng.randrange(10)
+        choice = rng.random()
+        if choice < lambda_density:
+            x = f"x{next(names)}"
+            half = max(1, size // 2)
+            return [["lambda", [x], gen(size - half, depth - 1, scope + [x])],
+                    gen(half, depth - 1, scope)]
+        if choice < lambda_density + if_density:
+            third = max(1, size // 3)
+            return ["if", gen(third, depth - 1, scope),
+                    gen(third, depth - 1, scope),
+                    gen(size - 2 * third, depth - 1, scope)]
+        left = rng.randrange(1, size)
+        return [rng.choice(["+", "-"]),
+                gen(left, depth - 1, scope),
+                gen(size - left, depth - 1, scope)]
+
+    return gen(size, depth, [])
+
+
+class GenSourceTests(unittest.TestCase):
+    def test_seeded(self):
+        self.assertEqual(gen_source(random.Random(3), 50), gen_source(random.Random(3), 50))
+
+    def test_densities(self):
+        def count(exp, head):
+            if not isinstance(exp, list):
+                return 0
+            return (exp[0] == head) + sum(count(e, head) for e in exp)
+        no_ifs = gen_source(random.Random(0), 200, if_density=0)
+        self.assertEqual(count(no_ifs, "if"), 0)
+        no_lambdas = gen_source(random.Random(0), 200, lambda_density=0)
+        self.assertEqual(count(no_lambdas, "lambda"), 0)
+
+
+"""
+Typed IR: an optional representation of CPS terms as slotted objects, one
+class per form. Each node costs one small object instead of a list header
+plus its element array (and, for cont and fun, the nested argument list).
+Variables stay strings and literals stay ints. interp, free_in and map_func
+accept either representation; to_nodes and to_lists convert between them.
+"""
+
+
+@dataclass(slots=True)
+class Cont:
+    arg: str
+    body: object
+    ann: dict | None = None
+
+
+@dataclass(slots=True)
+class Fun:
+    arg: str
+    k: str
+    body: object
+    ann: dict | None = None
+
+
+@dataclass(slots=True)
+class Prim:
+    op: str
+    x: object
+    y: object
+    k: object
+
+
+@dataclass(slots=True)
+class If:
+    cond: object
+    iftrue: object
+    iffalse: object
+
+
+@dataclass(slots=True)
+class Let:
+    bindings: list
+    body: object
+
+
+@dataclass(slots=True)
+class CallCont:
+    cont: object
+    arg: object
+
+
+@dataclass(slots=True)
+class Call:
+    func: object
+    arg: object
+    k: object
+
+
+def to_nodes(exp):
+    match exp:
+        case int(_) | str(_) | FunctionType():
+            return exp
+        case ["cont", [arg], body]:
+            return Cont(arg, to_nodes(body))
+        case ["cont", [arg], ann, body]:
+            return Cont(arg, to_nodes(body), ann)
+        case ["fun", [arg, k], body]:
+            return Fun(arg, k, to_nodes(body))
+        case ["fun", [arg, k], ann, body]:
+            return Fun(arg, k, to_nodes(body), ann)
+        case ["$if", cond, iftrue, iffalse]:
+            return If(to_nodes(cond), to_nodes(iftrue), to_nodes(iffalse))
+        case ["let", bindings, body]:
+            return Let([(name, to_nodes(value)) for name, value in bindings], to_nodes(body))
+        case ["$call-cont", cont, arg]:
+            return CallCont(to_nodes(cont), to_nodes(arg))
+        case [op, x, y, k] if op in ["$+", "$-", "$*", "$/"]:
+            return Prim(op, to_nodes(x), to_nodes(y), to_nodes(k))
+        case [func, arg, k]:
+            return Call(to_nodes(func), to_nodes(arg), to_nodes(k))
+    raise NotImplementedError(exp)
+
+
+def to_lists(exp):
+    match exp:
+        case int(_) | str(_) | FunctionType():
+            return exp
+        case Cont(arg, body, None):
+            return ["cont", [arg], to_lists(body)]
+        case Cont(arg, body, ann):
+            return ["cont", [arg], ann, to_lists(body)]
+        case Fun(arg, k, body, None):
+            return ["fun", [arg, k], to_lists(body)]
+        case Fun(arg, k, body, ann):
+            return ["fun", [arg, k], ann, to_lists(body)]
+        case If(cond, iftrue, iffalse):
+            return ["$if", to_lists(cond), to_lists(iftrue), to_lists(iffalse)]
+        case Let(bindings, body):
+            return ["let", [[name, to_lists(value)] for name, value in bindings], to_lists(body)]
+        case CallCont(cont, arg):
+            return ["$call-cont", to_lists(cont), to_lists(arg)]
+        case Prim(op, x, y, k):
+            return [op, to_lists(x), to_lists(y), to_lists(k)]
+        case Call(func, arg, k):
+            return [to_lists(func), to_lists(arg), to_lists(k)]
+    raise NotImplementedError(exp)
+
+
+class TypedIRTests(UseGensym):
+    def test_round_trip(self):
+        for exp in [["+", 1, ["+", 2, 3]],
+                    [[["lambda", ["x"], ["lambda", ["y"], ["+", "x", "y"]]], 3], 4],
+                    ["let", ["x", 1], ["if", "x", ["-", "x", 2], 3]]]:
+            converted = cps(exp, "k")
+            self.assertEqual(to_lists(to_nodes(converted)), converted)
+
+    def test_to_nodes(self):
+        self.assertEqual(to_nodes(["$call-cont", ["cont", ["v0"], ["$+", "v0", 1, "k"]], 2]),
+                         CallCont(Cont("v0", Prim("$+", "v0", 1, "k")), 2))
+
+    def test_map_func(self):
+        exp = cps([["lambda", ["x"], "x"], 1], "k")
+        def count(node):
+            counts.append(node)
+            return node
+        counts = []
+        expected = to_nodes(map_func(exp, count))
+        list_count = len(counts)
+        counts = []
+        self.assertEqual(map_func(to_nodes(exp), count), expected)
+        self.assertEqual(len(counts), list_count)
+
+    def test_annotated(self):
+        exp = ["fun", ["x", "k"], {"freevars": ["y"], "clo": "c0"}, ["$call-cont", "k", "y"]]
+        self.assertEqual(to_nodes(exp), Fun("x", "k", CallCont("k", "y"), {"freevars": ["y"], "clo": "c0"}))
+        self.assertEqual(to_lists(to_nodes(exp)), exp)
+
+
+class Closure:
+    """A flat closure record built by ["$closure", code, captures].
+
+    code is a closure-converted ["fun", ...] or ["cont", ...] whose annotation
+    names the closure ("clo"); values holds the captured variables in the
+    order of its "freevars", and ["$clo-ref", clo, i] reads values[i]."""
+
+    __slots__ = ("code", "values")
+
+    def __init__(self, code, values):
+        self.code = code
+        self.values = values
+
+    def __repr__(self):
+        return f"Closure({self.code!r}, {self.values!r})"
+
+
+# $/ is integer division, rounding down like Python's //.
+PRIMS = {"$+": operator.add, "$-": operator.sub, "$*": operator.mul, "$/": operator.floordiv}
+
+
 def triv(cps, env):
     match cps:
-        case int(_):
-            return cps
         case str(_):
             return env[cps]
+        case int(_):
+            return cps
         case ["fun", [argname, kname], body]:
             return cps
         case ["cont", [argname], body]:
             return cps
-        case FunctionType():
+        case ["$clo-ref", clo, index]:
+            return env[clo].values[index]
+        case ["$closure", code, captures]:
+            return Closure(code, tuple([triv(capture, env) for capture in captures]))
+        case ["$frame-ref", frame, index]:
+            return env[frame][index]
+        case ["$frame", tag, captures]:
+            return tag([triv(capture, env) for capture in captures])
+        case ["fun", [_, _], _, _] | ["cont", [_], _, _]:
+            return cps
+        case FunctionType() | Fun() | Cont():
             return cps
     raise NotImplementedError(cps)
 
 
 def unpack_func(func):
     match func:
-        case ["fun", [argname, kname], body]:
+        case ["fun", [argname, kname], body] | Fun(argname, kname, body):
             return argname, kname, body
     raise NotImplementedError(func)
 
 
 def unpack_cont(cont):
     match cont:
-        case ["cont", [argname], body]:
+        case ["cont", [argname], body] | Cont(argname, body):
             return argname, body
     raise NotImplementedError(cont)
 
 
 def apply_cont(cont, arg, env):
+    state = _apply_cont(cont, arg, as_env(env))
+    if state is not None:
+        resume = RESUME.get()
+        if resume is not None:
+            resume.append(state)
+        else:
+            interp(*state)
+
+
+# drive sets this to its pending deque while it runs, and a driver built on
+# it (such as async_interp's) while it resumes a host procedure's
+# continuation: apply_cont then appends the state it would run there instead
+# of running it in a nested interp. interp clears it while it runs, so an
+# interp a host procedure starts keeps its own states.
+RESUME = ContextVar("RESUME", default=None)
+
+
+def _apply_cont(cont, arg, env):
     match cont:
-        case ["cont", [argname], body]:
-            interp(body, {**env, argname: arg})
-            return
-        case FunctionType():
+        case ["cont", [argname], body] | Cont(argname, body):
+            return body, env.set(argname, arg)
+        case Frame(code=["cont", [argname], ann, body]):
+            return body, Env({argname: arg, ann["clo"]: cont})
+        # Closure-converted conts run in a fresh environment holding only
+        # their argument and closure record.
+        case Closure(code=["cont", [argname], ann, body]):
+            return body, Env({argname: arg, ann["clo"]: cont})
+        case ["cont", [argname], _, body]:
+            return body, Env({argname: arg})
+        case _ if callable(cont):
             cont(arg)
-            return
+            return None
     raise NotImplementedError(cont)
 
 
-def interp(cps, env):
+def step(cps, env):
+    """Run one transition of the CPS machine.
+
+    env is an Env. Returns the next (term, env) state, or None once control
+    has passed to a host continuation or host procedure."""
     match cps:
-        case ["$+", x, y, k]:
-            varg = triv(x, env) + triv(y, env)
-            apply_cont(triv(k, env), varg, env)
-            return
-        case ["$-", x, y, k]:
-            varg = triv(x, env) - triv(y, env)
-            apply_cont(triv(k, env), varg, env)
-            return
-        case ["fun", [arg, k], body]:
+        case ["$call-cont", cont, arg]:
+            return _apply_cont(triv(cont, env), triv(arg, env), env)
+        case [op, x, y, k] if op in PRIMS:
+            varg = PRIMS[op](triv(x, env), triv(y, env))
+            return _apply_cont(triv(k, env), varg, env)
+        case ["fun", [arg, k], body] | Fun(arg, k, body):
             raise NotImplementedError(cps)
         case ["$if", cond, iftrue, iffalse]:
-            vcond = triv(cond, env)
-            if vcond:
-                interp(iftrue, env)
-            else:
-                interp(iffalse, env)
-            return
+            if triv(cond, env):
+                return iftrue, env
+            return iffalse, env
         case ["let", bindings, body]:
-            newenv = env.copy()
+            newenv = env
             for name, value in bindings:
-                newenv[name] = triv(value, env)
-            interp(body, newenv)
-            return
-        case ["$call-cont", cont, arg]:
-            vcont = triv(cont, env)
-            varg = triv(arg, env)
-            apply_cont(vcont, varg, env)
-            return
+                newenv = newenv.set(name, triv(value, env))
+            return body, newenv
         case [func, arg, k]:
             vfunc = triv(func, env)
             varg = triv(arg, env)
             vk = triv(k, env)
             if isinstance(vfunc, FunctionType):
                 vfunc(varg, env, vk)
-                return
+                return None
+            match vfunc:
+                case Closure(code=["fun", [argname, kname], ann, body]):
+                    return body, Env({argname: varg, kname: vk, ann["clo"]: vfunc})
+                case ["fun", [argname, kname], _, body]:
+                    return body, Env({argname: varg, kname: vk})
+            argname, kname, body = unpack_func(vfunc)
+            return body, env.set(argname, varg).set(kname, vk)
+        case CallCont(cont, arg):
+            return _apply_cont(triv(cont, env), triv(arg, env), env)
+        case Prim(op, x, y, k):
+            varg = PRIMS[op](triv(x, env), triv(y, env))
+            return _apply_cont(triv(k, env), varg, env)
+        case If(cond, iftrue, iffalse):
+            if triv(cond, env):
+                return iftrue, env
+            return iffalse, env
+        case Let(bindings, body):
+            newenv = env
+            for name, value in bindings:
+                newenv = newenv.set(name, triv(value, env))
+            return body, newenv
+        case Call(func, arg, k):
+            vfunc = triv(func, env)
+            varg = triv(arg, env)
+            vk = triv(k, env)
+            if isinstance(vfunc, FunctionType):
+                vfunc(varg, env, vk)
+                return None
             argname, kname, body = unpack_func(vfunc)
-            interp(body, {**env, argname: varg, kname: vk})
-            return
+            return body, env.set(argname, varg).set(kname, vk)
     raise NotImplementedError(cps)
 
 
+def interp(cps, env, profile=None):
+    # Every CPS transition is a tail call, so drive the machine with a loop
+    # instead of recursing; the Python stack stays flat however long the
+    # program runs.
+    env = as_env(env)
+    if profile is None:
+        profile = _PROFILE.get()
+    if profile is not None:
+        return _interp_profiled(cps, env, profile)
+    # This machine runs what its own host procedures resume, even when a
+    # host procedure of another driver started it.
+    token = RESUME.set(None)
+    try:
+        while True:
+            state = step(cps, env)
+            if state is None:
+                return
+            cps, env = state
+    finally:
+        RESUME.reset(token)
+
+
+# The profile of the run in progress, so that runs a host procedure starts
+# with apply_cont are counted too.
+_PROFILE = ContextVar("_PROFILE", default=None)
+
+
+def _interp_profiled(cps, env, profile):
+    token = _PROFILE.set(profile)
+    resume = RESUME.set(None)
+    try:
+        while True:
+            profile.record(cps, env)
+            state = step(cps, env)
+            if state is None:
+                return
+            cps, env = state
+    finally:
+        RESUME.reset(resume)
+        _PROFILE.reset(token)
+
+
+def drive(state, pending, fuel=None, profile=None, stop=None):
+    """Run the machine from state, for drivers other than interp.
+
+    Host procedures run with RESUME set to pending, a deque, so the states
+    they resume are queued there instead of run in a nested interp; each is
+    run once the machine stops at the one before it. drive returns after fuel
+    steps (never, if fuel is None), or without running a state for which
+    stop(term, env) is true. Returns (state, steps): the state to continue
+    from, or None once it and pending are both done, and the steps run."""
+    steps = 0
+    token = RESUME.set(pending)
+    try:
+        while fuel is None or steps < fuel:
+            if state is None:
+                if not pending:
+                    break
+                state = pending.popleft()
+            if stop is not None and stop(*state):
+                break
+            if profile is not None:
+                profile.record(*state)
+            steps += 1
+            state = step(*state)
+    finally:
+        RESUME.reset(token)
+    return state, steps
+
+
+def _code(value):
+    return value.code if type(value) is Closure or isinstance(value, Frame) else value
+
+
+def _is_cont(value):
+    value = _code(value)
+    return isinstance(value, Cont) or (isinstance(value, list) and value[0] == "cont")
+
+
+def _is_fun(value):
+    value = _code(value)
+    return isinstance(value, Fun) or (isinstance(value, list) and value[0] == "fun")
+
+
+class Profile:
+    """Execution counts collected by interp(..., profile=Profile()).
+
+    Counts steps per node kind ("$+", "$-", "$if", "let", "$call-cont",
+    "call" for user functions and "host-call" for host procedures), how often
+    each fun and cont term is entered and each call site executed, and how
+    many environments and continuation values the program allocates: one
+    environment per continuation application, function call and let, and one
+    continuation value whenever a cont term is passed to a function or bound
+    rather than applied on the spot. For closure-converted programs it also
+    counts the closure records built and the values captured in them, and for
+    defunctionalized ones the frame records. Terms
+    are identified by object identity. Runs that a host procedure starts with
+    apply_cont are counted too."""
+
+    def __init__(self):
+        self.steps = 0
+        self.kinds = Counter()
+        self.funs = Counter()
+        self.conts = Counter()
+        self.call_sites = Counter()
+        self.env_allocs = 0
+        self.cont_allocs = 0
+        self.closure_allocs = 0
+        self.captured = 0
+        self.frame_allocs = 0
+        self.frame_captured = 0
+        self.terms = {}
+
+    def _key(self, term):
+        self.terms[id(term)] = term
+        return id(term)
+
+    def _enter_cont(self, vcont):
+        if _is_cont(vcont):
+            self.conts[self._key(_code(vcont))] += 1
+            self.env_allocs += 1
+
+    def _capture(self, *values):
+        for value in values:
+            if isinstance(value, list) and value[0] == "$closure":
+                value = value[1]
+            elif isinstance(value, list) and value[0] == "$frame":
+                value = value[1].code
+            if _is_cont(value):
+                self.cont_allocs += 1
+
+    def _closures(self, *terms):
+        for term in terms:
+            if isinstance(term, list) and term[0] == "$closure":
+                self.closure_allocs += 1
+                self.captured += len(term[2])
+            elif isinstance(term, list) and term[0] == "$frame":
+                self.frame_allocs += 1
+                self.frame_captured += len(term[2])
+
+    def record(self, cps, env):
+        self.steps += 1
+        match cps:
+            case ["$call-cont", cont, arg] | CallCont(cont, arg):
+                self.kinds["$call-cont"] += 1
+                self._closures(cont, arg)
+                self._enter_cont(triv(cont, env))
+            case [op, _, _, k] | Prim(op, _, _, k) if op in ["$+", "$-", "$*", "$/"]:
+                self.kinds[op] += 1
+                self._closures(k)
+                self._enter_cont(triv(k, env))
+            case ["$if", _, _, _] | If():
+                self.kinds["$if"] += 1
+            case ["let", bindings, _] | Let(bindings, _):
+                self.kinds["let"] += 1
+                self.env_allocs += 1
+                self._capture(*(value for _, value in bindings))
+                self._closures(*(value for _, value in bindings))
+            case [func, arg, k] | Call(func, arg, k):
+                vfunc = triv(func, env)
+                self.call_sites[self._key(cps)] += 1
+                self._capture(arg, k)
+                self._closures(func, arg, k)
+                if _is_fun(vfunc):
+                    self.kinds["call"] += 1
+                    self.funs[self._key(_code(vfunc))] += 1
+                    self.env_allocs += 1
+                else:
+                    self.kinds["host-call"] += 1
+
+    def hottest(self, counter, n=5):
+        return [(count, self.terms[key]) for key, count in counter.most_common(n)]
+
+    def report(self, n=5):
+        def show(term):
+            text = repr(term if isinstance(term, list) else to_lists(term))
+            return text if len(text) <= 70 else text[:67] + "..."
+        lines = [f"steps: {self.steps}",
+                 f"environments allocated: {self.env_allocs}",
+                 f"continuations allocated: {self.cont_allocs}",
+                 f"closures allocated: {self.closure_allocs} ({self.captured} values captured)",
+                 f"frames allocated: {self.frame_allocs} ({self.frame_captured} values captured)",
+                 "steps by kind:"]
+        lines += [f"  {kind:>10} {count}" for kind, count in self.kinds.most_common()]
+        for title, counter in [("hottest funs:", self.funs),
+                               ("hottest conts:", self.conts),
+                               ("hottest call sites:", self.call_sites)]:
+            lines.append(title)
+            lines += [f"  {count:>10} {show(term)}" for count, term in self.hottest(counter, n)]
+        return "\n".join(lines)
+
+
 class CPSInterpTests(unittest.TestCase):
+    interp = staticmethod(interp)
+
     @staticmethod
     def _return():
         result = None
@@ -372,59 +872,168 @@ class CPSInterpTests(unittest.TestCase):
 
     def test_ret(self):
         _set, _get = self._return()
-        interp(["$call-cont", "k", 1], {"k": _set})
+        self.interp(["$call-cont", "k", 1], {"k": _set})
         self.assertEqual(_get(), 1)
 
     def test_add(self):
         _set, _get = self._return()
-        interp(["$+", 1, 2, "k"], {"k": _set})
+        self.interp(["$+", 1, 2, "k"], {"k": _set})
         self.assertEqual(_get(), 3)
 
     def test_add_nested(self):
         _set, _get = self._return()
-        interp(["$+", 1, 2, ["cont", ["v0"], ["$+", "v0", 3, "k"]]], {"k": _set})
+        self.interp(["$+", 1, 2, ["cont", ["v0"], ["$+", "v0", 3, "k"]]], {"k": _set})
         self.assertEqual(_get(), 6)
 
     def test_sub(self):
         _set, _get = self._return()
-        interp(["$-", 1, 2, "k"], {"k": _set})
+        self.interp(["$-", 1, 2, "k"], {"k": _set})
         self.assertEqual(_get(), -1)
 
     def test_sub_nested(self):
         _set, _get = self._return()
-        interp(["$-", 1, 2, ["cont", ["v0"], ["$-", "v0", 3, "k"]]], {"k": _set})
+        self.interp(["$-", 1, 2, ["cont", ["v0"], ["$-", "v0", 3, "k"]]], {"k": _set})
         self.assertEqual(_get(), -4)
 
+    def test_mul_div(self):
+        _set, _get = self._return()
+        self.interp(["$*", 6, 7, ["cont", ["v0"], ["$/", "v0", 4, "k"]]], {"k": _set})
+        self.assertEqual(_get(), 10)
+
     def test_lambda_id(self):
         _set, _get = self._return()
-        interp(["$call-cont", "k", ["fun", ["x", "k0"], ["$call-cont", "k0", "x"]]], {"k": _set})
+        self.interp(["$call-cont", "k", ["fun", ["x", "k0"], ["$call-cont", "k0", "x"]]], {"k": _set})
         self.assertEqual(_get(), ["fun", ["x", "k0"], ["$call-cont", "k0", "x"]])
 
     def test_if_true(self):
         _set, _get = self._return()
-        interp(["$if", 1, ["$call-cont", "k1", 2], ["$call-cont", "k1", 3]], {"k1": _set})
+        self.interp(["$if", 1, ["$call-cont", "k1", 2], ["$call-cont", "k1", 3]], {"k1": _set})
         self.assertEqual(_get(), 2)
 
     def test_if_false(self):
         _set, _get = self._return()
-        interp(["$if", 0, ["$call-cont", "k1", 2], ["$call-cont", "k1", 3]], {"k1": _set})
+        self.interp(["$if", 0, ["$call-cont", "k1", 2], ["$call-cont", "k1", 3]], {"k1": _set})
         self.assertEqual(_get(), 3)
 
     def test_call(self):
         _set, _get = self._return()
         exp = ["$call-cont", ["cont", ["v0"], ["$call-cont", ["cont", ["v1"], ["v0", "v1", "k"]], 1]], "f"]
-        interp(exp, {"f": lambda x, env, k: apply_cont(k, x+1, env), "k": _set})
+        self.interp(exp, {"f": lambda x, env, k: apply_cont(k, x+1, env), "k": _set})
         self.assertEqual(_get(), 2)
 
     def test_call_reentrant(self):
         _set, _get = self._return()
         exp = ["$call-cont", ["cont", ["v0"], ["$call-cont", ["cont", ["v1"], ["v0", "v1", "k"]], 1]], "f"]
-        interp(exp, {"f": lambda x, env, k: apply_cont(k, x+1, env),
+        self.interp(exp, {"f": lambda x, env, k: apply_cont(k, x+1, env),
                      "k": ["cont", ["x"], ["$call-cont", _set, "x"]]})
         self.assertEqual(_get(), 2)
 
+    def test_long_running_loop_uses_constant_stack(self):
+        _set, _get = self._return()
+        loop = ["fun", ["n", "k"],
+                ["$if", "n",
+                 ["$-", "n", 1, ["cont", ["m"], ["loop", "m", "k"]]],
+                 ["$call-cont", "k", "n"]]]
+        self.interp(["loop", 100000, "k"], {"loop": loop, "k": _set})
+        self.assertEqual(_get(), 0)
+
+    def test_step(self):
+        _set, _get = self._return()
+        term, env = step(["$+", 1, 2, ["cont", ["v0"], ["$call-cont", "k", "v0"]]], Env({"k": _set}))
+        self.assertEqual(term, ["$call-cont", "k", "v0"])
+        self.assertEqual(env["v0"], 3)
+        self.assertIsNone(step(term, env))
+        self.assertEqual(_get(), 3)
+
+
+def _interp_nodes(exp, env):
+    interp(to_nodes(exp), {name: to_nodes(value) if isinstance(value, list) else value
+                           for name, value in env.items()})
+
+
+class NodesInterpTests(CPSInterpTests):
+    interp = staticmethod(_interp_nodes)
+
+    def test_lambda_id(self):
+        _set, _get = self._return()
+        self.interp(["$call-cont", "k", ["fun", ["x", "k0"], ["$call-cont", "k0", "x"]]], {"k": _set})
+        self.assertEqual(_get(), Fun("x", "k0", CallCont("k0", "x")))
+
+
+class DriveTests(unittest.TestCase):
+    def test_fuel_and_pending(self):
+        seen = []
+        def show(x, env, k):
+            seen.append(x)
+            apply_cont(k, x + 1, env)
+        out = []
+        term = ["show", 1, ["cont", ["v"], ["show", "v", "k"]]]
+        state, pending = (term, as_env({"show": show, "k": out.append})), deque()
+        state, steps = drive(state, pending, fuel=1)
+        # The state show resumed is queued, not run.
+        self.assertEqual((state, len(pending), seen, steps), (None, 1, [1], 1))
+        state, steps = drive(state, pending)
+        self.assertEqual((state, len(pending), seen, out, steps), (None, 0, [1, 2], [3], 1))
+
+    def test_stop(self):
+        term = ["let", [["x", 1]], ["$call-cont", "k", "x"]]
+        stop = lambda term, env: term[0] == "$call-cont"
+        state, steps = drive((term, as_env({"k": print})), deque(), stop=stop)
+        self.assertEqual((state[0], steps), (["$call-cont", "k", "x"], 1))
+
+    def test_nested_interp_keeps_its_states(self):
+        def ident(x, env, k):
+            apply_cont(k, x, env)
+        def evalsub(x, env, k):
+            out = []
+            interp(cps_cont(["+", x, ["ident", 41]], "k"), {"k": out.append, "ident": ident})
+            apply_cont(k, out[0], env)
+        out = []
+        pending = deque()
+        drive((cps_cont(["evalsub", 1], "k"), as_env({"evalsub": evalsub, "k": out.append})),
+              pending)
+        self.assertEqual(out, [42])
+
+
+class ProfileTests(unittest.TestCase):
+    LOOP = ["fun", ["n", "k"],
+            ["$if", "n",
+             ["$-", "n", 1, ["cont", ["m"], ["loop", "m", "k"]]],
+             ["$call-cont", "k", "n"]]]
+
+    def test_counts(self):
+        profile = Profile()
+        results = []
+        interp(["loop", 10, "k"], {"loop": self.LOOP, "k": lambda x: results.append(x)}, profile)
+        self.assertEqual(results, [0])
+        self.assertEqual(profile.steps, 11 + 11 + 10 + 1)
+        self.assertEqual(profile.kinds, {"call": 11, "$if": 11, "$-": 10, "$call-cont": 1})
+        self.assertEqual(profile.hottest(profile.funs), [(11, self.LOOP)])
+        [(count, cont)] = profile.hottest(profile.conts)
+        self.assertEqual((count, cont), (10, self.LOOP[2][2][3]))
+        self.assertEqual(profile.env_allocs, 11 + 10)
+        self.assertEqual(profile.cont_allocs, 0)
+        self.assertIn("hottest funs:", profile.report())
+
+    def test_cont_allocations(self):
+        profile = Profile()
+        exp = cps_cont([["lambda", ["x"], ["+", "x", 1]], ["f", 2]], "k")
+        interp(exp, {"f": lambda x, env, k: apply_cont(k, x * 2, env),
+                     "k": lambda x: None}, profile)
+        self.assertEqual(profile.kinds["host-call"], 1)
+        self.assertEqual(profile.kinds["call"], 1)
+        self.assertEqual(profile.cont_allocs, 1)
+
+    def test_nodes(self):
+        profile = Profile()
+        interp(to_nodes(["$+", 1, 2, ["cont", ["v0"], ["$call-cont", "k", "v0"]]]),
+               {"k": lambda x: None}, profile)
+        self.assertEqual(profile.kinds, {"$+": 1, "$call-cont": 1})
+
 
 class EndToEndTests(unittest.TestCase):
+    interp = staticmethod(interp)
+
     @staticmethod
     def _return():
         result = None
@@ -439,12 +1048,15 @@ class EndToEndTests(unittest.TestCase):
         cps0 = cps(exp, "k")
         cps1 = cps_cont(exp, "k")
         _set0, _get0 = self._return()
-        interp(cps0, {"k": _set0})
+        self.interp(cps0, {"k": _set0})
         _set1, _get1 = self._return()
-        interp(cps1, {"k": _set1})
+        self.interp(cps1, {"k": _set1})
+        _set2, _get2 = self._return()
+        self.interp(shrink(cps0), {"k": _set2})
         res0 = _get0()
         res1 = _get1()
         self.assertEqual(res0, res1)
+        self.assertEqual(res0, _get2())
         return res0
 
     def test_int(self):
@@ -469,6 +1081,14 @@ class EndToEndTests(unittest.TestCase):
         exp = [[["lambda", ["x"], ["lambda", ["y"], ["+", "x", "y"]]], 3], 4]
         self.assertEqual(self._interp(exp), 7)
 
+    def test_if_nested_cond(self):
+        exp = ["if", ["if", 0, 2, 0], ["+", 4, 4], ["+", 5, 5]]
+        self.assertEqual(self._interp(exp), 10)
+
+    def test_if_in_operand(self):
+        exp = ["+", ["if", 1, ["+", 1, 1], 7], ["if", 0, 5, 3]]
+        self.assertEqual(self._interp(exp), 5)
+
 
 def free_in(exp):
     match exp:
@@ -482,12 +1102,30 @@ def free_in(exp):
             return free_in(body) - set(args)
         case ["$if", cond, iftrue, iffalse]:
             return free_in(cond) | free_in(iftrue) | free_in(iffalse)
+        case ["let", bindings, body]:
+            bound = {name for name, _ in bindings}
+            return set().union(*(free_in(value) for _, value in bindings)) | (free_in(body) - bound)
         case ["$call-cont", cont, arg]:
             return free_in(cont) | free_in(arg)
         case [op, x, y, k] if op in ["$+", "$-", "$*", "$/"]:
             return free_in(x) | free_in(y) | free_in(k)
         case [func, arg, k]:
             return free_in(func) | free_in(arg) | free_in(k)
+        case Cont(arg, body):
+            return free_in(body) - {arg}
+        case Fun(arg, k, body):
+            return free_in(body) - {arg, k}
+        case If(cond, iftrue, iffalse):
+            return free_in(cond) | free_in(iftrue) | free_in(iffalse)
+        case Let(bindings, body):
+            bound = {name for name, _ in bindings}
+            return set().union(*(free_in(value) for _, value in bindings)) | (free_in(body) - bound)
+        case CallCont(cont, arg):
+            return free_in(cont) | free_in(arg)
+        case Prim(_, x, y, k):
+            return free_in(x) | free_in(y) | free_in(k)
+        case Call(func, arg, k):
+            return free_in(func) | free_in(arg) | free_in(k)
         case _:
             raise NotImplementedError(exp)
 
@@ -520,6 +1158,16 @@ class FreeInTests(unittest.TestCase):
     def test_free_in_call(self):
         self.assertEqual(free_in(["f", "x", "k"]), {"f", "x", "k"})
 
+    def test_free_in_let(self):
+        self.assertEqual(free_in(["let", [["j", "x"], ["n", 1]], ["j", "n", "k"]]), {"x", "k"})
+
+    def test_free_in_nodes(self):
+        self.assertEqual(free_in(Cont("x", Call("f", "x", "k"))), {"f", "k"})
+        self.assertEqual(free_in(Fun("x", "k", Prim("$+", "x", "y", "k"))), {"y"})
+        self.assertEqual(free_in(If("x", CallCont("k", 1), CallCont("j", "z"))), {"x", "k", "j", "z"})
+        self.assertEqual(free_in(Let([("j", Cont("v", CallCont("k", "v")))], CallCont("j", "x"))),
+                         {"k", "x"})
+
 
 def map_func(exp, f):
     match exp:
@@ -542,44 +1190,182 @@ def map_func(exp, f):
             return [op, map_func(x, f), map_func(y, f), map_func(k, f)]
         case [func, arg, k]:
             return [map_func(func, f), map_func(arg, f), map_func(k, f)]
+
+        case Cont(arg, body, ann):
+            return f(Cont(arg, map_func(body, f), {} if ann is None else ann))
+        case Fun(arg, k, body, ann):
+            return f(Fun(arg, k, map_func(body, f), {} if ann is None else ann))
+        case If(cond, iftrue, iffalse):
+            return If(map_func(cond, f), map_func(iftrue, f), map_func(iffalse, f))
+        case Let(bindings, body):
+            return Let([(name, map_func(value, f)) for name, value in bindings], map_func(body, f))
+        case CallCont(cont, arg):
+            return CallCont(map_func(cont, f), map_func(arg, f))
+        case Prim(op, x, y, k):
+            return Prim(op, map_func(x, f), map_func(y, f), map_func(k, f))
+        case Call(func, arg, k):
+            return Call(map_func(func, f), map_func(arg, f), map_func(k, f))
         case _:
             raise NotImplementedError(exp)
 
 
-def _annotate_freevars(exp):
-    fv = {"freevars": sorted(free_in(exp))}
+def _subterms(exp):
     match exp:
-        case ["cont", [arg], ann, body]:
-            return ["cont", [arg], {**ann, **fv}, body]
-        case ["fun", [arg, k], ann, body]:
-            # TODO(max): Don't allocate closure if no freevars
-            return ["fun", [arg, k], {**ann, **fv, "clo": gensym("c")}, body]
+        case ["cont", _, body] | ["cont", _, _, body]:
+            return (body,)
+        case ["fun", _, body] | ["fun", _, _, body]:
+            return (body,)
+        case ["$if", cond, iftrue, iffalse]:
+            return (cond, iftrue, iffalse)
+        case ["let", bindings, body]:
+            return (*(value for _, value in bindings), body)
+        case ["$call-cont", cont, arg]:
+            return (cont, arg)
+        case [op, x, y, k] if op in ["$+", "$-", "$*", "$/"]:
+            return (x, y, k)
+        case [func, arg, k]:
+            return (func, arg, k)
         case _:
             raise NotImplementedError(exp)
 
 
+def _clo_ann(ann, fv):
+    # A fun or cont without free variables is a combinator and needs no
+    # closure.
+    ann = {**ann, "freevars": sorted(fv)}
+    if fv:
+        ann["clo"] = gensym("c")
+    else:
+        ann.pop("clo", None)
+    return ann
+
+
+def _annotate_node(exp, children, fv):
+    match exp:
+        case ["cont", [arg], _]:
+            return ["cont", [arg], _clo_ann({}, fv), *children]
+        case ["cont", [arg], ann, _]:
+            return ["cont", [arg], _clo_ann(ann, fv), *children]
+        case ["fun", [arg, k], _]:
+            return ["fun", [arg, k], _clo_ann({}, fv), *children]
+        case ["fun", [arg, k], ann, _]:
+            return ["fun", [arg, k], _clo_ann(ann, fv), *children]
+        case ["let", bindings, _]:
+            return ["let", [[name, value] for (name, _), value in zip(bindings, children)],
+                    children[-1]]
+        case ["$if", _, _, _] | ["$call-cont", _, _]:
+            return [exp[0], *children]
+        case [op, _, _, _] if op in ["$+", "$-", "$*", "$/"]:
+            return [op, *children]
+        case _:
+            return children
+
+
 def annotate_freevars(exp):
-    return map_func(exp, _annotate_freevars)
+    """Annotate every cont and fun with its sorted free variables, and give
+    every one that has free variables a fresh closure name ("clo").
+
+    This is a single bottom-up pass over an explicit stack: the free variables
+    of each node are computed once from its children's (memoized by node
+    identity) rather than by calling free_in at every binder, so the cost is
+    linear in the size of the term times the number of free variables, and
+    deeply nested terms do not hit the recursion limit."""
+    free = {}
+    rebuilt = {}
+    stack = [(exp, False)]
+    while stack:
+        node, ready = stack.pop()
+        if isinstance(node, (int, str)) or id(node) in rebuilt:
+            continue
+        children = _subterms(node)
+        if not ready:
+            stack.append((node, True))
+            stack.extend((child, False) for child in reversed(children))
+            continue
+        fvs = [{child} if isinstance(child, str) else free.get(id(child), set())
+               for child in children]
+        match node:
+            case ["cont", args, *_] | ["fun", args, *_]:
+                fv = set().union(*fvs) - set(args)
+            case ["let", bindings, _]:
+                fv = set().union(*fvs[:-1]) | (fvs[-1] - {name for name, _ in bindings})
+            case _:
+                fv = set().union(*fvs)
+        free[id(node)] = fv
+        new_children = [rebuilt.get(id(child), child) for child in children]
+        rebuilt[id(node)] = _annotate_node(node, new_children, fv)
+    return rebuilt.get(id(exp), exp)
 
 
 class AnnotateFreeVarsTests(UseGensym):
     def test_cont(self):
         self.assertEqual(annotate_freevars(["cont", ["x"], "y"]),
-                         ["cont", ["x"], {"freevars": ["y"]}, "y"])
+                         ["cont", ["x"], {"freevars": ["y"], "clo": "c0"}, "y"])
 
     def test_fun(self):
         self.assertEqual(annotate_freevars(["fun", ["x", "k"], "y"]),
                          ["fun", ["x", "k"], {"freevars": ["y"], "clo": "c0"}, "y"])
 
+    def test_matches_free_in(self):
+        exp = cps(["lambda", ["x"], [["lambda", ["y"], ["+", "x", "y"]], ["if", "x", "z", 1]]], "k")
+        def check(exp):
+            match exp:
+                case ["cont" | "fun", _, ann, body]:
+                    self.assertEqual(ann["freevars"], sorted(free_in(exp)))
+                    check(body)
+                case list(_):
+                    for child in _subterms(exp):
+                        check(child)
+        check(annotate_freevars(exp))
+
+    def test_gensym_order_matches_map_func(self):
+        exp = ["$call-cont", ["fun", ["x", "k"], ["$call-cont", "k", ["fun", ["y", "j"], ["$call-cont", "j", "x"]]]], "z"]
+        self.assertEqual(annotate_freevars(exp),
+                         ["$call-cont",
+                          ["fun", ["x", "k"], {"freevars": []},
+                           ["$call-cont", "k", ["fun", ["y", "j"], {"freevars": ["x"], "clo": "c0"},
+                                               ["$call-cont", "j", "x"]]]],
+                          "z"])
+
+    def test_deeply_nested(self):
+        depth = 3000
+        exp = ["$+", "x0", f"x{depth - 1}", f"k{depth - 1}"]
+        for i in reversed(range(1, depth)):
+            exp = ["$call-cont", f"k{i - 1}", ["fun", [f"x{i}", f"k{i}"], exp]]
+        exp = ["fun", ["x0", "k0"], exp]
+        result = annotate_freevars(exp)
+        self.assertEqual(result[2]["freevars"], [])
+        for _ in range(depth - 1):
+            result = result[3][2]
+        self.assertEqual(result[2]["freevars"], ["x0"])
+
+
+def _shadow(ann, names):
+    # Blank out the free variables that names rebind, keeping the indexes of
+    # the rest.
+    fv = ann.get("freevars", ())
+    if not any(name in fv for name in names):
+        return ann
+    return {**ann, "freevars": [None if v in names else v for v in fv]}
+
 
 def _map_ann(exp, ann, f):
     match exp:
-        case int(_) | str(_):
+        case int(_) | str(_) | FunctionType():
             return f(exp, ann)
+        case ["$call-cont", ["cont", [arg], _, body], value]:
+            # A cont applied on the spot runs in the enclosing scope, like a
+            # let, so it keeps the enclosing annotation and loses its own.
+            return f(["$call-cont", ["cont", [arg], _map_ann(body, _shadow(ann, [arg]), f)],
+                      _map_ann(value, ann, f)], ann)
         case ["cont", [arg], new_ann, body]:
             return f(["cont", [arg], new_ann, _map_ann(body, new_ann, f)], ann)
         case ["fun", [arg, k], new_ann, body]:
             return f(["fun", [arg, k], new_ann, _map_ann(body, new_ann, f)], ann)
+        case ["let", bindings, body]:
+            names = [name for name, _ in bindings]
+            return f(["let", [[name, _map_ann(value, ann, f)] for name, value in bindings],
+                      _map_ann(body, _shadow(ann, names), f)], ann)
         case ["$if", cond, iftrue, iffalse]:
             return f(["$if", _map_ann(cond, ann, f),
                       _map_ann(iftrue, ann, f),
@@ -595,20 +1381,27 @@ def _map_ann(exp, ann, f):
 
 
 def map_ann(exp, f):
+    """Rebuild an annotated term bottom up, replacing each node with
+    f(node, ann), where ann is the annotation of the cont or fun whose body
+    the node is in ({} outside all of them), with the names rebound since
+    blanked out of its "freevars"."""
     return _map_ann(exp, {}, f)
 
 
 def _clo_ref(exp, ann):
     match exp:
         case str(_):
-            if "freevars" in ann and exp in ann["freevars"]:
-                return ["$clo-ref", ann["clo"], exp]
+            fv = ann.get("freevars", ())
+            if exp in fv:
+                return ["$clo-ref", ann["clo"], fv.index(exp)]
             return exp
         case _:
             return exp
 
 
 def clo_ref(exp):
+    """Rewrite every use of a free variable of the enclosing cont or fun to
+    ["$clo-ref", clo, index], index being its position in "freevars"."""
     return map_ann(exp, _clo_ref)
 
 
@@ -618,10 +1411,468 @@ class AddClosureParamsTests(unittest.TestCase):
 
     def test_clo_ref(self):
         self.assertEqual(
-                clo_ref(["fun", ["x", "k"], {"clo": "c0", "freevars": ["y"]},
+                clo_ref(["fun", ["x", "k"], {"clo": "c0", "freevars": ["w", "y"]},
                           ["$+", "x", "y", "k"]]),
-                ["fun", ["x", "k"], {"clo": "c0", "freevars": ["y"]},
-                  ["$+", "x", ["$clo-ref", "c0", "y"], "k"]])
+                ["fun", ["x", "k"], {"clo": "c0", "freevars": ["w", "y"]},
+                  ["$+", "x", ["$clo-ref", "c0", 1], "k"]])
+
+    def test_shadowed(self):
+        exp = ["fun", ["x", "k"], {"clo": "c0", "freevars": ["y"]},
+               ["let", [["y", "y"]], ["$call-cont", "k", "y"]]]
+        self.assertEqual(clo_ref(exp)[3],
+                         ["let", [["y", ["$clo-ref", "c0", 0]]], ["$call-cont", "k", "y"]])
+
+
+def _closure(exp, ann):
+    match exp:
+        case ["cont", _, node_ann, _] | ["fun", _, node_ann, _] if node_ann["freevars"]:
+            return ["$closure", exp, [_clo_ref(v, ann) for v in node_ann["freevars"]]]
+    return _clo_ref(exp, ann)
+
+
+def closure_convert(exp):
+    """Closure-convert a CPS term (in list form) for flat closures.
+
+    Every fun, and every cont that is passed or bound rather than applied on
+    the spot, becomes ["$closure", code, captures] when it has free
+    variables: captures lists the values of its free variables at the point
+    of creation, and inside code each of them is read with
+    ["$clo-ref", clo, index] (see clo_ref). Combinators (no free variables)
+    stay plain annotated terms and allocate nothing.
+
+    interp runs the result with lexical scope: a closure record holds only
+    what it captured, and entering a converted fun or cont starts a fresh
+    environment with just its parameters and its record."""
+    return map_ann(annotate_freevars(exp), _closure)
+
+
+def recursive_sum_source(n):
+    """Source for 0 + 1 + ... + n by non-tail recursion through the Z
+    combinator, so n additions are pending at the deepest call. interp runs
+    the plain CPS of it with dynamic scope, under which the combinator never
+    returns; closure-convert it first."""
+    half = ["lambda", ["x"], ["f", ["lambda", ["v"], [["x", "x"], "v"]]]]
+    z = ["lambda", ["f"], [half, half]]
+    body = ["lambda", ["self"],
+            ["lambda", ["n"], ["if", "n", ["+", "n", ["self", ["-", "n", 1]]], 0]]]
+    return [[z, body], n]
+
+
+def _interp_converted(exp, env):
+    interp(closure_convert(exp), env)
+
+
+class ClosureConvertTests(UseGensym):
+    def test_built_on_clo_ref(self):
+        exp = cps_cont(["lambda", ["x"], ["lambda", ["y"], ["+", "x", "y"]]], "k")
+        self.setUp()
+        refs = clo_ref(annotate_freevars(exp))
+        self.setUp()
+        converted = closure_convert(exp)
+        # The code in the closure record reads what clo_ref wrote.
+        [_, code, captures] = converted[2][3][2]
+        self.assertEqual(code, refs[2][3][2])
+        self.assertEqual(captures, ["x"])
+
+    def test_convert(self):
+        exp = cps_cont(["lambda", ["x"], ["lambda", ["y"], ["+", "x", "y"]]], "k")
+        self.assertEqual(closure_convert(exp),
+                         ["$call-cont", "k",
+                          ["fun", ["x", "k0"], {"freevars": []},
+                           ["$call-cont", "k0",
+                            ["$closure",
+                             ["fun", ["y", "k1"], {"freevars": ["x"], "clo": "c2"},
+                              ["$+", ["$clo-ref", "c2", 0], "y", "k1"]],
+                             ["x"]]]]])
+
+    def test_escaping_cont(self):
+        exp = ["f", 1, ["cont", ["v"], ["$+", "v", "x", "k"]]]
+        self.assertEqual(closure_convert(exp),
+                         ["f", 1, ["$closure",
+                                   ["cont", ["v"], {"freevars": ["k", "x"], "clo": "c0"},
+                                    ["$+", "v", ["$clo-ref", "c0", 1], ["$clo-ref", "c0", 0]]],
+                                   ["k", "x"]]])
+
+    def test_lexical_scope(self):
+        # f captures x = 1; the call to f happens where x = 2.
+        exp = cps_cont([["lambda", ["f"], [["lambda", ["x"], ["f", 0]], 2]],
+                        [["lambda", ["x"], ["lambda", ["y"], "x"]], 1]], "k")
+        results = []
+        interp(closure_convert(exp), {"k": results.append})
+        self.assertEqual(results, [1])
+
+    def test_environment_is_flat(self):
+        sizes = []
+        def f(x, env, k):
+            sizes.append(len(env))
+            apply_cont(k, x, env)
+        exp = cps_cont([["lambda", ["a"], [["lambda", ["b"], [["lambda", ["c"], ["f", "c"]], 3]], 2]], 1], "k")
+        results = []
+        interp(closure_convert(exp), {"f": f, "k": results.append})
+        self.assertEqual(results, [3])
+        # Only c, the continuation and the record capturing f.
+        self.assertEqual(sizes, [3])
+
+    def test_profile(self):
+        profile = Profile()
+        exp = cps_cont([[["lambda", ["x"], ["lambda", ["y"], ["+", "x", "y"]]], 3], 4], "k")
+        interp(closure_convert(exp), {"k": lambda x: None}, profile)
+        # The inner fun captures x; the continuation of the outer call captures k.
+        self.assertEqual((profile.closure_allocs, profile.captured), (2, 2))
+        self.assertEqual(profile.kinds["call"], 2)
+
+
+class ClosureConvertedEndToEndTests(EndToEndTests):
+    interp = staticmethod(_interp_converted)
+
+    def test_shadowing(self):
+        exp = [["lambda", ["x"], [["lambda", ["x"], ["+", "x", 1]], ["+", "x", 10]]], 1]
+        self.assertEqual(self._interp(exp), 12)
+
+    def test_recursion(self):
+        self.assertEqual(self._interp(recursive_sum_source(10)), 55)
+
+
+"""
+Defunctionalized continuations:
+
+After closure conversion an escaping cont is a Closure: a record pointing at
+its code plus a separate tuple of captured values. defunctionalize replaces
+each such cont term with ["$frame", tag, captures], where tag is a subclass of
+Frame made for that one term and holding its code. A frame record is then
+just a tuple of the cont's live variables, one allocation with no code
+pointer: its class is its tag, and _apply_cont dispatches on it. The
+continuation a cont passes its result on to is among its live variables, so
+pending frames form a chain like a control stack. Inside the code,
+["$frame-ref", clo, i] reads the i-th live variable.
+"""
+
+
+class Frame(tuple):
+    """Base of the per-cont frame record classes made by defunctionalize."""
+
+    __slots__ = ()
+    code = None
+
+    def __repr__(self):
+        return f"{type(self).__name__}{tuple(self)!r}"
+
+
+def _defunctionalize(exp, frames, tags):
+    # frames holds the record names of the frames whose code encloses exp.
+    match exp:
+        case ["$clo-ref", clo, index] if clo in frames:
+            return ["$frame-ref", clo, index]
+        case ["$closure", ["cont", [arg], ann, body], captures]:
+            captures = [_defunctionalize(capture, frames, tags) for capture in captures]
+            code = ["cont", [arg], ann, _defunctionalize(body, frames | {ann["clo"]}, tags)]
+            tag = type(f"Frame{next(tags)}", (Frame,), {"__slots__": (), "code": code})
+            return ["$frame", tag, captures]
+        case ["$closure", code, captures]:
+            return ["$closure", _defunctionalize(code, frames, tags),
+                    [_defunctionalize(capture, frames, tags) for capture in captures]]
+        case ["fun", params, ann, body]:
+            return ["fun", params, ann, _defunctionalize(body, frames, tags)]
+        case ["cont", params, *ann, body]:
+            return ["cont", params, *ann, _defunctionalize(body, frames, tags)]
+        case ["let", bindings, body]:
+            return ["let", [[name, _defunctionalize(value, frames, tags)] for name, value in bindings],
+                    _defunctionalize(body, frames, tags)]
+        case [str(head), *rest] if head.startswith("$"):
+            return [head, *[_defunctionalize(term, frames, tags) for term in rest]]
+        case [*terms] if len(terms) == 3:
+            return [_defunctionalize(term, frames, tags) for term in terms]
+    return exp
+
+
+def defunctionalize(exp):
+    """Closure-convert a CPS term (in list form), then turn every cont that
+    becomes a closure into a frame record (see above). interp runs the result
+    with the same lexical scope as closure_convert's."""
+    return _defunctionalize(closure_convert(exp), frozenset(), itertools.count())
+
+
+def _interp_defunctionalized(exp, env):
+    interp(defunctionalize(exp), env)
+
+
+class DefunctionalizeTests(UseGensym):
+    def test_escaping_cont(self):
+        exp = defunctionalize(["f", 1, ["cont", ["v"], ["$+", "v", "x", "k"]]])
+        [f, one, [head, tag, captures]] = exp
+        self.assertEqual([f, one, head, captures], ["f", 1, "$frame", ["k", "x"]])
+        self.assertTrue(issubclass(tag, Frame))
+        self.assertEqual(tag.code,
+                         ["cont", ["v"], {"freevars": ["k", "x"], "clo": "c0"},
+                          ["$+", "v", ["$frame-ref", "c0", 1], ["$frame-ref", "c0", 0]]])
+
+    def test_frames_chain(self):
+        seen = []
+        def f(x, env, k):
+            seen.append(k)
+            apply_cont(k, x, env)
+        # An addition pending in the caller of g, and one in g around f.
+        exp = cps_cont(["+", 1, [["lambda", ["y"], ["+", 2, ["f", "y"]]], 3]], "k")
+        results = []
+        interp(defunctionalize(exp), {"f": f, "k": results.append})
+        self.assertEqual(results, [6])
+        [frame] = seen
+        self.assertIsInstance(frame, Frame)
+        # The frame holds the continuation it returns to, itself a frame
+        # holding the host continuation.
+        self.assertFalse(hasattr(frame, "__dict__"))
+        [parent] = [value for value in frame if isinstance(value, Frame)]
+        self.assertIn(results.append, list(parent))
+
+    def test_funs_stay_closures(self):
+        exp = defunctionalize(cps_cont(["lambda", ["x"], ["lambda", ["y"], ["+", "x", "y"]]], "k"))
+        self.assertEqual(exp[2][3][2][0], "$closure")
+
+    def test_profile(self):
+        profile = Profile()
+        exp = cps_cont([[["lambda", ["x"], ["lambda", ["y"], ["+", "x", "y"]]], 3], 4], "k")
+        interp(defunctionalize(exp), {"k": lambda x: None}, profile)
+        self.assertEqual((profile.closure_allocs, profile.captured), (1, 1))
+        self.assertEqual((profile.frame_allocs, profile.frame_captured), (1, 1))
+        self.assertIn("frames allocated: 1 (1 values captured)", profile.report())
+
+
+class DefunctionalizedEndToEndTests(ClosureConvertedEndToEndTests):
+    interp = staticmethod(_interp_defunctionalized)
+
+
+def census(exp):
+    """Count how often each name is referenced and bound in exp.
+
+    Returns (uses, binds), two Counters keyed by name."""
+    uses = Counter()
+    binds = Counter()
+    stack = [exp]
+    while stack:
+        exp = stack.pop()
+        match exp:
+            case str(_):
+                uses[exp] += 1
+            case ["cont", args, *rest] | ["fun", args, *rest]:
+                binds.update(args)
+                stack.append(rest[-1])
+            case ["let", bindings, body]:
+                for name, value in bindings:
+                    binds[name] += 1
+                    stack.append(value)
+                stack.append(body)
+            case list(_):
+                stack.extend(_subterms(exp))
+    return uses, binds
+
+
+class _Shrinker:
+    """One top-down shrinking pass, driven by the census of the whole term."""
+
+    def __init__(self, exp):
+        self.uses, self.binds = census(exp)
+        # Names bound by a binder enclosing the current node. Only names
+        # bound exactly once are consulted, so nested binders of one name
+        # cannot confuse it.
+        self.scope = set()
+        # Pending substitutions, applied as the walk reaches each use, so
+        # contracting a redex costs nothing beyond walking its body once.
+        self.subst = {}
+        self.changed = False
+
+    def stable(self, name):
+        """Whether name refers to the same binding everywhere below the
+        current node: it is bound nowhere in the term, or only by a binder
+        enclosing the current node."""
+        count = self.binds[name]
+        return count == 0 or (count == 1 and name in self.scope)
+
+    def contract(self, name, value):
+        """Substitute value for name if that is safe, and report whether it was.
+
+        value has been shrunk already unless it is a cont or fun literal."""
+        if self.binds[name] != 1:
+            return False
+        match value:
+            case int(_):
+                pass
+            case str(_) if self.stable(value):
+                pass
+            case ["cont" | "fun", _, _] if self.uses[name] == 1 and all(
+                    self.stable(v) for v in free_in(value)):
+                # Move, never copy, a literal, and only when nothing in its
+                # new position rebinds its free variables.
+                pass
+            case _:
+                return False
+        self.subst[name] = value
+        self.changed = True
+        return True
+
+    def bind(self, names, body):
+        self.scope.update(names)
+        try:
+            return self.shrink(body)
+        finally:
+            self.scope.difference_update(names)
+
+    def shrink(self, exp):
+        match exp:
+            case str(_):
+                if exp not in self.subst:
+                    return exp
+                value = self.subst[exp]
+                if isinstance(value, list):
+                    return self.shrink(value)
+                return value
+            case ["$call-cont", ["cont", [v], body], arg]:
+                if self.uses[v] == 0:
+                    self.changed = True
+                    return self.shrink(body)
+                if isinstance(arg, str):
+                    arg = self.shrink(arg)
+                if self.contract(v, arg):
+                    return self.shrink(body)
+                return ["$call-cont", self.shrink(exp[1]), self.shrink(arg)]
+            case ["$call-cont", cont, arg]:
+                cont = self.shrink(cont)
+                match cont:
+                    case ["cont", _, _]:
+                        # A literal moved here by substitution: a new redex.
+                        return self.shrink(["$call-cont", cont, arg])
+                return ["$call-cont", cont, self.shrink(arg)]
+            case ["cont", [v], body]:
+                body = self.bind([v], body)
+                match body:
+                    case ["$call-cont", str(k), arg] if arg == v and k != v and self.stable(k):
+                        self.changed = True
+                        return k
+                return ["cont", [v], body]
+            case ["fun", [x, k], body]:
+                body = self.bind([x, k], body)
+                match body:
+                    case [str(f), arg, kont] if (arg == x and kont == k and f not in (x, k)
+                                                 and f not in PRIMS and self.stable(f)):
+                        self.changed = True
+                        return f
+                return ["fun", [x, k], body]
+            case [op, x, y, k] if op in PRIMS:
+                x, y, k = self.shrink(x), self.shrink(y), self.shrink(k)
+                if type(x) is int and type(y) is int and not (op == "$/" and y == 0):
+                    self.changed = True
+                    return self.shrink(["$call-cont", k, PRIMS[op](x, y)])
+                return [op, x, y, k]
+            case ["$if", cond, iftrue, iffalse]:
+                cond = self.shrink(cond)
+                if type(cond) is int:
+                    self.changed = True
+                    return self.shrink(iftrue if cond else iffalse)
+                return ["$if", cond, self.shrink(iftrue), self.shrink(iffalse)]
+            case ["let", bindings, body]:
+                kept = []
+                for name, value in bindings:
+                    if isinstance(value, str):
+                        value = self.shrink(value)
+                    if self.uses[name] == 0:
+                        self.changed = True
+                    elif not self.contract(name, value):
+                        kept.append([name, self.shrink(value)])
+                body = self.bind([name for name, _ in kept], body)
+                if not kept:
+                    return body
+                return ["let", kept, body]
+            case [func, arg, k]:
+                return [self.shrink(func), self.shrink(arg), self.shrink(k)]
+        return exp
+
+
+def shrink(exp):
+    """Shrink a CPS term (in list form) without changing what it computes.
+
+    Each pass takes a census of the uses and binders of every name and then
+    rewrites top-down:
+
+    - a literal cont applied to a trivial value, or a let binding, whose
+      name is never used is dropped; one bound to an int, or to a variable
+      that no binder in between rebinds, is substituted into the body;
+      one bound to a cont or fun literal is substituted only where the name
+      is used exactly once (beta-contraction);
+    - ["cont", [v], ["$call-cont", k, v]] becomes k, and
+      ["fun", [x, k], [f, x, k]] becomes f (eta-reduction);
+    - arithmetic on two int literals is folded (except division by zero),
+      and so is an $if on an int literal.
+
+    Passes repeat until one changes nothing; every rewrite makes the term
+    smaller, so this terminates. Substitution is only done for names bound
+    exactly once in the term, which is the case for every name cps and
+    cps_cont generate."""
+    while True:
+        shrinker = _Shrinker(exp)
+        exp = shrinker.shrink(exp)
+        if not shrinker.changed:
+            return exp
+
+
+class ShrinkTests(UseGensym):
+    def _steps(self, exp):
+        profile = Profile()
+        results = []
+        interp(exp, {"k": results.append}, profile)
+        return results, profile.steps
+
+    def test_fold(self):
+        self.assertEqual(shrink(cps(["+", 1, ["*", 2, 3]], "k")), ["$call-cont", "k", 7])
+
+    def test_var_operand(self):
+        self.assertEqual(shrink(cps(["-", "x", ["/", 7, 2]], "k")), ["$-", "x", 3, "k"])
+
+    def test_division_by_zero_is_not_folded(self):
+        self.assertEqual(shrink(["$/", 1, 0, "k"]), ["$/", 1, 0, "k"])
+
+    def test_if(self):
+        self.assertEqual(shrink(cps(["if", 0, 2, 3], "k")), ["$call-cont", "k", 3])
+        self.assertEqual(shrink(cps(["if", "x", 2, 3], "k")),
+                         ["$if", "x", ["$call-cont", "k", 2], ["$call-cont", "k", 3]])
+
+    def test_fun_literal_used_once(self):
+        self.assertEqual(shrink(cps([["lambda", ["x"], "x"], 123], "k")),
+                         [["fun", ["x", "k2"], ["$call-cont", "k2", "x"]], 123, "k"])
+
+    def test_eta(self):
+        self.assertEqual(shrink(["f", 1, ["cont", ["v"], ["$call-cont", "k", "v"]]]), ["f", 1, "k"])
+        self.assertEqual(shrink(["$call-cont", "k", ["fun", ["x", "j"], ["g", "x", "j"]]]),
+                         ["$call-cont", "k", "g"])
+
+    def test_eta_keeps_rebound_continuation(self):
+        exp = ["let", [["k", 1]], ["f", 1, ["cont", ["v"], ["$call-cont", "k", "v"]]]]
+        exp = ["$call-cont", ["cont", ["k"], exp], "j"]
+        self.assertEqual(shrink(exp), exp)
+
+    def test_no_capture(self):
+        exp = ["$call-cont", ["cont", ["a"], ["g", 1, ["cont", ["x"], ["f", "a", "k"]]]], "x"]
+        self.assertEqual(shrink(exp), exp)
+
+    def test_dead_let(self):
+        exp = ["let", [["j", ["cont", ["v"], ["$call-cont", "k", "v"]]], ["n", 1]],
+               ["$call-cont", "k", "n"]]
+        self.assertEqual(shrink(exp), ["$call-cont", "k", 1])
+
+    def test_join_point_is_kept(self):
+        exp = cps_cont(["+", ["if", "x", 1, 2], 3], "k")
+        self.assertEqual(shrink(exp), exp)
+
+    def test_as_few_steps_as_cps_cont(self):
+        for exp in [["+", 1, ["+", 2, 3]],
+                    [[["lambda", ["x"], ["lambda", ["y"], ["+", "x", "y"]]], 3], 4],
+                    [["lambda", ["x"], ["if", "x", ["-", "x", 2], 3]], 1],
+                    ["if", ["if", 0, 2, 0], ["+", 4, 4], ["+", 5, 5]],
+                    ["+", ["if", 1, ["+", 1, 1], 7], ["if", 0, 5, 3]],
+                    [["lambda", ["f"], ["f", ["f", 3]]], ["lambda", ["x"], ["*", "x", "x"]]]]:
+            with self.subTest(exp=exp):
+                naive, naive_steps = self._steps(shrink(cps(exp, "k")))
+                meta, meta_steps = self._steps(cps_cont(exp, "k"))
+                self.assertEqual(naive, meta)
+                self.assertLessEqual(naive_steps, meta_steps)
 
 
 if __name__ == "__main__":
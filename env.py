@@ -0,0 +1,241 @@
+import unittest
+from collections.abc import Mapping
+
+
+"""
+Persistent environments for the CPS interpreter.
+
+An Env is an immutable mapping stored as a hash array mapped trie (HAMT).
+Extending it with set() copies only the path from the root to the changed
+entry, at most 13 nodes of up to 32 entries for 64-bit hashes, and shares the
+rest of the trie with the original. Lookups walk the same path. Rebinding a
+name replaces its entry instead of shadowing it, so an environment threaded
+through a long-running loop stays the size of its scope.
+"""
+
+
+_BITS = 5
+_MASK = (1 << _BITS) - 1
+_HASH_BITS = 64
+_HASH_MASK = (1 << _HASH_BITS) - 1
+
+
+class _Node:
+    __slots__ = ("bitmap", "entries")
+
+    def __init__(self, bitmap, entries):
+        self.bitmap = bitmap
+        # Each entry is a (key, value) tuple, a child _Node, or a _Bucket.
+        self.entries = entries
+
+
+class _Bucket:
+    """Keys whose full hashes collide."""
+
+    __slots__ = ("pairs",)
+
+    def __init__(self, pairs):
+        self.pairs = pairs
+
+    def assoc(self, key, value):
+        for i, (k, v) in enumerate(self.pairs):
+            if k == key:
+                return _Bucket(self.pairs[:i] + ((key, value),) + self.pairs[i + 1:]), False
+        return _Bucket(self.pairs + ((key, value),)), True
+
+
+_EMPTY = _Node(0, ())
+
+
+def _hash(key):
+    return hash(key) & _HASH_MASK
+
+
+def _lookup(node, key, h):
+    shift = 0
+    while True:
+        bit = 1 << ((h >> shift) & _MASK)
+        if not node.bitmap & bit:
+            raise KeyError(key)
+        entry = node.entries[(node.bitmap & (bit - 1)).bit_count()]
+        kind = type(entry)
+        if kind is tuple:
+            if entry[0] is key or entry[0] == key:
+                return entry[1]
+            raise KeyError(key)
+        if kind is _Node:
+            node = entry
+            shift += _BITS
+            continue
+        for k, v in entry.pairs:
+            if k == key:
+                return v
+        raise KeyError(key)
+
+
+def _merge(pair, pair_hash, key, value, h, shift):
+    if shift >= _HASH_BITS:
+        return _Bucket((pair, (key, value)))
+    old_index = (pair_hash >> shift) & _MASK
+    new_index = (h >> shift) & _MASK
+    if old_index == new_index:
+        child = _merge(pair, pair_hash, key, value, h, shift + _BITS)
+        return _Node(1 << old_index, (child,))
+    if old_index < new_index:
+        entries = (pair, (key, value))
+    else:
+        entries = ((key, value), pair)
+    return _Node((1 << old_index) | (1 << new_index), entries)
+
+
+def _assoc(node, key, value, h, shift):
+    """Return (new node, whether a key was added)."""
+    bit = 1 << ((h >> shift) & _MASK)
+    index = (node.bitmap & (bit - 1)).bit_count()
+    entries = node.entries
+    if not node.bitmap & bit:
+        return _Node(node.bitmap | bit, entries[:index] + ((key, value),) + entries[index:]), True
+    entry = entries[index]
+    kind = type(entry)
+    if kind is tuple:
+        if entry[0] is key or entry[0] == key:
+            new, added = (key, value), False
+        else:
+            new = _merge(entry, _hash(entry[0]), key, value, h, shift + _BITS)
+            added = True
+    elif kind is _Node:
+        new, added = _assoc(entry, key, value, h, shift + _BITS)
+    else:
+        new, added = entry.assoc(key, value)
+    return _Node(node.bitmap, entries[:index] + (new,) + entries[index + 1:]), added
+
+
+def _items(node):
+    for entry in node.entries:
+        kind = type(entry)
+        if kind is tuple:
+            yield entry
+        elif kind is _Node:
+            yield from _items(entry)
+        else:
+            yield from entry.pairs
+
+
+class Env(Mapping):
+    __slots__ = ("_root", "_size")
+
+    def __init__(self, mapping=()):
+        root, size = _EMPTY, 0
+        items = mapping.items() if isinstance(mapping, Mapping) else mapping
+        for key, value in items:
+            root, added = _assoc(root, key, value, _hash(key), 0)
+            size += added
+        self._root = root
+        self._size = size
+
+    @classmethod
+    def _make(cls, root, size):
+        env = cls.__new__(cls)
+        env._root = root
+        env._size = size
+        return env
+
+    def __getitem__(self, key):
+        return _lookup(self._root, key, _hash(key))
+
+    def __contains__(self, key):
+        try:
+            _lookup(self._root, key, _hash(key))
+        except KeyError:
+            return False
+        return True
+
+    def __iter__(self):
+        for key, _ in _items(self._root):
+            yield key
+
+    def __len__(self):
+        return self._size
+
+    def items(self):
+        return list(_items(self._root))
+
+    def __repr__(self):
+        return f"Env({dict(_items(self._root))!r})"
+
+    def set(self, key, value):
+        """Return a new environment with key bound to value."""
+        root, added = _assoc(self._root, key, value, _hash(key), 0)
+        return Env._make(root, self._size + added)
+
+    def update(self, mapping):
+        """Return a new environment with every binding in mapping added."""
+        env = self
+        items = mapping.items() if isinstance(mapping, Mapping) else mapping
+        for key, value in items:
+            env = env.set(key, value)
+        return env
+
+
+def as_env(env):
+    if type(env) is Env:
+        return env
+    return Env(env)
+
+
+class EnvTests(unittest.TestCase):
+    def test_empty(self):
+        env = Env()
+        self.assertEqual(len(env), 0)
+        self.assertNotIn("x", env)
+        with self.assertRaises(KeyError):
+            env["x"]
+
+    def test_set_is_persistent(self):
+        env0 = Env({"x": 1})
+        env1 = env0.set("y", 2)
+        self.assertEqual(dict(env0), {"x": 1})
+        self.assertEqual(dict(env1), {"x": 1, "y": 2})
+
+    def test_rebind_replaces(self):
+        env = Env({"x": 1}).set("x", 2)
+        self.assertEqual(env["x"], 2)
+        self.assertEqual(len(env), 1)
+
+    def test_many_keys(self):
+        env = Env()
+        for i in range(5000):
+            env = env.set(f"v{i}", i)
+        self.assertEqual(len(env), 5000)
+        self.assertTrue(all(env[f"v{i}"] == i for i in range(5000)))
+        self.assertEqual(env.get("missing", "default"), "default")
+
+    def test_full_hash_collision(self):
+        class Key:
+            def __init__(self, name):
+                self.name = name
+
+            def __hash__(self):
+                return 42
+
+            def __eq__(self, other):
+                return self.name == other.name
+
+        a, b, c = Key("a"), Key("b"), Key("c")
+        env = Env().set(a, 1).set(b, 2).set(c, 3).set(b, 4)
+        self.assertEqual((env[a], env[b], env[c]), (1, 4, 3))
+        self.assertEqual(len(env), 3)
+        self.assertNotIn(Key("d"), env)
+
+    def test_update(self):
+        env = Env({"x": 1}).update({"x": 3, "y": 2})
+        self.assertEqual(dict(env), {"x": 3, "y": 2})
+
+    def test_as_env(self):
+        env = Env({"x": 1})
+        self.assertIs(as_env(env), env)
+        self.assertEqual(as_env({"x": 1}), env)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,195 @@
+import unittest
+
+from kelsey import CFG, Block, F, Gblocks, PURE_OPS, UseGensym, check_preserves_run
+
+
+"""
+Dominator-based global value numbering over a kelsey.CFG.
+
+The pass walks the dominator tree depth first with a scoped hash table from
+expressions to the name that first computed them: entries made in a block are
+visible in every block it dominates and are dropped when the walk leaves it.
+An assignment whose expression, after substituting the names already found
+redundant, is in the table is deleted and its name replaced by the earlier
+one everywhere; SSA guarantees the earlier definition dominates every use.
+Copies and constants are propagated the same way. Operands of commutative
+operators are ordered, so (+ a b) and (+ b a) share a number. A phi whose
+inputs are all one value, or that matches an earlier phi of the same block
+input for input, is removed too.
+
+Only the operators in PURE_OPS are numbered; calls may have effects and are
+never merged. A computation repeated in two sibling branches is not
+redundant on either path and is left alone (removing it would need code
+motion, not value numbering).
+"""
+
+
+COMMUTATIVE = {"+", "*", "=", "!="}
+
+
+def _key(exp):
+    match exp:
+        case [op, x, y] if op in COMMUTATIVE:
+            x, y = sorted([_key(x), _key(y)], key=repr)
+            return (op, x, y)
+        case [op, *args]:
+            return (op, *[_key(arg) for arg in args])
+    return exp
+
+
+class _Numbering:
+    def __init__(self):
+        # Name -> the value (an earlier name or an int) that replaces it.
+        self.subst = {}
+        self.table = {}
+
+    def resolve(self, exp):
+        match exp:
+            case str(_):
+                while isinstance(exp, str) and exp in self.subst:
+                    exp = self.subst[exp]
+                return exp
+            case [op, *args]:
+                return [op, *[self.resolve(arg) for arg in args]]
+        return exp
+
+    def visit(self, b, block, log):
+        phis = []
+        for x, _, _, inputs in block.phis:
+            args = [self.resolve(arg) for _, arg in inputs]
+            others = {repr(arg): arg for arg in args if arg != x}
+            if len(others) == 1:
+                [self.subst[x]] = others.values()
+                continue
+            key = ("phi", b, tuple(args))
+            if key in self.table:
+                self.subst[x] = self.table[key]
+                continue
+            self.table[key] = x
+            log.append(key)
+            phis.append(x)
+        body = []
+        for x, _, value in block.body:
+            value = self.resolve(value)
+            match value:
+                case int(_) | str(_):
+                    self.subst[x] = value
+                    continue
+                case [op, _, _] if op in PURE_OPS:
+                    key = _key(value)
+                    if key in self.table:
+                        self.subst[x] = self.table[key]
+                        continue
+                    self.table[key] = x
+                    log.append(key)
+            body.append(x)
+        return phis, body
+
+
+def gvn(cfg):
+    """Run GVN over cfg (a kelsey.CFG, or a Gblocks dict).
+
+    Returns (new CFG, stats) with instruction counts before and after and the
+    number of names replaced."""
+    if isinstance(cfg, dict):
+        cfg = CFG.from_blocks(cfg)
+    numbering = _Numbering()
+    kept = {}
+    stack = [(0, None)]
+    while stack:
+        b, log = stack.pop()
+        if log is not None:
+            # Leaving b: its entries go out of scope.
+            for key in log:
+                del numbering.table[key]
+            continue
+        log = []
+        kept[b] = numbering.visit(b, cfg.blocks[b], log)
+        stack.append((b, log))
+        stack.extend((child, None) for child in reversed(cfg.dom_tree[b]))
+
+    resolve = numbering.resolve
+    blocks = []
+    for block in cfg.blocks:
+        phi_names, body_names = kept.get(block.id, ([], []))
+        phi_names, body_names = set(phi_names), set(body_names)
+        phis = [[x, "<-", "phi", [(pred, resolve(arg)) for pred, arg in inputs]]
+                for x, _, _, inputs in block.phis if x in phi_names]
+        body = [[x, "<-", resolve(value)] for x, _, value in block.body if x in body_names]
+        match block.term:
+            case ["return", value]:
+                term = ["return", resolve(value)]
+            case ["br", test, then, else_]:
+                term = ["br", resolve(test), then, else_]
+            case term:
+                pass
+        blocks.append(Block(block.id, block.label, phis, body, term,
+                            list(block.preds), list(block.succs)))
+    result = CFG(blocks, cfg.params)
+    stats = {
+        "instructions_before": cfg.instruction_count(),
+        "instructions_after": result.instruction_count(),
+        "replaced": len(numbering.subst),
+    }
+    return result, stats
+
+
+class GVNTests(UseGensym):
+    def test_path(self):
+        source = ["let", [["s", ["+", "a", "b"]]],
+                  ["let", [["t", ["+", "b", "a"]]],
+                   ["let", [["u", ["*", "s", "t"]]],
+                    ["let", [["w", ["*", "t", "s"]]],
+                     ["-", "u", "w"]]]]]
+        cfg = Gblocks(F(source, "k"), cfg=True)
+        new, stats = gvn(cfg)
+        self.assertEqual(new[0].body, [["s", "<-", ["+", "a", "b"]], ["u", "<-", ["*", "s", "s"]]])
+        self.assertEqual(new[0].term, ["return", ["-", "u", "u"]])
+        self.assertEqual(stats, {"instructions_before": 5, "instructions_after": 3, "replaced": 2})
+        env = {"a": 3, "b": 4}
+        self.assertEqual(new.run(env)[0], cfg.run(env)[0])
+
+    def test_dominating_computation_reaches_both_arms(self):
+        source = ["let", [["s", ["+", "a", "b"]]],
+                  ["if", "p",
+                   ["let", [["t", ["+", "a", "b"]]], ["-", "t", "s"]],
+                   ["let", [["u", ["+", "a", "b"]]], ["*", "u", "s"]]]]
+        cfg = Gblocks(F(source, "k"), cfg=True)
+        new, stats = gvn(cfg)
+        self.assertEqual(stats["replaced"], 2)
+        for p in 0, 1:
+            env = {"a": 3, "b": 4, "p": p}
+            self.assertEqual(new.run(env)[0], cfg.run(env)[0])
+            self.assertLess(new.run(env)[1], cfg.run(env)[1])
+
+    def test_sibling_branches_are_not_merged(self):
+        source = ["if", "p",
+                  ["let", [["t", ["+", "a", "b"]]], "t"],
+                  ["let", [["u", ["+", "a", "b"]]], "u"]]
+        _, stats = gvn(Gblocks(F(source, "k"), cfg=True))
+        self.assertEqual(stats["replaced"], 0)
+
+    def test_calls_are_not_merged(self):
+        source = ["let", [["x", ["f", "a"]]], ["let", [["y", ["f", "a"]]], ["+", "x", "y"]]]
+        new, stats = gvn(Gblocks(F(source, "k"), cfg=True))
+        self.assertEqual(stats["replaced"], 0)
+        self.assertEqual(len(new[0].body), 2)
+
+    def test_trivial_phi(self):
+        source = ["let", [["x", ["if", "p", "a", "a"]]],
+                  ["let", [["y", ["if", "q", "x", "b"]]],
+                   ["-", "y", "x"]]]
+        cfg = Gblocks(F(source, "k"), cfg=True)
+        new, stats = gvn(cfg)
+        self.assertEqual([phi[0] for block in new.blocks for phi in block.phis], ["y"])
+        self.assertEqual(new[1].phis[0][3], [(5, "a"), (6, "b")])
+        self.assertEqual(new[1].term, ["return", ["-", "y", "a"]])
+        self.assertEqual(stats["instructions_after"], stats["instructions_before"] - 1)
+
+    def test_preserves_results(self):
+        check_preserves_run(self, lambda cfg: gvn(cfg)[0])
+
+
+if __name__ == "__main__":
+    __import__("sys").modules["unittest.util"]._MAX_LENGTH = 999999999
+    unittest.main()
@@ -1,17 +1,16 @@
+import itertools
+import operator
+import random
 import unittest
+from collections import Counter
+from dataclasses import dataclass
 
-
-GENSYM_COUNTER = iter(range(1000))
-
-
-def gensym(stem="v"):
-    return f"{stem}{next(GENSYM_COUNTER)}"
+from names import gensym, name_supply
 
 
 class UseGensym(unittest.TestCase):
     def setUp(self):
-        global GENSYM_COUNTER
-        GENSYM_COUNTER = iter(range(1000))
+        self.enterContext(name_supply())
 
 
 """
@@ -114,16 +113,105 @@ M' ::= (E E* C)
      | (let ((x E)) M')
      | (letrec ((x P')) M')
 C ::= k | (l_cont (x) M')
-P' ::= (l_proc (x* k) M') | (l_jump (x*) M')
+P' ::= (l_proc (x* k) M') | (l_jump (x*) M') | (l_cont (x) M')
 where x, k are variables
 """
 
 
-def V(exp):
+@dataclass(slots=True)
+class LCont:
+    arg: str
+    body: object
+
+
+@dataclass(slots=True)
+class LProc:
+    args: list
+    body: object
+
+
+@dataclass(slots=True)
+class LJump:
+    args: list
+    body: object
+
+
+@dataclass(slots=True)
+class Let:
+    x: str
+    value: object
+    body: object
+
+
+@dataclass(slots=True)
+class Letrec:
+    bindings: list
+    body: object
+
+
+@dataclass(slots=True)
+class If:
+    test: object
+    conseq: object
+    alt: object
+
+
+@dataclass(slots=True)
+class CallCont:
+    k: object
+    exp: object
+
+
+@dataclass(slots=True)
+class Jmp:
+    k: str
+    args: list
+
+
+@dataclass(slots=True)
+class App:
+    fn: object
+    args: list
+    k: object
+
+
+@dataclass(slots=True)
+class _Loop:
+    """A procedure whose self tail calls F turns into jumps to label, which
+    is made at the first such call."""
+    name: str
+    k: str
+    label: str = None
+
+
+def V(exp, typed=False, name=None):
+    """CPS-convert a lambda to an l_proc.
+
+    name is the name the procedure calls itself by, if any. A call to it in
+    tail position (passing the procedure's own continuation) becomes a jump
+    to a loop header: the parameters are renamed, the body is wrapped in an
+    l_jump binding the original names, and the procedure starts by jumping
+    there with the renamed parameters, so G makes the recursion a loop."""
     match exp:
         case ["lambda", [*args], body]:
             k = gensym("k")
-            return ["l_proc", [*args, k], F(body, k)]
+            if name is not None and name not in args:
+                loop = _Loop(name, k)
+                loop_body = F(body, k, typed, loop)
+                if loop.label is not None:
+                    params = [gensym(arg) for arg in args]
+                    if typed:
+                        return LProc([*params, k], Letrec([(loop.label, LJump(args, loop_body))],
+                                                          Jmp(loop.label, params)))
+                    return ["l_proc", [*params, k],
+                            ["letrec", [[loop.label, ["l_jump", [*args], loop_body]]],
+                             ["$jmp", loop.label, *params]]]
+                body = loop_body
+            else:
+                body = F(body, k, typed)
+            if typed:
+                return LProc([*args, k], body)
+            return ["l_proc", [*args, k], body]
         case _:
             raise TypeError(f"not a procedure: {exp}")
 
@@ -132,60 +220,129 @@ def is_trivial(exp):
     return isinstance(exp, (int, str))
 
 
-def jmp(k, exp):
+def jmp(k, exp, typed=False):
     match exp:
         case str(_):
-            return ["$jmp", k, exp]
+            return Jmp(k, [exp]) if typed else ["$jmp", k, exp]
         case _:
             v = gensym()
+            if typed:
+                return Let(v, exp, Jmp(k, [v]))
             return ["let", [[v, exp]], ["$jmp", k, v]]
 
 
-def F(exp, k):
+def _unpack_l_cont(k):
+    match k:
+        case ["l_cont", [k_arg], k_body] | LCont(k_arg, k_body):
+            return k_arg, k_body
+    raise NotImplementedError(k)
+
+
+def F(exp, k, typed=False, loop=None):
+    """CPS-convert exp with continuation k.
+
+    With typed=True the result is built from the slotted node classes above
+    instead of lists; k may then also be an LCont. loop is set by V for a
+    named procedure."""
     if isinstance(exp, list) and exp[0] == "+":
         assert all(is_trivial(arg) for arg in exp[1:]), "Arguments must be trivial"
     if isinstance(k, list):
         assert k[0] == "l_cont"
     else:
-        assert isinstance(k, str)
+        assert isinstance(k, (str, LCont))
     match exp:
         case int(_) | str(_) | ["+", *_] if isinstance(k, str):
-            if k[0] == "$":
-                # Letrec-bound jmp continuation
-                return jmp(k, exp)
-            return ["$call-cont", k, exp]
+            return CallCont(k, exp) if typed else ["$call-cont", k, exp]
         case int(_) | str(_) | ["+", *_]:
-            _, [k_arg], k_body = k
-            return ["let", [[k_arg, exp]], k_body]
+            k_arg, k_body = _unpack_l_cont(k)
+            return Let(k_arg, exp, k_body) if typed else ["let", [[k_arg, exp]], k_body]
         case ["let", [[x, value]], body]:
             # The paper just has a lambda, which is shorthand or a typo. The
             # continuation argument to F can only be a variable or l_cont.
-            return F(value, ["l_cont", x, F(body, k)])
+            # Binding the procedure's name hides it from the body.
+            body_loop = None if loop is not None and x == loop.name else loop
+            if typed:
+                return F(value, LCont(x, F(body, k, typed, body_loop)), typed)
+            return F(value, ["l_cont", [x], F(body, k, loop=body_loop)])
         case ["if", test, conseq, alt] if isinstance(k, str):
-            return ["if", test, F(conseq, k), F(alt, k)]
+            if typed:
+                return If(test, F(conseq, k, typed, loop), F(alt, k, typed, loop))
+            return ["if", test, F(conseq, k, loop=loop), F(alt, k, loop=loop)]
         case ["if", test, conseq, alt]:
-            _, [k_arg], k_body = k
-            # $ indicates that it's bound by letrec, which is a terrible way to
-            # do this, but I want to keep the function looking as similar to
-            # Kelsey's paper as possible (for now). This is needed for the
-            # function call case, which has two cases: 1) letrec-bound conts
-            # and 2) other conts.
-            kvar = gensym("$k")
-            return ["letrec", [[kvar, ["l_jump", [k_arg], k_body]]],
+            k_arg, k_body = _unpack_l_cont(k)
+            # Bind the join as an ordinary l_cont; promote_jumps finds that it
+            # does not escape and makes it an l_jump before G runs.
+            kvar = gensym("k")
+            if typed:
+                return Letrec([(kvar, LCont(k_arg, k_body))],
+                              If(test, F(conseq, kvar, typed), F(alt, kvar, typed)))
+            return ["letrec", [[kvar, ["l_cont", [k_arg], k_body]]],
                     ["if", test, F(conseq, kvar), F(alt, kvar)]]
-        case [fn, *args] if isinstance(k, str) and k[0] == "$":
-            # Letrec-bound jmp continuation
-            assert is_trivial(fn), "Function must be trivial"
+        case [fn, *args] if loop is not None and fn == loop.name and k == loop.k:
+            # Self tail call
             assert all(is_trivial(arg) for arg in args), "Arguments must be trivial"
-            return jmp(k, exp)
+            if loop.label is None:
+                loop.label = gensym("$loop")
+            return Jmp(loop.label, args) if typed else ["$jmp", loop.label, *args]
         case [fn, *args]:
             assert is_trivial(fn), "Function must be trivial"
             assert all(is_trivial(arg) for arg in args), "Arguments must be trivial"
-            return [fn, *args, k]
+            return App(fn, args, k) if typed else [fn, *args, k]
         case _:
             raise NotImplementedError(f"not implemented: {exp}")
 
 
+def to_nodes(cps):
+    """Convert a CPS term from F (or an l_proc from V) to the typed IR."""
+    match cps:
+        case int(_) | str(_):
+            return cps
+        case ["l_cont", [arg], body]:
+            return LCont(arg, to_nodes(body))
+        case ["l_proc", [*args], body]:
+            return LProc(args, to_nodes(body))
+        case ["l_jump", [*args], body]:
+            return LJump(args, to_nodes(body))
+        case ["let", [[x, value]], body]:
+            return Let(x, value, to_nodes(body))
+        case ["letrec", [*bindings], body]:
+            return Letrec([(name, to_nodes(lam)) for name, lam in bindings], to_nodes(body))
+        case ["if", test, conseq, alt]:
+            return If(test, to_nodes(conseq), to_nodes(alt))
+        case ["$call-cont", k, exp]:
+            return CallCont(k, exp)
+        case ["$jmp", k, *args]:
+            return Jmp(k, args)
+        case [fn, *args, k]:
+            return App(fn, args, to_nodes(k))
+    raise NotImplementedError(cps)
+
+
+def to_lists(cps):
+    match cps:
+        case int(_) | str(_):
+            return cps
+        case LCont(arg, body):
+            return ["l_cont", [arg], to_lists(body)]
+        case LProc(args, body):
+            return ["l_proc", [*args], to_lists(body)]
+        case LJump(args, body):
+            return ["l_jump", [*args], to_lists(body)]
+        case Let(x, value, body):
+            return ["let", [[x, value]], to_lists(body)]
+        case Letrec(bindings, body):
+            return ["letrec", [[name, to_lists(lam)] for name, lam in bindings], to_lists(body)]
+        case If(test, conseq, alt):
+            return ["if", test, to_lists(conseq), to_lists(alt)]
+        case CallCont(k, exp):
+            return ["$call-cont", k, exp]
+        case Jmp(k, args):
+            return ["$jmp", k, *args]
+        case App(fn, args, k):
+            return [fn, *args, to_lists(k)]
+    raise NotImplementedError(cps)
+
+
 class CPSConversionTests(UseGensym):
     def test_int(self):
         self.assertEqual(F(42, "k"), ["$call-cont", "k", 42])
@@ -210,18 +367,10 @@ class CPSConversionTests(UseGensym):
                           ["$call-cont", "k", 2],
                           ["$call-cont", "k", 3]])
         self.assertEqual(F(exp, ["l_cont", ["x"], "k_body"]),
-                         ["letrec", [["$k0", ["l_jump", ["x"], "k_body"]]],
+                         ["letrec", [["k0", ["l_cont", ["x"], "k_body"]]],
                           ["if", 1,
-                           ["let", [["v1", 2]],
-                            ["$jmp", "$k0", "v1"]],
-                           ["let", [["v2", 3]],
-                            ["$jmp", "$k0", "v2"]]]])
-
-    def test_app_letrec_cont(self):
-        exp = ["f", 1, 2]
-        self.assertEqual(F(exp, "$k0"),
-                         ["let", [["v0", ["f", 1, 2]]],
-                          ["$jmp", "$k0", "v0"]])
+                           ["$call-cont", "k0", 2],
+                           ["$call-cont", "k0", 3]]])
 
     def test_app_cont(self):
         exp = ["f", 1, 2]
@@ -233,12 +382,8 @@ class CPSConversionTests(UseGensym):
     def test_if_app(self):
         exp = ["if", 1, ["f", 2], ["g", 3]]
         self.assertEqual(F(exp, ["l_cont", ["x"], "k_body"]),
-                         ["letrec", [["$k0", ["l_jump", ["x"], "k_body"]]],
-                          ["if", 1,
-                           ["let", [["v1", ["f", 2]]],
-                            ["$jmp", "$k0", "v1"]],
-                           ["let", [["v2", ["g", 3]]],
-                            ["$jmp", "$k0", "v2"]]]])
+                         ["letrec", [["k0", ["l_cont", ["x"], "k_body"]]],
+                          ["if", 1, ["f", 2, "k0"], ["g", 3, "k0"]]])
 
     def test_lambda(self):
         exp = ["lambda", ["x"], ["+", "x", 1]]
@@ -246,6 +391,234 @@ class CPSConversionTests(UseGensym):
                          ["l_proc", ["x", "k0"],
                           ["$call-cont", "k0", ["+", "x", 1]]])
 
+    def test_let_multichar_name(self):
+        exp = ["let", [["x0", 42]], ["+", "x0", 1]]
+        self.assertEqual(F(exp, "k"),
+                         ["let", [["x0", 42]], ["$call-cont", "k", ["+", "x0", 1]]])
+
+
+class TypedCPSConversionTests(UseGensym):
+    def test_typed_matches_lists(self):
+        exps = [
+            (42, "k"),
+            (["let", [["x", 42]], ["+", "x", 1]], "k"),
+            (["if", 1, 2, 3], ["l_cont", ["x"], ["$call-cont", "k", "x"]]),
+            (["if", 1, ["f", 2], ["g", 3]], ["l_cont", ["x"], ["$call-cont", "k", "x"]]),
+            (["f", 1, 2], "k0"),
+            (["f", 1, 2], ["l_cont", ["x"], ["$call-cont", "k", "x"]]),
+        ]
+        for exp, k in exps:
+            with self.subTest(exp=exp):
+                self.setUp()
+                expected = F(exp, k)
+                self.setUp()
+                typed_k = to_nodes(k) if isinstance(k, list) else k
+                self.assertEqual(F(exp, typed_k, typed=True), to_nodes(expected))
+                self.assertEqual(to_lists(to_nodes(expected)), expected)
+
+    def test_typed_lambda(self):
+        self.assertEqual(V(["lambda", ["x"], ["+", "x", 1]], typed=True),
+                         LProc(["x", "k0"], CallCont("k0", ["+", "x", 1])))
+
+
+"""
+Continuation escape analysis:
+
+F binds the join point of an if that is not in tail position with letrec, as
+an ordinary l_cont that both arms apply or return to, and a CPS term from
+elsewhere may bind continuations the same way:
+
+    (letrec ((j (l_cont (x) M'))) M')
+
+Such a continuation escapes if its name is used as a value (passed as an
+ordinary argument, bound by let, returned) or is referred to from inside an
+l_proc, whose body runs in another procedure's frame. Otherwise every use of
+j is either (j E) or a call that returns to j, so promote_jumps makes it an
+l_jump: ($call-cont j E) becomes a jump, and (f E* j) binds the call's result
+and jumps. An l_cont applied on the spot, ($call-cont (l_cont (x) M') E),
+becomes a let. G then lowers the promoted continuations to blocks and
+escaping ones are left for a backend that can allocate them.
+"""
+
+
+def escaping_conts(cps):
+    """Return the names of the letrec-bound l_conts in cps that escape."""
+    # Name -> the l_proc (by number) whose body binds it.
+    owner = {}
+    escaped = set()
+    procs = itertools.count(1)
+
+    def value(exp, proc):
+        match exp:
+            case str(_):
+                if exp in owner:
+                    escaped.add(exp)
+            case [_, *args]:
+                for arg in args:
+                    value(arg, proc)
+
+    def cont(k, proc):
+        if isinstance(k, str):
+            if k in owner and owner[k] != proc:
+                escaped.add(k)
+        else:
+            walk(k, proc)
+
+    def walk(exp, proc):
+        match exp:
+            case ["l_cont", [_], body] | LCont(_, body) | ["l_jump", [*_], body] | LJump(_, body):
+                walk(body, proc)
+            case ["l_proc", [*_], body] | LProc(_, body):
+                walk(body, next(procs))
+            case ["let", [[_, v]], body] | Let(_, v, body):
+                value(v, proc)
+                walk(body, proc)
+            case ["letrec", [*bindings], body] | Letrec(bindings, body):
+                for name, lam in bindings:
+                    match lam:
+                        case ["l_cont", *_] | LCont():
+                            owner[name] = proc
+                for _, lam in bindings:
+                    walk(lam, proc)
+                walk(body, proc)
+            case ["if", test, conseq, alt] | If(test, conseq, alt):
+                value(test, proc)
+                walk(conseq, proc)
+                walk(alt, proc)
+            case ["$call-cont", k, v] | CallCont(k, v):
+                cont(k, proc)
+                value(v, proc)
+            case ["$jmp", _, *args] | Jmp(_, args):
+                for arg in args:
+                    value(arg, proc)
+            case [fn, *args, k] | App(fn, args, k):
+                value(fn, proc)
+                for arg in args:
+                    value(arg, proc)
+                cont(k, proc)
+            case _:
+                raise NotImplementedError(exp)
+
+    walk(cps, 0)
+    return escaped
+
+
+def promote_jumps(cps):
+    """Turn the letrec-bound l_conts of cps that do not escape into l_jumps
+    (see above). Works on lists or typed nodes and returns the same kind."""
+    typed = not isinstance(cps, list)
+    escaped = escaping_conts(cps)
+    jumps = set()
+
+    def promote(exp):
+        match exp:
+            case ["l_cont", [x], body]:
+                return ["l_cont", [x], promote(body)]
+            case LCont(x, body):
+                return LCont(x, promote(body))
+            case ["l_proc", [*args], body]:
+                return ["l_proc", args, promote(body)]
+            case LProc(args, body):
+                return LProc(args, promote(body))
+            case ["l_jump", [*args], body]:
+                return ["l_jump", args, promote(body)]
+            case LJump(args, body):
+                return LJump(args, promote(body))
+            case ["let", [[x, v]], body]:
+                return ["let", [[x, v]], promote(body)]
+            case Let(x, v, body):
+                return Let(x, v, promote(body))
+            case ["letrec", [*bindings], body] | Letrec(bindings, body):
+                new = []
+                for name, lam in bindings:
+                    match lam:
+                        case ["l_cont", [x], lam_body] | LCont(x, lam_body) if name not in escaped:
+                            jumps.add(name)
+                            lam = LJump([x], lam_body) if typed else ["l_jump", [x], lam_body]
+                    new.append((name, lam))
+                new = [(name, promote(lam)) for name, lam in new]
+                if typed:
+                    return Letrec(new, promote(body))
+                return ["letrec", [[name, lam] for name, lam in new], promote(body)]
+            case ["if", test, conseq, alt]:
+                return ["if", test, promote(conseq), promote(alt)]
+            case If(test, conseq, alt):
+                return If(test, promote(conseq), promote(alt))
+            case ["$call-cont", ["l_cont", [x], body], v]:
+                return ["let", [[x, v]], promote(body)]
+            case CallCont(LCont(x, body), v):
+                return Let(x, v, promote(body))
+            case ["$call-cont", str(k), v] | CallCont(str(k), v) if k in jumps:
+                return jmp(k, v, typed)
+            case ["$call-cont", k, v]:
+                return ["$call-cont", promote(k), v]
+            case CallCont(k, v):
+                return CallCont(promote(k), v)
+            case ["$jmp", *_] | Jmp():
+                return exp
+            case [fn, *args, str(k)] | App(fn, args, str(k)) if k in jumps:
+                return jmp(k, [fn, *args], typed)
+            case [fn, *args, k]:
+                return [fn, *args, promote(k)]
+            case App(fn, args, k):
+                return App(fn, args, promote(k))
+            case str(_):
+                return exp
+        raise NotImplementedError(exp)
+
+    return promote(cps)
+
+
+class PromoteJumpsTests(UseGensym):
+    # The join of (if p (f 1) 2), written as a letrec-bound l_cont.
+    JOIN = ["letrec", [["j", ["l_cont", ["x"], ["$call-cont", "k", ["+", "x", 1]]]]],
+            ["if", "p", ["f", 1, "j"], ["$call-cont", "j", 2]]]
+
+    def test_promote(self):
+        self.assertEqual(escaping_conts(self.JOIN), set())
+        self.assertEqual(promote_jumps(self.JOIN),
+                         ["letrec", [["j", ["l_jump", ["x"], ["$call-cont", "k", ["+", "x", 1]]]]],
+                          ["if", "p",
+                           ["let", [["v0", ["f", 1]]], ["$jmp", "j", "v0"]],
+                           ["let", [["v1", 2]], ["$jmp", "j", "v1"]]]])
+
+    def test_matches_f(self):
+        cps = F(["if", "p", ["f", 1], 2], ["l_cont", ["x"], ["$call-cont", "k", ["+", "x", 1]]])
+        self.assertEqual(repr(cps).replace("'k0'", "'j'"), repr(self.JOIN))
+
+    def test_typed(self):
+        typed = promote_jumps(to_nodes(self.JOIN))
+        self.setUp()
+        self.assertEqual(typed, to_nodes(promote_jumps(self.JOIN)))
+
+    def test_passed_as_value(self):
+        cps = ["letrec", [["j", ["l_cont", ["x"], ["$call-cont", "k", "x"]]]],
+               ["call-with-cont", "j", "k"]]
+        self.assertEqual(escaping_conts(cps), {"j"})
+        self.assertEqual(promote_jumps(cps), cps)
+
+    def test_used_by_inner_procedure(self):
+        inner = ["l_proc", ["y", "k1"], ["$call-cont", "j", "y"]]
+        cps = ["letrec", [["j", ["l_cont", ["x"], ["$call-cont", "k", "x"]]], ["g", inner]],
+               ["g", 1, "j"]]
+        self.assertEqual(escaping_conts(cps), {"j"})
+        self.assertEqual(promote_jumps(cps), cps)
+
+    def test_applied_on_the_spot(self):
+        cps = ["$call-cont", ["l_cont", ["x"], ["$call-cont", "k", ["+", "x", 1]]], 41]
+        self.assertEqual(promote_jumps(cps),
+                         ["let", [["x", 41]], ["$call-cont", "k", ["+", "x", 1]]])
+        self.assertEqual(G(cps), [["x", "<-", 41], ["return", ["+", "x", 1]]])
+
+    def test_f_joins_become_blocks(self):
+        cps = F(["let", [["a", ["if", "p", ["f", 1], 2]]], ["g", "a"]], "k")
+        self.assertEqual(cps[1], [["k0", ["l_cont", ["a"], ["g", "a", "k"]]]])
+        self.assertEqual(escaping_conts(cps), set())
+        self.assertEqual(promote_jumps(cps)[1], [["k0", ["l_jump", ["a"], ["g", "a", "k"]]]])
+        blocks = Gblocks(cps)
+        self.assertEqual(list(blocks), ["k0", "entry"])
+        self.assertEqual(blocks["k0"][0][:3], ["a", "<-", "phi"])
+
 
 """
 SSA grammar:
@@ -264,27 +637,60 @@ where x are variables, l are labels
 The l_jump's in the program are ignored when found by G. Each l_jump is instead
 lifted up to become a labeled block in the SSA procedure. The arguments to the
 l_jump's, which are also ignored by G, become the arguments to the phi function
-that defines the value of the corresponding variable in the SSA program.
+that defines the value of the corresponding variable in the SSA program: one
+phi per parameter, the i-th taking the i-th argument of every jump.
 """
 
 
 # TODO(max): Collect the l_jump and their arguments and lift to blocks
 
 
+@dataclass(slots=True)
+class Assign:
+    x: str
+    value: object
+
+
+@dataclass(slots=True)
+class Phi:
+    x: str
+    inputs: list
+
+
+@dataclass(slots=True)
+class Return:
+    value: object
+
+
+@dataclass(slots=True)
+class Goto:
+    label: str
+
+
+@dataclass(slots=True)
+class Branch:
+    test: object
+    conseq: list
+    alt: list
+
+
 class C:
     def __init__(self):
         self.blocks = {}
         self.block = "entry"
         self.jumps = {}
 
-    def phi(self, to):
-        phi = self.jumps.get(to)
-        if phi is None:
-            phi = self.jumps[to] = []
-        return phi
+    def phi(self, to, i=0):
+        phis = self.jumps.get(to)
+        if phis is None:
+            phis = self.jumps[to] = []
+        while len(phis) <= i:
+            phis.append([])
+        return phis[i]
 
-    def jmp(self, to, arg):
-        self.phi(to).append((self.block, arg))
+    def jmp(self, to, args):
+        for i, arg in enumerate(args):
+            self.phi(to, i).append((self.block, arg))
 
     def G(self, cps) -> list:
         match cps:
@@ -292,53 +698,121 @@ class C:
                 return [[x, "<-", value], *self.G(body)]
             case ["$call-cont", k, exp]:
                 return [["return", exp]]
-            case ["$jmp", k, exp]:
-                assert isinstance(exp, str)
-                self.jmp(k, exp)
+            case ["$jmp", k, *args]:
+                assert all(is_trivial(arg) for arg in args)
+                self.jmp(k, args)
                 return [["goto", k]]
             case ["if", test, conseq, alt]:
                 return [["if", test, self.G(conseq), self.G(alt)]]
-            case ["letrec", [*lams], body]:
+            case ["letrec", [*lams], body] | Letrec(lams, body):
                 prev_block = self.block
                 for name, lam in lams:
                     self.block = name
                     self.blocks[name] = self.Gjump(name, lam)
                 self.block = prev_block
                 return self.G(body)
+            case [fn, *args, ["l_cont", [x], body]]:
+                return [[x, "<-", [fn, *args]], *self.G(body)]
+            case [fn, *args, str(k)]:
+                # A tail call returns the callee's result directly.
+                return [["return", [fn, *args]]]
+            case Let(x, value, body):
+                return [Assign(x, value), *self.G(body)]
+            case CallCont(k, exp):
+                return [Return(exp)]
+            case Jmp(k, args):
+                assert all(is_trivial(arg) for arg in args)
+                self.jmp(k, args)
+                return [Goto(k)]
+            case If(test, conseq, alt):
+                return [Branch(test, self.G(conseq), self.G(alt))]
+            case App(fn, args, LCont(x, body)):
+                return [Assign(x, [fn, *args]), *self.G(body)]
+            case App(fn, args, str(k)):
+                return [Return([fn, *args])]
             case _:
                 raise NotImplementedError(f"not implemented: {cps}")
 
     def Gjump(self, name, lam):
-        assert lam[0] == "l_jump"
-        _, [x], body = lam
-        return [
-            [x, "<-", "phi", self.phi(name)],
-            *self.G(body),
-        ]
+        match lam:
+            case ["l_jump", [*xs], body]:
+                return [
+                    *[[x, "<-", "phi", self.phi(name, i)] for i, x in enumerate(xs)],
+                    *self.G(body),
+                ]
+            case LJump([*xs], body):
+                return [*[Phi(x, self.phi(name, i)) for i, x in enumerate(xs)], *self.G(body)]
+        raise NotImplementedError(lam)
+
+
+def ssa_to_nodes(stmts):
+    """Convert a list of SSA statements from G to the typed IR."""
+    result = []
+    for stmt in stmts:
+        match stmt:
+            case [x, "<-", "phi", inputs]:
+                result.append(Phi(x, inputs))
+            case [x, "<-", value]:
+                result.append(Assign(x, value))
+            case ["return", value]:
+                result.append(Return(value))
+            case ["goto", label]:
+                result.append(Goto(label))
+            case ["if", test, conseq, alt]:
+                result.append(Branch(test, ssa_to_nodes(conseq), ssa_to_nodes(alt)))
+            case _:
+                raise NotImplementedError(stmt)
+    return result
+
+
+def ssa_to_lists(stmts):
+    result = []
+    for stmt in stmts:
+        match stmt:
+            case Phi(x, inputs):
+                result.append([x, "<-", "phi", inputs])
+            case Assign(x, value):
+                result.append([x, "<-", value])
+            case Return(value):
+                result.append(["return", value])
+            case Goto(label):
+                result.append(["goto", label])
+            case Branch(test, conseq, alt):
+                result.append(["if", test, ssa_to_lists(conseq), ssa_to_lists(alt)])
+            case _:
+                raise NotImplementedError(stmt)
+    return result
 
 
 def G(cps):
     c = C()
-    return c.G(cps)
+    return c.G(promote_jumps(cps))
 
 
-def Gblocks(cps):
+def Gblocks(cps, cfg=False):
+    """Convert cps to a dict of SSA blocks by label, or with cfg=True to a
+    CFG of basic blocks."""
     c = C()
-    entry = c.G(cps)
+    entry = c.G(promote_jumps(cps))
     c.blocks["entry"] = entry
+    if cfg:
+        return CFG.from_blocks(c.blocks)
     return c.blocks
 
 
 def Gproc(cps):
+    """Convert an l_proc to ["proc", args, entry, [label, stmts]...], with one
+    [label, stmts] pair per block lifted from an l_jump."""
     match cps:
-        case ["l_proc", [*args], body]:
-            # TODO(max): Gjump(...) ???
-            return ["proc", args, G(body)]
+        case ["l_proc", [*args], body] | LProc(args, body):
+            c = C()
+            entry = c.G(promote_jumps(body))
+            return ["proc", args, entry, *[[label, stmts] for label, stmts in c.blocks.items()]]
         case _:
             raise TypeError(f"not a procedure: {cps}")
 
 
-class SSAConversionTests(unittest.TestCase):
+class SSAConversionTests(UseGensym):
     def test_let(self):
         cps = ["let", [["x", 42]], ["$call-cont", "k", ["+", "x", 1]]]
         self.assertEqual(G(cps), [
@@ -360,23 +834,40 @@ class SSAConversionTests(unittest.TestCase):
         self.assertEqual(G(cps),
                              [["if", 1,
                               [["v1", "<-", ["f", 2]],
-                               ["goto", "$k0"]],
+                               ["goto", "k0"]],
                               [["v2", "<-", ["g", 3]],
-                               ["goto", "$k0"]]]])
+                               ["goto", "k0"]]]])
+        self.setUp()
         self.assertEqual(Gblocks(cps),
-                         {"$k0": [
-                             ["x", "<-", "phi", [("entry", "v1"), ("entry", "v2")]],
+                         {"k0": [
+                             ["x", "<-", "phi", [("entry", "v0"), ("entry", "v1")]],
                              ["return", "x"]],
                           "entry": [
                               ["if", 1, [
-                                  ["v1", "<-", ["f", 2]],
-                                  ["goto", "$k0"],
+                                  ["v0", "<-", ["f", 2]],
+                                  ["goto", "k0"],
                               ], [
-                                  ["v2", "<-", ["g", 3]],
-                                  ["goto", "$k0"],
+                                  ["v1", "<-", ["g", 3]],
+                                  ["goto", "k0"],
                               ]]]}
                          )
 
+    def test_typed(self):
+        cps = F(["if", 1, ["f", 2], ["g", 3]], ["l_cont", ["x"], ["$call-cont",
+                                                                  "$halt", "x"]])
+        # promote_jumps names the jumps' arguments, so give both runs the
+        # same names.
+        with name_supply():
+            blocks = Gblocks(cps)
+        with name_supply():
+            typed_blocks = Gblocks(to_nodes(cps))
+        self.assertEqual(typed_blocks, {label: ssa_to_nodes(stmts)
+                                        for label, stmts in blocks.items()})
+        [join] = [label for label in typed_blocks if label != "entry"]
+        self.assertIsInstance(typed_blocks[join][0], Phi)
+        for label, stmts in typed_blocks.items():
+            self.assertEqual(ssa_to_lists(stmts), blocks[label])
+
     def test_lambda(self):
         cps = ["l_proc", ["x", "k0"], ["$call-cont", "k0", ["+", "x", 1]]]
         self.assertEqual(Gproc(cps),
@@ -384,8 +875,543 @@ class SSAConversionTests(unittest.TestCase):
                              ["return", ["+", "x", 1]],
                          ]])
 
+    def test_lambda_blocks(self):
+        cps = V(["lambda", ["x"], ["let", [["y", ["if", "x", 1, 2]]], ["+", "y", 1]]])
+        self.assertEqual(Gproc(cps),
+                         ["proc", ["x", "k0"],
+                          [["if", "x", [["v2", "<-", 1], ["goto", "k1"]],
+                                       [["v3", "<-", 2], ["goto", "k1"]]]],
+                          ["k1", [["y", "<-", "phi", [("entry", "v2"), ("entry", "v3")]],
+                                   ["return", ["+", "y", 1]]]]])
+
+    def test_app(self):
+        cps = F(["let", [["x", ["f", 1]]], ["g", "x"]], "k")
+        self.assertEqual(G(cps), [["x", "<-", ["f", 1]], ["return", ["g", "x"]]])
+        self.assertEqual(G(to_nodes(cps)), ssa_to_nodes(G(cps)))
+
+    def test_self_tail_call(self):
+        lam = ["lambda", ["n", "acc"],
+               ["if", ["=", "n", 0], "acc",
+                ["let", [["m", ["-", "n", 1]]],
+                 ["let", [["a", ["+", "acc", "n"]]],
+                  ["sum", "m", "a"]]]]]
+        self.assertEqual(Gproc(V(lam, name="sum")),
+                         ["proc", ["n2", "acc3", "k0"],
+                          [["goto", "$loop1"]],
+                          ["$loop1", [["n", "<-", "phi", [("$loop1", "m"), ("entry", "n2")]],
+                                      ["acc", "<-", "phi", [("$loop1", "a"), ("entry", "acc3")]],
+                                      ["if", ["=", "n", 0],
+                                       [["return", "acc"]],
+                                       [["m", "<-", ["-", "n", 1]],
+                                        ["a", "<-", ["+", "acc", "n"]],
+                                        ["goto", "$loop1"]]]]]])
+        self.setUp()
+        typed = to_lists(V(lam, typed=True, name="sum"))
+        self.setUp()
+        self.assertEqual(typed, V(lam, name="sum"))
+        self.setUp()
+        cfg = CFG.from_proc(Gproc(V(lam, name="sum")))
+        [header] = cfg[0].succs
+        [latch] = [pred for pred in cfg[header].preds if pred != 0]
+        self.assertTrue(cfg.dominates(header, latch))
+        self.assertEqual(cfg.run({param: value for param, value in zip(cfg.params, [100_000, 0])})[0],
+                         100_000 * 100_001 // 2)
+
+    def test_non_tail_self_call(self):
+        lam = ["lambda", ["n"],
+               ["if", "n", ["let", [["m", ["-", "n", 1]]],
+                            ["let", [["s", ["total", "m"]]], ["+", "s", "n"]]], 0]]
+        expected = V(lam)
+        self.setUp()
+        self.assertEqual(V(lam, name="total"), expected)
+        # A let binding the name hides the procedure.
+        shadowed = ["lambda", ["n"], ["let", [["f", ["g", "n"]]], ["f", "n"]]]
+        self.setUp()
+        expected = V(shadowed)
+        self.setUp()
+        self.assertEqual(V(shadowed, name="f"), expected)
+
+
+"""
+Out of SSA:
+
+A phi at the head of block L takes its i-th input from the i-th goto to L
+(in statement order) in the predecessor block that input names. Leaving SSA
+replaces each such goto with copies of the inputs into the phi variables
+followed by the goto. All the phis of a block read their inputs at once, so
+the copies are a parallel assignment; parallel_moves orders them so that no
+copy overwrites a value a later one still reads, breaking cycles (such as a
+swap) with a temporary.
+"""
+
+
+def parallel_moves(moves, tmp):
+    """Sequentialize the parallel assignment [(dst, src), ...].
+
+    Sources are variables or constants. Returns (dst, src) pairs to run in
+    order, using the variable tmp to break cycles."""
+    moves = [(dst, src) for dst, src in moves if dst != src]
+    result = []
+    while moves:
+        read = {src for _, src in moves if isinstance(src, str)}
+        for i, (dst, src) in enumerate(moves):
+            if dst not in read:
+                result.append((dst, src))
+                del moves[i]
+                break
+        else:
+            # Every destination is still read by another move, so the moves
+            # form cycles. Save one destination and read the copy instead.
+            dst = moves[0][0]
+            result.append((tmp, dst))
+            moves = [(d, tmp if s == dst else s) for d, s in moves]
+    return result
+
+
+def out_of_ssa(blocks):
+    """Replace the phis in blocks ({label: stmts}, as from Gblocks or the
+    blocks of Gproc) with copies before the gotos that feed them."""
+    blocks = {label: ssa_to_lists(stmts) if stmts and not isinstance(stmts[0], list) else stmts
+              for label, stmts in blocks.items()}
+    phis = {}
+    for label, stmts in blocks.items():
+        phis[label] = [stmt for stmt in stmts if stmt[2:3] == ["phi"]]
+    tmp = None
+
+    def lower(stmts, pred, seen):
+        nonlocal tmp
+        result = []
+        for stmt in stmts:
+            match stmt:
+                case [_, "<-", "phi", _]:
+                    pass
+                case ["goto", label]:
+                    n = seen[label]
+                    seen[label] += 1
+                    moves = []
+                    for x, _, _, inputs in phis.get(label, ()):
+                        args = [arg for p, arg in inputs if p == pred]
+                        moves.append((x, args[n]))
+                    if len(moves) > 1 and tmp is None:
+                        tmp = gensym("t")
+                    for dst, src in parallel_moves(moves, tmp):
+                        result.append([dst, "<-", src])
+                    result.append(stmt)
+                case ["if", test, conseq, alt]:
+                    result.append(["if", test, lower(conseq, pred, seen), lower(alt, pred, seen)])
+                case _:
+                    result.append(stmt)
+        return result
+
+    return {label: lower(stmts, label, Counter()) for label, stmts in blocks.items()}
+
+
+def assigned(stmts):
+    """Yield the names stmts (a block of out_of_ssa's output) assigns,
+    including those assigned in the arms of an if."""
+    for stmt in stmts:
+        match stmt:
+            case [x, "<-", _]:
+                yield x
+            case ["if", _, conseq, alt]:
+                yield from assigned(conseq)
+                yield from assigned(alt)
+
+
+# Source procedures the backends' and the allocator's tests share.
+FIB = ["lambda", ["n"],
+       ["if", ["<", "n", 2], "n",
+        ["let", [["n1", ["-", "n", 1]]],
+         ["let", [["a", ["fib", "n1"]]],
+          ["let", [["n2", ["-", "n", 2]]],
+           ["let", [["b", ["fib", "n2"]]],
+            ["+", "a", "b"]]]]]]]
+
+ABS_PLUS = ["lambda", ["x", "y"],
+            ["let", [["z", ["if", ["<", "x", 0], ["-", 0, "x"], "x"]]],
+             ["+", "z", "y"]]]
+
+# 0 + 1 + ... + n, by a self tail call.
+TOTAL = ["lambda", ["n", "acc"],
+         ["if", "n", ["let", [["m", ["-", "n", 1]]],
+                      ["let", [["a", ["+", "acc", "n"]]], ["total", "m", "a"]]], "acc"]]
+
+
+class OutOfSSATests(UseGensym):
+    def _run_moves(self, moves, env):
+        env = dict(env)
+        for dst, src in parallel_moves(moves, "tmp"):
+            env[dst] = env[src] if isinstance(src, str) else src
+        env.pop("tmp", None)
+        return env
+
+    def test_parallel_moves(self):
+        self.assertEqual(parallel_moves([("a", "b"), ("b", "c")], "t"), [("a", "b"), ("b", "c")])
+        self.assertEqual(parallel_moves([("b", "c"), ("a", "b")], "t"), [("a", "b"), ("b", "c")])
+        self.assertEqual(parallel_moves([("a", "b"), ("b", "a")], "t"),
+                         [("t", "a"), ("a", "b"), ("b", "t")])
+        self.assertEqual(parallel_moves([("a", "a"), ("b", 1)], "t"), [("b", 1)])
+
+    def test_parallel_moves_permutations(self):
+        names = ["a", "b", "c", "d"]
+        env = {name: i for i, name in enumerate(names)}
+        for perm in itertools.permutations(names):
+            moves = list(zip(names, perm)) + [("e", "a")]
+            expected = {**env, **{dst: env[src] for dst, src in moves}}
+            with self.subTest(perm=perm):
+                self.assertEqual(self._run_moves(moves, {**env, "e": None}), expected)
+
+    def test_out_of_ssa(self):
+        cps = F(["if", 1, ["f", 2], ["g", 3]], ["l_cont", ["x"], ["$call-cont", "$halt", "x"]])
+        self.assertEqual(out_of_ssa(Gblocks(cps)),
+                         {"k0": [["return", "x"]],
+                          "entry": [["if", 1,
+                                     [["v1", "<-", ["f", 2]], ["x", "<-", "v1"], ["goto", "k0"]],
+                                     [["v2", "<-", ["g", 3]], ["x", "<-", "v2"], ["goto", "k0"]]]]})
+        with name_supply():
+            typed = out_of_ssa(Gblocks(to_nodes(cps)))
+        with name_supply():
+            self.assertEqual(typed, out_of_ssa(Gblocks(cps)))
 
-# TODO(max): Convert out of SSA with parallel assignments and emit C
+
+"""
+Control-flow graph:
+
+CFG.from_blocks splits the labeled blocks of G into basic blocks numbered from
+0 (the entry). An if ends its basic block with ["br", test, then, else] and
+each arm starts a new unlabeled block; a goto becomes ["goto", block]. Each
+block keeps its phis, its straight-line assignments and its terminator
+separately. Phi inputs are re-keyed by predecessor block ID and listed in the
+order of the block's preds, so the i-th input of every phi comes from preds[i].
+"""
+
+
+# Integer operators the backends implement; comparisons produce 0 or 1.
+PURE_OPS = {
+    "+": operator.add, "-": operator.sub, "*": operator.mul,
+    "<": lambda x, y: int(x < y), "<=": lambda x, y: int(x <= y),
+    ">": lambda x, y: int(x > y), ">=": lambda x, y: int(x >= y),
+    "=": lambda x, y: int(x == y), "!=": lambda x, y: int(x != y),
+}
+
+
+@dataclass(slots=True)
+class Block:
+    id: int
+    label: object
+    phis: list
+    body: list
+    term: list
+    preds: list
+    succs: list
+
+
+class CFG:
+    def __init__(self, blocks, params=()):
+        self.blocks = blocks
+        self.params = list(params)
+        self._cache = {}
+
+    @classmethod
+    def from_blocks(cls, blocks, params=()):
+        """Build a CFG from {label: stmts} as produced by Gblocks (lists or
+        typed nodes); "entry" becomes block 0."""
+        blocks = {label: ssa_to_lists(stmts) if stmts and not isinstance(stmts[0], list) else stmts
+                  for label, stmts in blocks.items()}
+        labels = ["entry", *(label for label in blocks if label != "entry")]
+        result = [Block(i, label, [], [], None, [], []) for i, label in enumerate(labels)]
+        ids = {label: i for i, label in enumerate(labels)}
+        # (pred label, target label) -> IDs of the blocks that jump, in order.
+        sources = {}
+
+        def build(block, stmts, label):
+            for stmt in stmts:
+                match stmt:
+                    case [x, "<-", "phi", inputs]:
+                        block.phis.append([x, "<-", "phi", inputs])
+                    case [_, "<-", _]:
+                        block.body.append(stmt)
+                    case ["return", _]:
+                        block.term = stmt
+                        return
+                    case ["goto", target]:
+                        block.term = ["goto", ids[target]]
+                        sources.setdefault((label, target), []).append(block.id)
+                        return
+                    case ["if", test, conseq, alt]:
+                        arms = []
+                        for arm in conseq, alt:
+                            new = Block(len(result), None, [], [], None, [], [])
+                            result.append(new)
+                            arms.append(new)
+                        block.term = ["br", test, arms[0].id, arms[1].id]
+                        build(arms[0], conseq, label)
+                        build(arms[1], alt, label)
+                        return
+                    case _:
+                        raise NotImplementedError(stmt)
+            raise ValueError(f"block {label} does not end in a jump or return")
+
+        for label in labels:
+            build(result[ids[label]], blocks[label], label)
+        for block in result:
+            match block.term:
+                case ["goto", target]:
+                    block.succs = [target]
+                case ["br", _, then, else_]:
+                    block.succs = [then, else_]
+        for block in result:
+            if block.phis:
+                # Pair each input with the goto that supplies it: the n-th
+                # input from label P comes from the n-th goto in P.
+                seen = Counter()
+                preds = []
+                for pred_label, _ in block.phis[0][3]:
+                    preds.append(sources[(pred_label, block.label)][seen[pred_label]])
+                    seen[pred_label] += 1
+                for phi in block.phis:
+                    phi[3] = [(pred, arg) for pred, (_, arg) in zip(preds, phi[3])]
+                block.preds = preds
+        for block in result:
+            for succ in block.succs:
+                if not result[succ].phis:
+                    result[succ].preds.append(block.id)
+        return cls(result, params)
+
+    @classmethod
+    def from_proc(cls, proc):
+        """Build a CFG from a Gproc result; params excludes the continuation."""
+        _, params, entry, *blocks = proc
+        return cls.from_blocks({"entry": entry, **{label: stmts for label, stmts in blocks}},
+                               params[:-1])
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def __getitem__(self, id):
+        return self.blocks[id]
+
+    def invalidate(self):
+        """Forget the cached orders and dominators after editing the graph."""
+        self._cache.clear()
+
+    @property
+    def rpo(self):
+        """Block IDs reachable from the entry, in reverse postorder."""
+        if "rpo" not in self._cache:
+            order = []
+            visited = {0}
+            stack = [(0, iter(self.blocks[0].succs))]
+            while stack:
+                node, succs = stack[-1]
+                for succ in succs:
+                    if succ not in visited:
+                        visited.add(succ)
+                        stack.append((succ, iter(self.blocks[succ].succs)))
+                        break
+                else:
+                    stack.pop()
+                    order.append(node)
+            order.reverse()
+            self._cache["rpo"] = order
+        return self._cache["rpo"]
+
+    @property
+    def idom(self):
+        """{block ID: immediate dominator ID} for reachable blocks; the
+        entry is its own. Computed with the iterative algorithm of Cooper,
+        Harvey and Kennedy over the reverse postorder."""
+        if "idom" not in self._cache:
+            order = self.rpo
+            index = {b: i for i, b in enumerate(order)}
+            idom = {0: 0}
+
+            def intersect(a, b):
+                while a != b:
+                    while index[a] > index[b]:
+                        a = idom[a]
+                    while index[b] > index[a]:
+                        b = idom[b]
+                return a
+
+            changed = True
+            while changed:
+                changed = False
+                for b in order[1:]:
+                    new = None
+                    for p in self.blocks[b].preds:
+                        if p in idom:
+                            new = p if new is None else intersect(p, new)
+                    if idom.get(b) != new:
+                        idom[b] = new
+                        changed = True
+            self._cache["idom"] = idom
+        return self._cache["idom"]
+
+    @property
+    def dom_tree(self):
+        """{block ID: [IDs it immediately dominates]}, children in RPO."""
+        if "dom_tree" not in self._cache:
+            tree = {b: [] for b in self.rpo}
+            for b in self.rpo[1:]:
+                tree[self.idom[b]].append(b)
+            self._cache["dom_tree"] = tree
+        return self._cache["dom_tree"]
+
+    def run(self, env, hosts=None):
+        """Interpret the graph: a reference semantics for testing passes.
+
+        env maps the free variables (such as params) to ints; hosts maps the
+        names of called procedures to Python functions. Returns the value of
+        the return reached and the number of instructions executed."""
+        env = dict(env)
+        hosts = hosts or {}
+
+        def ev(exp):
+            match exp:
+                case int(_):
+                    return exp
+                case str(_):
+                    return env[exp]
+                case [op, x, y] if op in PURE_OPS:
+                    return PURE_OPS[op](ev(x), ev(y))
+                case [fn, *args]:
+                    return hosts[fn](*[ev(arg) for arg in args])
+            raise NotImplementedError(exp)
+
+        b, pred, count = 0, None, 0
+        while True:
+            block = self.blocks[b]
+            if block.phis:
+                i = block.preds.index(pred)
+                values = [ev(phi[3][i][1]) for phi in block.phis]
+                for phi, value in zip(block.phis, values):
+                    env[phi[0]] = value
+            for x, _, value in block.body:
+                env[x] = ev(value)
+            count += len(block.phis) + len(block.body) + 1
+            match block.term:
+                case ["return", value]:
+                    return ev(value), count
+                case ["goto", target]:
+                    b, pred = target, b
+                case ["br", test, then, else_]:
+                    b, pred = (then if ev(test) else else_), b
+
+    def instruction_count(self):
+        """Phis, assignments and terminators in the blocks reachable from the
+        entry."""
+        return sum(len(self.blocks[b].phis) + len(self.blocks[b].body) + 1 for b in self.rpo)
+
+    def dominates(self, a, b):
+        idom = self.idom
+        while b != a:
+            if b == 0:
+                return False
+            b = idom[b]
+        return True
+
+
+def gen_source(rng, size, depth=12, if_density=0.2):
+    """Generate a program in the restricted source grammar F accepts:
+    non-trivial expressions only in tail position or bound by let. F only
+    converts the body of a single procedure, so there are no lambdas."""
+    names = iter(range(1_000_000))
+
+    def trivial(scope):
+        if scope and rng.random() < 0.6:
+            return rng.choice(scope)
+        return rng.randrange(10)
+
+    def gen(size, depth, scope):
+        if size <= 1 or depth <= 0:
+            if rng.random() < 0.5:
+                return ["+", trivial(scope), trivial(scope)]
+            return trivial(scope)
+        half = max(1, size // 2)
+        if rng.random() < if_density:
+            return ["if", trivial(scope), gen(half, depth - 1, scope),
+                    gen(size - half, depth - 1, scope)]
+        x = f"x{next(names)}"
+        return ["let", [[x, gen(half, depth - 1, scope)]],
+                gen(size - half, depth - 1, scope + [x])]
+
+    return gen(size, depth, [])
+
+
+def check_preserves_run(test, transform):
+    """Check, with test's assertions, that transform (a pass from a CFG to a
+    new CFG) keeps the value run returns on generated procedures and runs no
+    more instructions."""
+    for seed in range(40):
+        source = gen_source(random.Random(seed), 60, if_density=0.4)
+        with test.subTest(seed=seed):
+            cfg = Gblocks(F(source, "k"), cfg=True)
+            new = transform(cfg)
+            value, count = cfg.run({})
+            new_value, new_count = new.run({})
+            test.assertEqual(new_value, value)
+            test.assertLessEqual(new_count, count)
+
+
+class CFGTests(UseGensym):
+    def test_gen_source_is_seeded(self):
+        self.assertEqual(gen_source(random.Random(3), 50), gen_source(random.Random(3), 50))
+
+    def test_if_app(self):
+        cps = F(["if", 1, ["f", 2], ["g", 3]], ["l_cont", ["x"], ["$call-cont", "$halt", "x"]])
+        cfg = Gblocks(cps, cfg=True)
+        self.assertEqual(cfg.blocks, [
+            Block(0, "entry", [], [], ["br", 1, 2, 3], [], [2, 3]),
+            Block(1, "k0", [["x", "<-", "phi", [(2, "v1"), (3, "v2")]]], [], ["return", "x"],
+                  [2, 3], []),
+            Block(2, None, [], [["v1", "<-", ["f", 2]]], ["goto", 1], [0], [1]),
+            Block(3, None, [], [["v2", "<-", ["g", 3]]], ["goto", 1], [0], [1]),
+        ])
+        self.assertEqual(cfg.rpo, [0, 3, 2, 1])
+        self.assertEqual(cfg.idom, {0: 0, 1: 0, 2: 0, 3: 0})
+        self.assertEqual(cfg.dom_tree, {0: [3, 2, 1], 1: [], 2: [], 3: []})
+        self.assertTrue(cfg.dominates(0, 1))
+        self.assertFalse(cfg.dominates(2, 1))
+        with name_supply():
+            typed = Gblocks(to_nodes(cps), cfg=True)
+        with name_supply():
+            self.assertEqual(typed.blocks, Gblocks(cps, cfg=True).blocks)
+
+    def test_nested(self):
+        source = ["let", [["a", ["if", "p", ["let", [["b", ["if", "q", 1, 2]]], ["+", "b", 1]], 3]]],
+                  ["+", "a", 1]]
+        cfg = Gblocks(F(source, "k"), cfg=True)
+        [outer] = [b for b in cfg.blocks if b.label is not None and b.phis and b.phis[0][0] == "a"]
+        [inner] = [b for b in cfg.blocks if b.label is not None and b.phis and b.phis[0][0] == "b"]
+        self.assertEqual(len(outer.preds), 2)
+        self.assertEqual(len(inner.preds), 2)
+        self.assertTrue(all(cfg.dominates(0, b) for b in cfg.rpo))
+        self.assertEqual(cfg.idom[outer.id], 0)
+        # The inner join is only reached through the then arm of the outer if.
+        then = cfg[0].succs[0]
+        self.assertEqual(cfg.idom[inner.id], then)
+        for block in cfg.blocks:
+            for succ in block.succs:
+                self.assertIn(block.id, cfg[succ].preds)
+            for phi in block.phis:
+                self.assertEqual([pred for pred, _ in phi[3]], block.preds)
+
+    def test_cached(self):
+        cfg = Gblocks(F(["if", 1, 2, 3], "k"), cfg=True)
+        self.assertIs(cfg.rpo, cfg.rpo)
+        cfg.invalidate()
+        self.assertEqual(cfg.rpo, [0, 2, 1])
+
+    def test_run(self):
+        cfg = Gblocks(F(["let", [["a", ["if", "p", ["f", 1], 2]]], ["+", "a", 1]], "k"), cfg=True)
+        self.assertEqual(cfg.run({"p": 1}, {"f": lambda x: x * 10}), (11, 5))
+        self.assertEqual(cfg.run({"p": 0}, {"f": lambda x: x * 10}), (3, 5))
+
+    def test_from_proc(self):
+        cfg = CFG.from_proc(Gproc(V(["lambda", ["x"], ["+", "x", 1]])))
+        self.assertEqual(cfg.params, ["x"])
+        self.assertEqual(cfg[0].term, ["return", ["+", "x", 1]])
 
 
 if __name__ == "__main__":
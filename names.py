@@ -0,0 +1,124 @@
+"""Fresh-name supply for the converters.
+
+gensym draws from the NameSupply installed in the current context. Wrap a
+compilation in name_supply() to give it its own counter: names are then
+deterministic per compilation, unbounded, and never interleave with a
+conversion running in another thread or task (each thread starts with its own
+context, and asyncio tasks copy theirs).
+"""
+
+import contextvars
+import itertools
+import sys
+import threading
+import unittest
+from contextlib import contextmanager
+
+
+_DIGITS = "0123456789abcdefghijklmnopqrstuvwxyz"
+
+
+def _base36(n):
+    digits = []
+    while True:
+        n, rem = divmod(n, 36)
+        digits.append(_DIGITS[rem])
+        if n == 0:
+            return "".join(reversed(digits))
+
+
+class NameSupply:
+    """An unbounded source of fresh names.
+
+    With compact=True, names keep only the first character of their stem (so
+    the "$" prefix kelsey uses survives) followed by the ID in base 36, and are
+    interned so that comparing two of them is a pointer comparison."""
+
+    __slots__ = ("_counter", "compact")
+
+    def __init__(self, compact=False):
+        self._counter = itertools.count()
+        self.compact = compact
+
+    def fresh(self):
+        """Return the next integer ID."""
+        return next(self._counter)
+
+    def gensym(self, stem="v"):
+        n = next(self._counter)
+        if self.compact:
+            return sys.intern(stem[:1] + _base36(n))
+        return f"{stem}{n}"
+
+
+NAME_SUPPLY = contextvars.ContextVar("NAME_SUPPLY")
+
+
+def current_supply():
+    try:
+        return NAME_SUPPLY.get()
+    except LookupError:
+        supply = NameSupply()
+        NAME_SUPPLY.set(supply)
+        return supply
+
+
+def gensym(stem="v"):
+    return current_supply().gensym(stem)
+
+
+@contextmanager
+def name_supply(supply=None):
+    """Run the body with its own name supply (a fresh one by default)."""
+    if supply is None:
+        supply = NameSupply()
+    token = NAME_SUPPLY.set(supply)
+    try:
+        yield supply
+    finally:
+        NAME_SUPPLY.reset(token)
+
+
+class NameSupplyTests(unittest.TestCase):
+    def test_unbounded(self):
+        with name_supply():
+            names = [gensym() for _ in range(5000)]
+        self.assertEqual(names[-1], "v4999")
+        self.assertEqual(len(set(names)), 5000)
+
+    def test_scoped(self):
+        with name_supply():
+            self.assertEqual(gensym("k"), "k0")
+            with name_supply():
+                self.assertEqual(gensym("k"), "k0")
+            self.assertEqual(gensym("k"), "k1")
+
+    def test_compact(self):
+        with name_supply(NameSupply(compact=True)):
+            self.assertEqual([gensym("$k") for _ in range(37)][-2:], ["$z", "$10"])
+            self.assertEqual(gensym("counter"), "c11")
+
+    def test_fresh(self):
+        supply = NameSupply()
+        self.assertEqual([supply.fresh(), supply.gensym(), supply.fresh()], [0, "v1", 2])
+
+    def test_threads_do_not_interleave(self):
+        results = {}
+        barrier = threading.Barrier(4)
+
+        def convert(i):
+            with name_supply():
+                barrier.wait()
+                results[i] = [gensym() for _ in range(2000)]
+
+        threads = [threading.Thread(target=convert, args=(i,)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        expected = [f"v{n}" for n in range(2000)]
+        self.assertEqual(results, {i: expected for i in range(4)})
+
+
+if __name__ == "__main__":
+    unittest.main()
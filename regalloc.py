@@ -0,0 +1,338 @@
+import random
+import unittest
+from bisect import insort
+from dataclasses import dataclass
+
+import kelsey
+from kelsey import ABS_PLUS, CFG, Block, F, FIB, Gblocks, UseGensym, check_preserves_run
+from names import name_supply
+
+
+"""
+Liveness analysis and linear-scan register allocation over a kelsey.CFG.
+
+liveness follows the SSA reading of phis: a phi defines its name at the top of
+its block, and each input is used at the end of the predecessor it comes from,
+so it is live out of that predecessor only, not into the phi's block.
+
+allocate numbers the instructions of the reachable blocks in reverse
+postorder, all the phis of a block sharing the block's first position, and
+gives every name one interval from its first to its last live position. The
+intervals are then scanned in order of start (Poletto and Sarkar): a register
+is freed when the interval holding it ends, and when all k are busy the
+interval ending last goes to a spill slot. A phi and its inputs are hinted
+towards one register, so the copy out of SSA would insert for that input can
+be dropped; Allocation.coalesced counts those.
+"""
+
+
+def _names(exp, out):
+    match exp:
+        case str(_):
+            out.add(exp)
+        case [_, *args]:
+            # The head is an operator or procedure name, not a variable.
+            for arg in args:
+                _names(arg, out)
+    return out
+
+
+def _term_uses(term):
+    match term:
+        case ["return", value] | ["br", value, _, _]:
+            return _names(value, set())
+    return set()
+
+
+def liveness(cfg):
+    """Return (live_in, live_out), each {block ID: set of names}, for the
+    reachable blocks of cfg. live_in includes the block's phi names."""
+    phi_defs = {}
+    upward = {}
+    defs = {}
+    # (pred, succ) -> names the phis of succ read along that edge.
+    edge_uses = {}
+    for b in cfg.rpo:
+        block = cfg.blocks[b]
+        phi_defs[b] = {phi[0] for phi in block.phis}
+        defined = set(phi_defs[b])
+        used = set()
+        for x, _, value in block.body:
+            used |= _names(value, set()) - defined
+            defined.add(x)
+        used |= _term_uses(block.term) - defined
+        upward[b] = used
+        defs[b] = defined
+        for _, _, _, inputs in block.phis:
+            for pred, arg in inputs:
+                _names(arg, edge_uses.setdefault((pred, b), set()))
+
+    live_in = {b: set() for b in cfg.rpo}
+    live_out = {b: set() for b in cfg.rpo}
+    changed = True
+    while changed:
+        changed = False
+        for b in reversed(cfg.rpo):
+            out = set()
+            for s in cfg.blocks[b].succs:
+                out |= live_in[s] - phi_defs[s]
+                out |= edge_uses.get((b, s), set())
+            new_in = phi_defs[b] | upward[b] | (out - defs[b])
+            if out != live_out[b] or new_in != live_in[b]:
+                live_out[b] = out
+                live_in[b] = new_in
+                changed = True
+    return live_in, live_out
+
+
+@dataclass(slots=True)
+class Allocation:
+    # name -> register number, for names that got one.
+    registers: dict
+    # name -> spill slot number.
+    spills: dict
+    # name -> [first, last] position.
+    intervals: dict
+    # Most names live at any one point.
+    pressure: int
+    # Phi inputs that are names, each a copy out of SSA.
+    moves: int
+    # Those whose input and phi share a register.
+    coalesced: int
+
+    @property
+    def nregs(self):
+        return max(self.registers.values(), default=-1) + 1
+
+    def location(self, name):
+        if name in self.registers:
+            return f"r{self.registers[name]}"
+        return f"s{self.spills[name]}"
+
+
+def _intervals(cfg, live_in, live_out):
+    intervals = {}
+
+    def extend(name, pos):
+        interval = intervals.get(name)
+        if interval is None:
+            intervals[name] = [pos, pos]
+        elif pos < interval[0]:
+            interval[0] = pos
+        elif pos > interval[1]:
+            interval[1] = pos
+
+    for param in cfg.params:
+        extend(param, 0)
+    # An instruction at index i reads at 2i and writes at 2i + 1, so a name
+    # whose last use is in an instruction can share a register with the name
+    # it defines.
+    i = 0
+    for b in cfg.rpo:
+        block = cfg.blocks[b]
+        for name in live_in[b]:
+            extend(name, 2 * i)
+        for x, _, value in block.body:
+            i += 1
+            for name in _names(value, set()):
+                extend(name, 2 * i)
+            extend(x, 2 * i + 1)
+        i += 1
+        for name in _term_uses(block.term) | live_out[b]:
+            extend(name, 2 * i)
+        i += 1
+    return intervals
+
+
+def _pressure(cfg, live_in, live_out):
+    pressure = 0
+    for b in cfg.rpo:
+        block = cfg.blocks[b]
+        live = live_out[b] | _term_uses(block.term)
+        pressure = max(pressure, len(live))
+        for x, _, value in reversed(block.body):
+            live.discard(x)
+            live |= _names(value, set())
+            pressure = max(pressure, len(live))
+        pressure = max(pressure, len(live_in[b]))
+    return pressure
+
+
+def linear_scan(intervals, k, hints=None):
+    """Assign registers 0..k-1 to intervals ({name: [start, end]}); returns
+    (registers, spills). hints maps a name to names whose register it should
+    take if that register is free."""
+    hints = hints or {}
+    registers = {}
+    spills = {}
+    free = set(range(k))
+    # (end, name), ordered by end.
+    active = []
+    for name in sorted(intervals, key=lambda name: (*intervals[name], name)):
+        start, end = intervals[name]
+        while active and active[0][0] < start:
+            _, done = active.pop(0)
+            free.add(registers[done])
+        if not free:
+            last_end, last = active[-1]
+            if last_end > end:
+                # Spill whichever of the two ends later.
+                registers[name] = registers.pop(last)
+                spills[last] = len(spills)
+                active.pop()
+                insort(active, (end, name))
+            else:
+                spills[name] = len(spills)
+            continue
+        reg = next((registers[other] for other in hints.get(name, ())
+                    if registers.get(other) in free), None)
+        if reg is None:
+            reg = min(free)
+        free.remove(reg)
+        registers[name] = reg
+        insort(active, (end, name))
+    return registers, spills
+
+
+def allocate(cfg, k=None):
+    """Allocate registers for cfg (a kelsey.CFG, a Gblocks dict or a Gproc
+    result) with at most k registers, or as many as needed if k is None."""
+    match cfg:
+        case dict():
+            cfg = CFG.from_blocks(cfg)
+        case ["proc", *_]:
+            cfg = CFG.from_proc(cfg)
+    live_in, live_out = liveness(cfg)
+    intervals = _intervals(cfg, live_in, live_out)
+    hints = {}
+    phi_moves = []
+    for b in cfg.rpo:
+        for x, _, _, inputs in cfg.blocks[b].phis:
+            for _, arg in inputs:
+                if isinstance(arg, str):
+                    hints.setdefault(x, []).append(arg)
+                    hints.setdefault(arg, []).append(x)
+                    phi_moves.append((x, arg))
+    registers, spills = linear_scan(intervals, len(intervals) if k is None else k, hints)
+    coalesced = sum(1 for x, arg in phi_moves
+                    if x in registers and registers.get(arg) == registers[x])
+    return Allocation(registers, spills, intervals, _pressure(cfg, live_in, live_out),
+                      len(phi_moves), coalesced)
+
+
+def rename(cfg, allocation):
+    """Return a copy of cfg with every allocated name replaced by its
+    location, "r<n>" for a register or "s<n>" for a spill slot."""
+
+    def sub(exp):
+        match exp:
+            case str(_):
+                if exp in allocation.registers or exp in allocation.spills:
+                    return allocation.location(exp)
+                return exp
+            case [op, *args]:
+                return [op, *[sub(arg) for arg in args]]
+        return exp
+
+    blocks = []
+    for block in cfg.blocks:
+        phis = [[sub(x), "<-", "phi", [(pred, sub(arg)) for pred, arg in inputs]]
+                for x, _, _, inputs in block.phis]
+        body = [[sub(x), "<-", sub(value)] for x, _, value in block.body]
+        match block.term:
+            case ["return", value]:
+                term = ["return", sub(value)]
+            case ["br", test, then, else_]:
+                term = ["br", sub(test), then, else_]
+            case term:
+                pass
+        blocks.append(Block(block.id, block.label, phis, body, term,
+                            list(block.preds), list(block.succs)))
+    return CFG(blocks, [sub(param) for param in cfg.params])
+
+
+def pressure_report(procs, k=None):
+    """Allocate each named source procedure ({name: ["lambda", ...]}) and
+    return {name: stats} in the JSON-friendly form bench.py prints."""
+    report = {}
+    with name_supply():
+        for name, lam in procs.items():
+            allocation = allocate(kelsey.Gproc(kelsey.V(lam, name=name)), k)
+            report[name] = {
+                "names": len(allocation.intervals),
+                "pressure": allocation.pressure,
+                "registers": allocation.nregs,
+                "spilled": len(allocation.spills),
+                "phi_moves": allocation.moves,
+                "coalesced": allocation.coalesced,
+            }
+    return report
+
+
+class RegallocTests(UseGensym):
+    def test_liveness(self):
+        cfg = CFG.from_proc(kelsey.Gproc(kelsey.V(ABS_PLUS)))
+        live_in, live_out = liveness(cfg)
+        [join] = [block for block in cfg.blocks if block.phis]
+        [z] = [phi[0] for phi in join.phis]
+        self.assertEqual(live_in[0], {"x", "y"})
+        self.assertEqual(live_in[join.id], {z, "y"})
+        self.assertEqual(live_out[join.id], set())
+        for pred, arg in join.phis[0][3]:
+            # The input is live out of its own predecessor only.
+            self.assertEqual(live_out[pred], {arg, "y"})
+            self.assertNotIn(arg, live_in[join.id])
+
+    def test_coalesce_phi(self):
+        allocation = allocate(kelsey.Gproc(kelsey.V(ABS_PLUS)))
+        self.assertEqual(allocation.moves, 2)
+        self.assertEqual(allocation.coalesced, 2)
+        self.assertEqual(allocation.spills, {})
+        self.assertEqual(allocation.nregs, allocation.pressure)
+
+    def test_spill(self):
+        source = ["let", [["a", ["+", "p", 1]]],
+                  ["let", [["b", ["+", "p", 2]]],
+                   ["let", [["c", ["+", "p", 3]]],
+                   ["let", [["d", ["+", "a", "b"]]],
+                    ["+", "d", "c"]]]]]
+        cfg = Gblocks(F(source, "k"), cfg=True)
+        allocation = allocate(cfg, 2)
+        self.assertEqual(allocation.pressure, 3)
+        self.assertEqual(allocation.nregs, 2)
+        self.assertEqual(len(allocation.spills), 1)
+        renamed = rename(cfg, allocation)
+        self.assertEqual(renamed.run({allocation.location("p"): 10}), cfg.run({"p": 10}))
+
+    def test_no_interference(self):
+        for k in None, 3:
+            def transform(cfg):
+                allocation = allocate(cfg, k)
+                by_register = {}
+                for name, reg in allocation.registers.items():
+                    by_register.setdefault(reg, []).append(allocation.intervals[name])
+                for intervals in by_register.values():
+                    intervals.sort()
+                    for (_, end), (start, _) in zip(intervals, intervals[1:]):
+                        self.assertLess(end, start)
+                return rename(cfg, allocation)
+            with self.subTest(k=k):
+                check_preserves_run(self, transform)
+
+    def test_unlimited_uses_few_registers(self):
+        source = kelsey.gen_source(random.Random(0), 2000, if_density=0.3)
+        allocation = allocate(Gblocks(F(source, "k"), cfg=True))
+        self.assertEqual(allocation.spills, {})
+        self.assertLess(allocation.nregs, len(allocation.intervals) // 4)
+
+    def test_pressure_report(self):
+        report = pressure_report({"fib": FIB, "abs_plus": ABS_PLUS}, k=2)
+        self.assertEqual(report["abs_plus"], {"names": 4, "pressure": 2, "registers": 2,
+                                              "spilled": 0, "phi_moves": 2, "coalesced": 2})
+        self.assertEqual(report["fib"]["registers"], 2)
+        self.assertGreater(report["fib"]["spilled"], 0)
+
+
+if __name__ == "__main__":
+    __import__("sys").modules["unittest.util"]._MAX_LENGTH = 999999999
+    unittest.main()
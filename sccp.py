@@ -0,0 +1,278 @@
+import unittest
+
+from kelsey import CFG, Block, F, Gblocks, PURE_OPS, UseGensym, check_preserves_run
+
+
+"""
+Sparse conditional constant propagation over a kelsey.CFG.
+
+Every SSA name starts at TOP (no value seen yet); names defined outside the
+graph, such as procedure parameters, are BOTTOM (not a constant). Blocks are
+evaluated only once an edge into them is known to be executable, a phi meets
+only the inputs that arrive along executable edges, and a branch whose test
+is a constant marks just one of its edges. When a name's value drops, only the
+executable blocks that use it are evaluated again, so each block is revisited
+at most a small constant number of times per name it uses.
+
+sccp then rewrites the graph: it substitutes constants for names, folds
+constant expressions, deletes the assignments and phis of constant names,
+turns constant branches into gotos, removes blocks that never became
+executable (renumbering the rest), and removes phis whose inputs are all the
+same value.
+"""
+
+
+class _Lattice:
+    __slots__ = ("name",)
+
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return self.name
+
+
+TOP = _Lattice("TOP")
+BOTTOM = _Lattice("BOTTOM")
+
+
+def meet(a, b):
+    if a is TOP:
+        return b
+    if b is TOP or a == b:
+        return a
+    return BOTTOM
+
+
+def _names(exp, out):
+    match exp:
+        case str(_):
+            out.add(exp)
+        case [_, *args]:
+            # The head is an operator or procedure name, not a variable.
+            for arg in args:
+                _names(arg, out)
+
+
+def _block_uses(block):
+    names = set()
+    for phi in block.phis:
+        for _, arg in phi[3]:
+            _names(arg, names)
+    for _, _, value in block.body:
+        _names(value, names)
+    match block.term:
+        case ["return", value] | ["br", value, _, _]:
+            _names(value, names)
+    return names
+
+
+class _Propagator:
+    def __init__(self, cfg):
+        self.cfg = cfg
+        self.values = {}
+        self.uses = {}
+        for block in cfg.blocks:
+            for phi in block.phis:
+                self.values[phi[0]] = TOP
+            for x, _, _ in block.body:
+                self.values[x] = TOP
+            for name in _block_uses(block):
+                self.uses.setdefault(name, set()).add(block.id)
+        self.executable = {0}
+        self.edges = set()
+        self.work = [0]
+
+    def value(self, exp):
+        match exp:
+            case int(_):
+                return exp
+            case str(_):
+                return self.values.get(exp, BOTTOM)
+            case [op, x, y] if op in PURE_OPS:
+                vx = self.value(x)
+                vy = self.value(y)
+                if vx is BOTTOM or vy is BOTTOM:
+                    return BOTTOM
+                if vx is TOP or vy is TOP:
+                    return TOP
+                return PURE_OPS[op](vx, vy)
+        # A call: its result is unknown.
+        return BOTTOM
+
+    def set(self, name, value):
+        old = self.values[name]
+        value = meet(old, value)
+        if value is not old and value != old:
+            self.values[name] = value
+            for b in self.uses.get(name, ()):
+                if b in self.executable:
+                    self.work.append(b)
+
+    def mark(self, pred, succ):
+        if (pred, succ) not in self.edges:
+            self.edges.add((pred, succ))
+            self.executable.add(succ)
+            self.work.append(succ)
+
+    def visit(self, b):
+        block = self.cfg.blocks[b]
+        for x, _, _, inputs in block.phis:
+            value = TOP
+            for pred, arg in inputs:
+                if (pred, b) in self.edges:
+                    value = meet(value, self.value(arg))
+            self.set(x, value)
+        for x, _, exp in block.body:
+            self.set(x, self.value(exp))
+        match block.term:
+            case ["goto", target]:
+                self.mark(b, target)
+            case ["br", test, then, else_]:
+                value = self.value(test)
+                if value is BOTTOM:
+                    self.mark(b, then)
+                    self.mark(b, else_)
+                elif value is not TOP:
+                    self.mark(b, then if value else else_)
+
+    def run(self):
+        while self.work:
+            self.visit(self.work.pop())
+
+
+def _rewrite(exp, subst):
+    """Substitute subst (name -> int or name) into exp and fold constants."""
+    match exp:
+        case str(_):
+            while isinstance(exp, str) and exp in subst:
+                exp = subst[exp]
+            return exp
+        case int(_):
+            return exp
+        case [op, x, y] if op in PURE_OPS:
+            x = _rewrite(x, subst)
+            y = _rewrite(y, subst)
+            if isinstance(x, int) and isinstance(y, int):
+                return PURE_OPS[op](x, y)
+            return [op, x, y]
+        case [fn, *args]:
+            return [fn, *[_rewrite(arg, subst) for arg in args]]
+    raise NotImplementedError(exp)
+
+
+def sccp(cfg):
+    """Run SCCP over cfg (a kelsey.CFG, or a Gblocks dict).
+
+    Returns (new CFG, stats) where stats counts instructions (phis,
+    assignments and terminators) and blocks before and after."""
+    if isinstance(cfg, dict):
+        cfg = CFG.from_blocks(cfg)
+    propagator = _Propagator(cfg)
+    propagator.run()
+    edges = propagator.edges
+    subst = {x: v for x, v in propagator.values.items() if type(v) is int}
+
+    live = [block.id for block in cfg.blocks if block.id in propagator.executable]
+    renumber = {old: new for new, old in enumerate(live)}
+    blocks = []
+    for old in live:
+        block = cfg.blocks[old]
+        phis = [[x, "<-", "phi", [(renumber[pred], arg) for pred, arg in inputs
+                                  if (pred, old) in edges]]
+                for x, _, _, inputs in block.phis if x not in subst]
+        body = [stmt for stmt in block.body if stmt[0] not in subst]
+        term = block.term
+        match term:
+            case ["goto", target]:
+                term = ["goto", renumber[target]]
+            case ["br", test, then, else_]:
+                targets = [t for t in (then, else_) if (old, t) in edges]
+                if len(targets) == 1:
+                    term = ["goto", renumber[targets[0]]]
+                else:
+                    term = ["br", test, renumber[then], renumber[else_]]
+        preds = [renumber[pred] for pred in block.preds if (pred, old) in edges]
+        blocks.append(Block(renumber[old], block.label, phis, body, term, preds, []))
+
+    # A phi whose inputs (other than itself) are all one value is that value.
+    changed = True
+    while changed:
+        changed = False
+        for block in blocks:
+            for phi in list(block.phis):
+                args = {_rewrite(arg, subst) for _, arg in phi[3]} - {phi[0]}
+                if len(args) == 1:
+                    subst[phi[0]] = args.pop()
+                    block.phis.remove(phi)
+                    changed = True
+
+    for block in blocks:
+        for phi in block.phis:
+            phi[3] = [(pred, _rewrite(arg, subst)) for pred, arg in phi[3]]
+        block.body = [[x, "<-", _rewrite(value, subst)] for x, _, value in block.body]
+        match block.term:
+            case ["return", value]:
+                block.term = ["return", _rewrite(value, subst)]
+            case ["br", test, then, else_]:
+                block.term = ["br", _rewrite(test, subst), then, else_]
+        match block.term:
+            case ["goto", target]:
+                block.succs = [target]
+            case ["br", _, then, else_]:
+                block.succs = [then, else_]
+    result = CFG(blocks, cfg.params)
+    stats = {
+        "instructions_before": cfg.instruction_count(),
+        "instructions_after": result.instruction_count(),
+        "blocks_before": len(cfg.rpo),
+        "blocks_after": len(result.rpo),
+    }
+    return result, stats
+
+
+class SCCPTests(UseGensym):
+    def test_constant_branch(self):
+        cps = F(["if", 1, ["f", 2], ["g", 3]], ["l_cont", ["x"], ["$call-cont", "$halt", "x"]])
+        cfg, stats = sccp(Gblocks(cps, cfg=True))
+        self.assertEqual(cfg.blocks, [
+            Block(0, "entry", [], [], ["goto", 2], [], [2]),
+            Block(1, "k0", [], [], ["return", "v1"], [2], []),
+            Block(2, None, [], [["v1", "<-", ["f", 2]]], ["goto", 1], [0], [1]),
+        ])
+        self.assertEqual(stats, {"instructions_before": 7, "instructions_after": 4,
+                                 "blocks_before": 4, "blocks_after": 3})
+
+    def test_constant_phi(self):
+        cps = F(["let", [["a", ["if", "p", 1, 1]]], ["+", "a", 1]], "k")
+        cfg, _ = sccp(Gblocks(cps, cfg=True))
+        [join] = [block for block in cfg.blocks if block.label not in ("entry", None)]
+        self.assertEqual((join.phis, join.body, join.term), ([], [], ["return", 2]))
+        self.assertEqual(cfg[0].term[0], "br")
+
+    def test_trivial_phi(self):
+        cps = F(["let", [["a", ["if", "p", "x", "x"]]], ["+", "a", 1]], "k")
+        cfg, _ = sccp(Gblocks(cps, cfg=True))
+        [join] = [block for block in cfg.blocks if block.label not in ("entry", None)]
+        self.assertEqual((join.phis, join.term), ([], ["return", ["+", "x", 1]]))
+
+    def test_folds_through_assignments(self):
+        source = ["let", [["a", 2]],
+                  ["let", [["b", ["-", "a", 2]]],
+                   ["let", [["c", ["if", "b", ["f", "a"], ["+", "a", "a"]]]],
+                    ["+", "c", "p"]]]]
+        cfg, stats = sccp(Gblocks(F(source, "k"), cfg=True))
+        self.assertEqual(stats["blocks_after"], 3)
+        self.assertEqual(cfg.run({"p": 10}), (14, 3))
+
+    def test_preserves_results(self):
+        def transform(cfg):
+            new, stats = sccp(cfg)
+            self.assertLessEqual(stats["instructions_after"], stats["instructions_before"])
+            return new
+        check_preserves_run(self, transform)
+
+
+if __name__ == "__main__":
+    __import__("sys").modules["unittest.util"]._MAX_LENGTH = 999999999
+    unittest.main()
@@ -0,0 +1,262 @@
+import heapq
+import itertools
+import unittest
+from collections import deque
+
+import cps
+from cps import Profile, as_env, cps_cont, drive
+
+
+"""
+A preemptive scheduler for CPS programs.
+
+Every transition of the CPS machine is a tail call, so a program's whole
+state between steps is one (term, env) pair. Scheduler keeps that pair for
+each spawned Program and runs the programs as green threads: a program runs
+for at most fuel steps, then is suspended and the next one runs. A program
+that never halts therefore costs the others one slice per turn rather than
+the worker.
+
+The order of the slices is round-robin by default. With policy="stride" each
+program gets slices in proportion to its priority (stride scheduling, after
+Waldspurger and Weihl): a program's pass advances by STRIDE // priority for
+every slice it runs, and the program with the lowest pass runs next.
+
+Each Program counts its steps and slices, and its Profile counts the
+environments, continuations, closures and frame records it allocates (see
+cps.Profile). Host procedures keep cps.interp's protocol, f(arg, env, k); the
+state they resume with apply_cont is handed back through cps.RESUME, so it
+runs in the program's later slices instead of in a nested interp outside the
+scheduler's control. An exception raised by a program ends that program only
+and is kept in Program.error.
+"""
+
+
+STRIDE = 1 << 20
+
+
+class Program:
+    """A program spawned on a Scheduler, and its accounting."""
+
+    __slots__ = ("id", "name", "priority", "state", "pending", "result", "error",
+                 "done", "slices", "profile", "pass_")
+
+    def __init__(self, id, name, priority, state):
+        self.id = id
+        self.name = name
+        self.priority = priority
+        self.state = state
+        # States handed back by host procedures, run in order.
+        self.pending = deque()
+        self.result = None
+        self.error = None
+        self.done = False
+        self.slices = 0
+        self.profile = Profile()
+        self.pass_ = 0
+
+    @property
+    def steps(self):
+        return self.profile.steps
+
+    @property
+    def allocations(self):
+        """Environments, continuations, closures and frames allocated."""
+        profile = self.profile
+        return (profile.env_allocs + profile.cont_allocs
+                + profile.closure_allocs + profile.frame_allocs)
+
+    def stats(self):
+        return {"name": self.name, "priority": self.priority, "done": self.done,
+                "steps": self.steps, "slices": self.slices,
+                "allocations": self.allocations,
+                "error": None if self.error is None else repr(self.error)}
+
+    def __repr__(self):
+        return f"<Program {self.id} {self.name!r} steps={self.steps} done={self.done}>"
+
+
+class Scheduler:
+    def __init__(self, fuel=1000, policy="round-robin"):
+        if fuel < 1:
+            raise ValueError(f"fuel must be positive, not {fuel}")
+        if policy not in ("round-robin", "stride"):
+            raise ValueError(f"unknown policy {policy!r}")
+        self.fuel = fuel
+        self.policy = policy
+        self.programs = []
+        self._ids = itertools.count()
+        # Round-robin: a deque of programs. Stride: a heap of
+        # (pass, id, program).
+        self._ready = deque() if policy == "round-robin" else []
+
+    def spawn(self, term, env=None, priority=1, name=None):
+        """Add a program, with "k" bound to a continuation that halts it with
+        its argument as the result. Returns the Program."""
+        if priority < 1:
+            raise ValueError(f"priority must be positive, not {priority}")
+        id = next(self._ids)
+        program = Program(id, f"program-{id}" if name is None else name, priority, None)
+
+        def halt(value):
+            program.result = value
+
+        program.state = term, as_env({**(env or {}), "k": halt})
+        self.programs.append(program)
+        if self.policy == "round-robin":
+            self._ready.append(program)
+        else:
+            # Join at the current minimum pass, so a newcomer neither waits
+            # behind nor jumps ahead of programs that have run for a while.
+            program.pass_ = self._ready[0][0] if self._ready else 0
+            heapq.heappush(self._ready, (program.pass_, id, program))
+        return program
+
+    def _next(self):
+        if self.policy == "round-robin":
+            return self._ready.popleft() if self._ready else None
+        return heapq.heappop(self._ready)[2] if self._ready else None
+
+    def _requeue(self, program):
+        if self.policy == "round-robin":
+            self._ready.append(program)
+        else:
+            program.pass_ += STRIDE // program.priority
+            heapq.heappush(self._ready, (program.pass_, program.id, program))
+
+    def _slice(self, program):
+        try:
+            state, _ = drive(program.state, program.pending, self.fuel, program.profile)
+        except Exception as error:
+            program.error = error
+            state = None
+            program.pending.clear()
+        program.state = state
+        program.slices += 1
+        program.done = state is None and not program.pending
+
+    def run_slice(self):
+        """Run the next ready program for one slice. Returns that program,
+        or None if none is ready."""
+        program = self._next()
+        if program is None:
+            return None
+        self._slice(program)
+        if not program.done:
+            self._requeue(program)
+        return program
+
+    def run(self, max_slices=None):
+        """Run slices until every program is done, or max_slices have run.
+        Returns the programs in the order they finished."""
+        finished = []
+        for _ in range(max_slices) if max_slices is not None else itertools.count():
+            program = self.run_slice()
+            if program is None:
+                break
+            if program.done:
+                finished.append(program)
+        return finished
+
+    def report(self):
+        return [program.stats() for program in self.programs]
+
+
+def _recursive_sum(n):
+    return cps.closure_convert(cps_cont(cps.recursive_sum_source(n), "k"))
+
+
+def _loop_forever():
+    # ((lambda (f) (f f)) (lambda (f) (f f))) never halts.
+    omega = ["lambda", ["f"], ["f", "f"]]
+    return cps.closure_convert(cps_cont([omega, omega], "k"))
+
+
+class SchedulerTests(unittest.TestCase):
+    def test_results(self):
+        scheduler = Scheduler(fuel=7)
+        programs = [scheduler.spawn(cps_cont(["+", i, ["*", i, 2]], "k")) for i in range(5)]
+        scheduler.spawn(_recursive_sum(50))
+        scheduler.run()
+        self.assertEqual([program.result for program in programs], [3 * i for i in range(5)])
+        self.assertEqual(scheduler.programs[-1].result, 50 * 51 // 2)
+        self.assertTrue(all(program.done for program in scheduler.programs))
+
+    def test_steps_match_interp(self):
+        term = _recursive_sum(20)
+        expected = Profile()
+        cps.interp(term, {"k": lambda x: None}, expected)
+        scheduler = Scheduler(fuel=10)
+        program = scheduler.spawn(term)
+        scheduler.run()
+        self.assertEqual(program.steps, expected.steps)
+        self.assertEqual(program.slices, -(-expected.steps // 10))
+        self.assertEqual(program.allocations,
+                         expected.env_allocs + expected.cont_allocs + expected.closure_allocs)
+        self.assertGreater(program.allocations, 0)
+
+    def test_long_program_does_not_starve_short_ones(self):
+        scheduler = Scheduler(fuel=100)
+        forever = scheduler.spawn(_loop_forever(), name="forever")
+        short = [scheduler.spawn(cps_cont(["+", i, 1], "k")) for i in range(10)]
+        finished = scheduler.run(max_slices=50)
+        self.assertEqual(finished, short)
+        self.assertFalse(forever.done)
+        self.assertEqual(forever.steps, 100 * (50 - len(short)))
+
+    def test_stride_priority(self):
+        scheduler = Scheduler(fuel=50, policy="stride")
+        low = scheduler.spawn(_loop_forever(), priority=1)
+        high = scheduler.spawn(_loop_forever(), priority=3)
+        scheduler.run(max_slices=400)
+        self.assertEqual(low.slices + high.slices, 400)
+        self.assertEqual(high.slices, 3 * low.slices)
+
+    def test_host_procedures(self):
+        seen = []
+        def show(x, env, k):
+            seen.append(x)
+            cps.apply_cont(k, x + 1, env)
+        scheduler = Scheduler(fuel=1)
+        program = scheduler.spawn(cps_cont(["show", ["show", 1]], "k"), {"show": show})
+        other = scheduler.spawn(cps_cont(["+", 1, 2], "k"))
+        scheduler.run()
+        self.assertEqual((program.result, other.result, seen), (3, 3, [1, 2]))
+        # Each resumption ran in a slice of its own, not inside the host call.
+        self.assertEqual(program.slices, program.steps)
+
+    def test_host_runs_nested_interp(self):
+        def ident(x, env, k):
+            cps.apply_cont(k, x, env)
+        def evalsub(x, env, k):
+            out = []
+            cps.interp(cps_cont(["+", x, ["ident", 41]], "k"),
+                       {"k": out.append, "ident": ident})
+            cps.apply_cont(k, out[0] if out else -1, env)
+        scheduler = Scheduler(fuel=2)
+        program = scheduler.spawn(cps_cont(["+", 1, ["evalsub", 1]], "k"),
+                                  {"evalsub": evalsub})
+        scheduler.run()
+        self.assertEqual(program.result, 43)
+
+    def test_error_ends_one_program(self):
+        scheduler = Scheduler(fuel=3)
+        bad = scheduler.spawn(cps_cont(["/", 1, 0], "k"))
+        good = scheduler.spawn(cps_cont(["+", 1, 2], "k"))
+        scheduler.run()
+        self.assertIsInstance(bad.error, ZeroDivisionError)
+        self.assertTrue(bad.done)
+        self.assertEqual(good.result, 3)
+        self.assertTrue(scheduler.report()[0]["error"].startswith("ZeroDivisionError"))
+
+    def test_invalid_arguments(self):
+        with self.assertRaises(ValueError):
+            Scheduler(fuel=0)
+        with self.assertRaises(ValueError):
+            Scheduler(policy="lottery")
+        with self.assertRaises(ValueError):
+            Scheduler().spawn(cps_cont(1, "k"), priority=0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,34 +1,162 @@
-# Lean on Python refcounting to demonstrate trampoline structure lifetimes.
+import argparse
+import itertools
+import math
+import unittest
 
-trampoline_id = 0
 
-class Trampoline:
-    def __init__(self, f):
-        self.f = f
-        global trampoline_id
-        self.id = trampoline_id
-        trampoline_id += 1
-        print("alloc", self.id)
+"""
+A trampoline for programs in continuation-passing style.
+
+A function that would make a tail call returns a Bounce instead: the function
+and a tuple of its arguments. trampoline calls bounces until one returns
+something else, so the Python stack stays flat however long the chain of tail
+calls. Bounce is a slotted pair; the continuations of fact_cps_thunked are
+slotted records, so each level of the recursion costs one small record while
+it is pending and each bounce one short-lived Bounce.
+
+TracedBounce reports the allocation, call and collection of every bounce.
+Functions take the bounce class as an argument, so passing TracedBounce turns
+tracing on for one run and costs the untraced path nothing.
+
+Run as a script to print a factorial, for example:
+
+    python trampoline.py 5 --trace
+"""
+
+
+class Bounce:
+    """A pending call of fn(*args)."""
+
+    __slots__ = ("fn", "args")
+
+    def __init__(self, fn, args):
+        self.fn = fn
+        self.args = args
 
     def __call__(self):
-        print("call", self.id)
-        return self.f()
+        return self.fn(*self.args)
+
+
+class TracedBounce(Bounce):
+    """A Bounce that reports its lifetime by calling log(event, id)."""
+
+    __slots__ = ("id",)
+    ids = itertools.count()
+    log = print
+
+    def __init__(self, fn, args):
+        self.fn = fn
+        self.args = args
+        self.id = next(TracedBounce.ids)
+        TracedBounce.log("alloc", self.id)
+
+    def __call__(self):
+        TracedBounce.log("call", self.id)
+        return self.fn(*self.args)
 
     def __del__(self):
-        print("del", self.id)
+        TracedBounce.log("del", self.id)
+
 
 def trampoline(f, *args):
-    v = f(*args)
-    while isinstance(v, Trampoline):
-        v = v()
-    return v
+    """Call f(*args), then each Bounce returned, until a value comes back."""
+    value = f(*args)
+    while isinstance(value, Bounce):
+        value = value()
+    return value
+
+
+def trampoline_counted(f, *args):
+    """Like trampoline, but return (value, number of bounces run)."""
+    value = f(*args)
+    bounces = 0
+    while isinstance(value, Bounce):
+        value = value()
+        bounces += 1
+    return value, bounces
 
-def fact_cps_thunked(n, cont):
+
+class _Times:
+    """Continuation of fact_cps_thunked's recursive call: multiply the result
+    by n (reduced by modulus, if any) and bounce to cont."""
+
+    __slots__ = ("n", "cont", "bounce", "modulus")
+
+    def __init__(self, n, cont, bounce, modulus):
+        self.n = n
+        self.cont = cont
+        self.bounce = bounce
+        self.modulus = modulus
+
+    def __call__(self, value):
+        value *= self.n
+        if self.modulus is not None:
+            value %= self.modulus
+        return self.bounce(self.cont, (value,))
+
+
+def fact_cps_thunked(n, cont, bounce=Bounce, modulus=None):
+    """n! (mod modulus, if given) passed to cont, run under trampoline.
+
+    Takes 2n bounces: n on the way down and n returning through the
+    continuations."""
     if n == 0:
         return cont(1)
-    else:
-        return Trampoline(lambda: fact_cps_thunked(
-                         n - 1,
-                         lambda value: Trampoline(lambda: cont(n * value))))
+    return bounce(fact_cps_thunked, (n - 1, _Times(n, cont, bounce, modulus), bounce, modulus))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("n", type=int)
+    parser.add_argument("--trace", action="store_true", help="log every bounce")
+    parser.add_argument("--modulus", type=int, default=None)
+    args = parser.parse_args(argv)
+    bounce = TracedBounce if args.trace else Bounce
+    print(trampoline(fact_cps_thunked, args.n, lambda x: x, bounce, args.modulus))
+
+
+class TrampolineTests(unittest.TestCase):
+    def test_fact(self):
+        for n in range(10):
+            self.assertEqual(trampoline(fact_cps_thunked, n, lambda x: x), math.factorial(n))
+
+    def test_deep(self):
+        # Far deeper than the Python stack allows.
+        m = 2**61 - 1
+        value, bounces = trampoline_counted(fact_cps_thunked, 200_000, lambda x: x, Bounce, m)
+        self.assertEqual(value, math.factorial(200_000) % m)
+        self.assertEqual(bounces, 400_000)
+
+    def test_trace(self):
+        events = []
+        old = TracedBounce.log
+        TracedBounce.log = lambda event, id: events.append(event)
+        try:
+            self.assertEqual(trampoline(fact_cps_thunked, 3, lambda x: x, TracedBounce), 6)
+        finally:
+            TracedBounce.log = old
+        self.assertEqual(events.count("alloc"), 6)
+        self.assertEqual(events.count("call"), 6)
+        # Every bounce is collected as soon as it has run.
+        self.assertEqual(events.count("del"), 6)
+        self.assertEqual(events[:3], ["alloc", "call", "alloc"])
+
+    def test_untraced_is_silent(self):
+        calls = []
+        old = TracedBounce.log
+        TracedBounce.log = lambda *args: calls.append(args)
+        try:
+            trampoline(fact_cps_thunked, 5, lambda x: x)
+        finally:
+            TracedBounce.log = old
+        self.assertEqual(calls, [])
+
+    def test_bounce_is_slotted(self):
+        bounce = Bounce(abs, (-1,))
+        self.assertFalse(hasattr(bounce, "__dict__"))
+        self.assertEqual(bounce(), 1)
+
 
-print(trampoline(fact_cps_thunked, 0, lambda x: x))
+if __name__ == "__main__":
+    main()
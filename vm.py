@@ -0,0 +1,384 @@
+import unittest
+from array import array
+
+import kelsey
+from names import name_supply
+
+
+"""
+A register VM for kelsey SSA procedures.
+
+assemble_procs takes named source procedures, lowers each through kelsey.V,
+kelsey.Gproc and kelsey.out_of_ssa, and packs it into a flat array('q') of
+instructions. Every variable, temporary and constant gets a numbered register;
+constants are preloaded into a per-procedure frame template, so no instruction
+loads one. Labels are resolved to absolute offsets in the stream.
+
+An instruction is an opcode followed by its operands:
+
+    MOVE dst src
+    ADD/SUB/MUL/LT/LE/GT/GE/EQ/NE dst x y
+    JMP target
+    JZ test target          jump when register test is zero
+    RET src
+    CALL dst proc argc args...
+    TAILCALL proc argc args...
+    HOST dst host argc args...
+    TAILHOST host argc args...
+
+CALL pushes the caller on an explicit stack instead of recursing in Python,
+and a call in tail position replaces the current frame, so deep and mutually
+tail-recursive procedures run in constant Python stack. Calls to names that are
+not procedures of the program go to host functions supplied at assembly time.
+Values are Python ints; comparisons produce 0 or 1.
+"""
+
+
+MOVE, ADD, SUB, MUL, LT, LE, GT, GE, EQ, NE, JMP, JZ, RET, CALL, TAILCALL, HOST, TAILHOST = range(17)
+
+OPNAMES = ["MOVE", "ADD", "SUB", "MUL", "LT", "LE", "GT", "GE", "EQ", "NE",
+           "JMP", "JZ", "RET", "CALL", "TAILCALL", "HOST", "TAILHOST"]
+
+BINOPS = {"+": ADD, "-": SUB, "*": MUL, "<": LT, "<=": LE, ">": GT, ">=": GE, "=": EQ, "!=": NE}
+
+
+class Bytecode:
+    """One assembled procedure."""
+
+    __slots__ = ("name", "nparams", "code", "frame", "labels")
+
+    def __init__(self, name, nparams, code, frame, labels):
+        self.name = name
+        self.nparams = nparams
+        # array("q") instruction stream.
+        self.code = code
+        # Initial register file: constants in place, everything else 0.
+        self.frame = frame
+        self.labels = labels
+
+
+class Assembler:
+    def __init__(self, name, procs, hosts):
+        self.name = name
+        self.procs = procs
+        self.hosts = hosts
+        self.regs = {}
+        self.consts = {}
+        self.nregs = 0
+        self.code = array("q")
+        self.labels = {}
+        # (offset of the operand, label) to patch once all labels are known.
+        self.fixups = []
+
+    def new_reg(self):
+        self.nregs += 1
+        return self.nregs - 1
+
+    def reg(self, name):
+        reg = self.regs.get(name)
+        if reg is None:
+            reg = self.regs[name] = self.new_reg()
+        return reg
+
+    def const(self, value):
+        reg = self.consts.get(value)
+        if reg is None:
+            reg = self.consts[value] = self.new_reg()
+        return reg
+
+    def emit(self, *words):
+        self.code.extend(words)
+
+    def operand(self, exp):
+        """Return a register holding the value of exp, emitting code for it."""
+        match exp:
+            case bool(_):
+                raise TypeError(f"not an integer: {exp!r}")
+            case int(_):
+                return self.const(exp)
+            case str(_):
+                if exp not in self.regs:
+                    raise NameError(f"unbound variable: {exp}")
+                return self.regs[exp]
+        dst = self.new_reg()
+        self.assign(dst, exp)
+        return dst
+
+    def call_operands(self, fn, args):
+        if fn in self.procs:
+            index, arity = self.procs[fn]
+            if len(args) != arity:
+                raise TypeError(f"{fn} takes {arity} arguments, got {len(args)}")
+            return False, index, [self.operand(arg) for arg in args]
+        if fn in self.hosts:
+            return True, self.hosts[fn], [self.operand(arg) for arg in args]
+        raise NameError(f"unknown procedure: {fn}")
+
+    def assign(self, dst, exp):
+        match exp:
+            case int(_) | str(_):
+                self.emit(MOVE, dst, self.operand(exp))
+            case [op, x, y] if op in BINOPS:
+                rx = self.operand(x)
+                ry = self.operand(y)
+                self.emit(BINOPS[op], dst, rx, ry)
+            case [str(fn), *args]:
+                host, index, regs = self.call_operands(fn, args)
+                self.emit(HOST if host else CALL, dst, index, len(regs), *regs)
+            case _:
+                raise NotImplementedError(exp)
+
+    def ret(self, exp):
+        match exp:
+            case [str(fn), *args] if not (fn in BINOPS and len(args) == 2):
+                host, index, regs = self.call_operands(fn, args)
+                self.emit(TAILHOST if host else TAILCALL, index, len(regs), *regs)
+            case _:
+                self.emit(RET, self.operand(exp))
+
+    def stmts(self, stmts):
+        for stmt in stmts:
+            match stmt:
+                case [x, "<-", value]:
+                    self.assign(self.reg(x), value)
+                case ["return", value]:
+                    self.ret(value)
+                case ["goto", label]:
+                    self.emit(JMP, 0)
+                    self.fixups.append((len(self.code) - 1, label))
+                case ["if", test, conseq, alt]:
+                    self.emit(JZ, self.operand(test), 0)
+                    patch = len(self.code) - 1
+                    # Both arms end in a return or goto, so conseq needs no
+                    # jump over alt.
+                    self.stmts(conseq)
+                    self.code[patch] = len(self.code)
+                    self.stmts(alt)
+                case _:
+                    raise NotImplementedError(stmt)
+
+    def assemble(self, proc):
+        _, params, entry, *blocks = proc
+        params = params[:-1]
+        for param in params:
+            self.reg(param)
+        blocks = kelsey.out_of_ssa({"entry": entry, **{label: stmts for label, stmts in blocks}})
+        # Every register a block assigns must exist before any block reads it.
+        for stmts in blocks.values():
+            for x in kelsey.assigned(stmts):
+                self.reg(x)
+        for label, stmts in blocks.items():
+            self.labels[label] = len(self.code)
+            self.stmts(stmts)
+        for offset, label in self.fixups:
+            self.code[offset] = self.labels[label]
+        frame = [0] * self.nregs
+        for value, reg in self.consts.items():
+            frame[reg] = value
+        return Bytecode(self.name, len(params), self.code, frame, self.labels)
+
+
+class VM:
+    """Assembled procedures and host functions, callable by name."""
+
+    def __init__(self, procs, hosts):
+        self.procs = procs
+        self.names = {proc.name: i for i, proc in enumerate(procs)}
+        self.hosts = hosts
+
+    def __call__(self, name, *args):
+        proc = self.procs[self.names[name]]
+        if len(args) != proc.nparams:
+            raise TypeError(f"{name} takes {proc.nparams} arguments, got {len(args)}")
+        return self.run(proc, list(args))
+
+    def run(self, proc, args):
+        procs = self.procs
+        hosts = self.hosts
+        code = proc.code
+        frame = proc.frame.copy()
+        frame[:len(args)] = args
+        stack = []
+        pc = 0
+        while True:
+            op = code[pc]
+            if op == MOVE:
+                frame[code[pc + 1]] = frame[code[pc + 2]]
+                pc += 3
+            elif op == ADD:
+                frame[code[pc + 1]] = frame[code[pc + 2]] + frame[code[pc + 3]]
+                pc += 4
+            elif op == SUB:
+                frame[code[pc + 1]] = frame[code[pc + 2]] - frame[code[pc + 3]]
+                pc += 4
+            elif op == JZ:
+                if frame[code[pc + 1]]:
+                    pc += 3
+                else:
+                    pc = code[pc + 2]
+            elif op == JMP:
+                pc = code[pc + 1]
+            elif op == LT:
+                frame[code[pc + 1]] = 1 if frame[code[pc + 2]] < frame[code[pc + 3]] else 0
+                pc += 4
+            elif op == CALL or op == TAILCALL:
+                if op == CALL:
+                    dst = code[pc + 1]
+                    pc += 1
+                callee = procs[code[pc + 1]]
+                argc = code[pc + 2]
+                new_frame = callee.frame.copy()
+                for i in range(argc):
+                    new_frame[i] = frame[code[pc + 3 + i]]
+                if op == CALL:
+                    stack.append((code, frame, pc + 3 + argc, dst))
+                code = callee.code
+                frame = new_frame
+                pc = 0
+            elif op == RET or op == TAILHOST:
+                if op == RET:
+                    value = frame[code[pc + 1]]
+                else:
+                    argc = code[pc + 2]
+                    value = hosts[code[pc + 1]](*[frame[code[pc + 3 + i]] for i in range(argc)])
+                if not stack:
+                    return value
+                code, frame, pc, dst = stack.pop()
+                frame[dst] = value
+            elif op == HOST:
+                argc = code[pc + 3]
+                frame[code[pc + 1]] = hosts[code[pc + 2]](
+                    *[frame[code[pc + 4 + i]] for i in range(argc)])
+                pc += 4 + argc
+            elif op == MUL:
+                frame[code[pc + 1]] = frame[code[pc + 2]] * frame[code[pc + 3]]
+                pc += 4
+            elif op == LE:
+                frame[code[pc + 1]] = 1 if frame[code[pc + 2]] <= frame[code[pc + 3]] else 0
+                pc += 4
+            elif op == GT:
+                frame[code[pc + 1]] = 1 if frame[code[pc + 2]] > frame[code[pc + 3]] else 0
+                pc += 4
+            elif op == GE:
+                frame[code[pc + 1]] = 1 if frame[code[pc + 2]] >= frame[code[pc + 3]] else 0
+                pc += 4
+            elif op == EQ:
+                frame[code[pc + 1]] = 1 if frame[code[pc + 2]] == frame[code[pc + 3]] else 0
+                pc += 4
+            elif op == NE:
+                frame[code[pc + 1]] = 1 if frame[code[pc + 2]] != frame[code[pc + 3]] else 0
+                pc += 4
+            else:
+                raise ValueError(f"bad opcode {op} at {pc} in {proc.name}")
+
+
+def assemble_procs(procs, hosts=None):
+    """Assemble named source procedures into a VM.
+
+    hosts maps names to Python functions that the procedures may call."""
+    hosts = hosts or {}
+    index = {}
+    for i, (name, lam) in enumerate(procs.items()):
+        match lam:
+            case ["lambda", [*args], _]:
+                index[name] = (i, len(args))
+            case _:
+                raise TypeError(f"not a procedure: {lam}")
+    host_names = [name for name in hosts if name not in index]
+    host_index = {name: i for i, name in enumerate(host_names)}
+    assembled = []
+    with name_supply():
+        for name, lam in procs.items():
+            proc = kelsey.Gproc(kelsey.V(lam, name=name))
+            assembled.append(Assembler(name, index, host_index).assemble(proc))
+    return VM(assembled, [hosts[name] for name in host_names])
+
+
+def disassemble(bytecode):
+    """Return the instructions of a Bytecode as (offset, name, operands)."""
+    code = bytecode.code
+    result = []
+    pc = 0
+    while pc < len(code):
+        op = code[pc]
+        if op in (JMP, RET):
+            width = 2
+        elif op in (MOVE, JZ):
+            width = 3
+        elif op in (CALL, HOST):
+            width = 4 + code[pc + 3]
+        elif op in (TAILCALL, TAILHOST):
+            width = 3 + code[pc + 2]
+        else:
+            width = 4
+        result.append((pc, OPNAMES[op], list(code[pc + 1:pc + width])))
+        pc += width
+    return result
+
+
+class VMTests(unittest.TestCase):
+    def test_fib(self):
+        vm = assemble_procs({"fib": kelsey.FIB})
+        self.assertEqual([vm("fib", n) for n in range(10)], [0, 1, 1, 2, 3, 5, 8, 13, 21, 34])
+
+    def test_instruction_stream(self):
+        vm = assemble_procs({"f": ["lambda", ["x"], ["let", [["y", ["if", "x", 1, 2]]],
+                                                     ["+", "y", 1]]]})
+        [proc] = vm.procs
+        self.assertIsInstance(proc.code, array)
+        self.assertEqual(proc.code.typecode, "q")
+        # x, the phi inputs and y, the constants 1 and 2, and a temporary
+        # for the returned sum.
+        self.assertEqual(proc.frame, [0, 0, 0, 0, 1, 2, 0])
+        self.assertEqual(disassemble(proc),
+                         [(0, "JZ", [0, 11]),
+                          (3, "MOVE", [1, 4]),
+                          (6, "MOVE", [2, 1]),
+                          (9, "JMP", [19]),
+                          (11, "MOVE", [3, 5]),
+                          (14, "MOVE", [2, 3]),
+                          (17, "JMP", [19]),
+                          (19, "ADD", [6, 2, 4]),
+                          (23, "RET", [6])])
+
+    def test_phi(self):
+        vm = assemble_procs({"f": ["lambda", ["x"], ["let", [["y", ["if", "x", 1, 2]]],
+                                                     ["+", "y", 1]]]})
+        self.assertEqual([vm("f", 0), vm("f", 5)], [3, 2])
+
+    def test_deep_mutual_tail_recursion(self):
+        even = ["lambda", ["n"],
+                ["if", ["=", "n", 0], 1, ["let", [["m", ["-", "n", 1]]], ["odd", "m"]]]]
+        odd = ["lambda", ["n"],
+               ["if", ["=", "n", 0], 0, ["let", [["m", ["-", "n", 1]]], ["even", "m"]]]]
+        vm = assemble_procs({"even": even, "odd": odd})
+        self.assertEqual(vm("even", 100_001), 0)
+
+    def test_deep_recursion(self):
+        total = ["lambda", ["n"],
+                 ["if", "n", ["let", [["m", ["-", "n", 1]]],
+                              ["let", [["s", ["total", "m"]]], ["+", "s", "n"]]], 0]]
+        vm = assemble_procs({"total": total})
+        self.assertEqual(vm("total", 50_000), 50_000 * 50_001 // 2)
+
+    def test_self_tail_call_is_a_loop(self):
+        vm = assemble_procs({"total": kelsey.TOTAL})
+        [proc] = vm.procs
+        ops = [op for _, op, _ in disassemble(proc)]
+        self.assertNotIn("TAILCALL", ops)
+        self.assertIn("JMP", ops)
+        self.assertEqual(vm("total", 100_000, 0), 100_000 * 100_001 // 2)
+
+    def test_host(self):
+        vm = assemble_procs({"f": ["lambda", ["x"], ["let", [["y", ["double", "x"]]], ["show", "y"]]]},
+                            {"double": lambda x: x * 2, "show": str})
+        self.assertEqual(vm("f", 21), "42")
+
+    def test_unknown_procedure(self):
+        with self.assertRaises(NameError):
+            assemble_procs({"f": ["lambda", ["x"], ["g", "x"]]})
+
+
+if __name__ == "__main__":
+    __import__("sys").modules["unittest.util"]._MAX_LENGTH = 999999999
+    unittest.main()